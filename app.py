@@ -1,14 +1,24 @@
-from flask import Flask, request, jsonify, session, g, send_file, redirect, url_for, render_template  # AÑADÍ render_template
+from flask import Flask, request, jsonify, session, g, send_file, redirect, url_for, render_template, Response  # AÑADÍ render_template
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import hashlib
+import json
 import os
+import re
 import uuid
 from PIL import Image, ImageDraw, ImageFont
-import textwrap
 import io
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import threading
+import queue
+import atexit
+import bisect
+import gc
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from mailjet_rest import Client
 import base64
 from dotenv import load_dotenv
@@ -26,84 +36,1353 @@ app.secret_key = os.getenv('SECRET_KEY', 'fallback-secret-key')
 
 
 # Rutas de archivos (usando rutas relativas)
-DATABASE = 'data/sys-donaciones/sys-donaciones'
+DATABASE = os.getenv('DATABASE_PATH', 'data/sys-donaciones/sys-donaciones')
 UPLOAD_FOLDER = 'data/sys-donaciones/certificados'
 TEMPLATES_FOLDER = 'data/sys-donaciones/plantillas'
+FUENTES_FOLDER = 'data/sys-donaciones/fuentes'
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(TEMPLATES_FOLDER, exist_ok=True)
 
+# Memoria máxima (MB) para plantillas decodificadas en caché
+PLANTILLAS_CACHE_MB = int(os.getenv('PLANTILLAS_CACHE_MB', '256'))
+
+# Caché en disco de certificados ya generados
+CACHE_RENDER_FOLDER = os.path.join(UPLOAD_FOLDER, 'cache')
+CERTIFICADOS_CACHE_MB = int(os.getenv('CERTIFICADOS_CACHE_MB', '512'))
+# Segundos que el navegador puede reutilizar un certificado sin revalidar
+CERTIFICADOS_MAX_AGE = int(os.getenv('CERTIFICADOS_MAX_AGE', '3600'))
+os.makedirs(CACHE_RENDER_FOLDER, exist_ok=True)
+
+# Certificados emitidos: el PNG de cada certificados_generados, dibujado al comprar
+EMITIDOS_FOLDER = os.path.join(UPLOAD_FOLDER, 'emitidos')
+os.makedirs(EMITIDOS_FOLDER, exist_ok=True)
+
+# Con un proxy delante (Apache mod_xsendfile, lighttpd) el archivo lo envía
+# el proxy y la app sólo manda el header X-Sendfile
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '0') == '1'
+
+# ============================================
+# MÉTRICAS
+# ============================================
+# Histogramas de latencia y contadores en memoria, expuestos en /metrics
+# con el formato de texto de Prometheus. Registrar una medición es un
+# perf_counter, un bisect y una suma bajo un lock; el texto sólo se arma
+# cuando alguien lo pide.
+# Cada proceso lleva las suyas: los procesos del pool de render devuelven
+# sus mediciones junto con el resultado y se suman en el proceso web. Con
+# varios workers de gunicorn cada worker responde con las propias.
+
+BUCKETS_SEGUNDOS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# nombre -> (tipo, descripción)
+METRICAS = {
+    'donaciones_http_request_segundos': ('histogram', "Duración de los requests por endpoint"),
+    'donaciones_http_respuestas_total': ('counter', "Respuestas por endpoint y código"),
+    'donaciones_plantilla_carga_segundos': ('histogram', "Decodificar y compilar una plantilla"),
+    'donaciones_fuente_carga_segundos': ('histogram', "Cargar una fuente TrueType"),
+    'donaciones_dibujo_segundos': ('histogram', "Dibujar los campos variables de un certificado"),
+    'donaciones_codificacion_segundos': ('histogram', "Codificar un certificado, por formato"),
+    'donaciones_sql_segundos': ('histogram', "Grupos de sentencias SQL, por grupo"),
+    'donaciones_mailjet_envio_segundos': ('histogram', "Llamadas a la API de Mailjet"),
+    'donaciones_mailjet_mensajes_total': ('counter', "Mensajes enviados a Mailjet, por resultado"),
+    'donaciones_cache_total': ('counter', "Aciertos y fallos de cada caché"),
+    'donaciones_cola_render': ('gauge', "Donaciones esperando emisión en este proceso"),
+    'donaciones_cola_correos': ('gauge', "Correos en cola_correos, por estado"),
+    'donaciones_plantillas_cache_bytes': ('gauge', "Bytes de plantillas decodificadas en memoria"),
+    'donaciones_descargas_pendientes': ('gauge', "Certificados con descargas sin guardar en la BD"),
+    'donaciones_descargas_errores_total': ('counter', "Vaciados del contador de descargas que fallaron"),
+    'donaciones_conexiones_libres': ('gauge', "Conexiones a la BD libres en el pool"),
+}
+
+_histogramas = {}  # (nombre, etiquetas) -> [conteo por bucket..., conteo +Inf, suma]
+_contadores = {}   # (nombre, etiquetas) -> valor
+_metricas_lock = threading.Lock()
+
+
+def observar(nombre, segundos, **etiquetas):
+    """Agrega una medición al histograma"""
+    clave = (nombre, tuple(sorted(etiquetas.items())))
+    indice = bisect.bisect_left(BUCKETS_SEGUNDOS, segundos)
+    with _metricas_lock:
+        histograma = _histogramas.get(clave)
+        if histograma is None:
+            histograma = _histogramas[clave] = [0] * (len(BUCKETS_SEGUNDOS) + 1) + [0.0]
+        histograma[indice] += 1
+        histograma[-1] += segundos
+
+
+def contar(nombre, cantidad=1, **etiquetas):
+    clave = (nombre, tuple(sorted(etiquetas.items())))
+    with _metricas_lock:
+        _contadores[clave] = _contadores.get(clave, 0) + cantidad
+
+
+@contextmanager
+def medir(nombre, **etiquetas):
+    """Mide lo que tarda el bloque y lo agrega al histograma"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        observar(nombre, time.perf_counter() - inicio, **etiquetas)
+
+
+def tomar_metricas():
+    """Devuelve y vacía las métricas de este proceso (para mandarlas desde el pool)"""
+    global _histogramas, _contadores
+    with _metricas_lock:
+        metricas = (_histogramas, _contadores)
+        _histogramas, _contadores = {}, {}
+    return metricas
+
+
+def sumar_metricas(metricas):
+    """Suma las métricas que devolvió otro proceso"""
+    histogramas, contadores = metricas
+    with _metricas_lock:
+        for clave, valores in histogramas.items():
+            propio = _histogramas.setdefault(clave, [0] * len(valores[:-1]) + [0.0])
+            for i, valor in enumerate(valores):
+                propio[i] += valor
+        for clave, valor in contadores.items():
+            _contadores[clave] = _contadores.get(clave, 0) + valor
+
+
+def _etiquetas_prometheus(etiquetas):
+    if not etiquetas:
+        return ''
+    partes = []
+    for nombre, valor in etiquetas:
+        valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        partes.append(f'{nombre}="{valor}"')
+    return '{' + ','.join(partes) + '}'
+
+
+def exportar_metricas(medidores=None):
+    """Texto para Prometheus con todas las métricas; medidores: {(nombre, etiquetas): valor}"""
+    with _metricas_lock:
+        histogramas = {clave: list(valores) for clave, valores in _histogramas.items()}
+        contadores = dict(_contadores)
+    series = {**contadores, **(medidores or {})}
+
+    lineas = []
+    for nombre, (tipo, descripcion) in METRICAS.items():
+        lineas.append(f"# HELP {nombre} {descripcion}")
+        lineas.append(f"# TYPE {nombre} {tipo}")
+        if tipo == 'histogram':
+            for (serie, etiquetas), valores in sorted(histogramas.items()):
+                if serie != nombre:
+                    continue
+                acumulado = 0
+                for limite, conteo in zip(BUCKETS_SEGUNDOS + ('+Inf',), valores[:-1]):
+                    acumulado += conteo
+                    lineas.append(f"{nombre}_bucket{_etiquetas_prometheus(etiquetas + (('le', limite),))} {acumulado}")
+                lineas.append(f"{nombre}_sum{_etiquetas_prometheus(etiquetas)} {valores[-1]}")
+                lineas.append(f"{nombre}_count{_etiquetas_prometheus(etiquetas)} {acumulado}")
+        else:
+            for (serie, etiquetas), valor in sorted(series.items()):
+                if serie == nombre:
+                    lineas.append(f"{nombre}{_etiquetas_prometheus(etiquetas)} {valor}")
+    return '\n'.join(lineas) + '\n'
+
+
+@app.before_request
+def iniciar_medicion_request():
+    g.inicio_request = time.perf_counter()
+
+
+@app.after_request
+def registrar_medicion_request(respuesta):
+    """Duración y código de cada request, por endpoint (las rutas, no las URLs, para no multiplicar series)"""
+    inicio = g.pop('inicio_request', None)
+    if inicio is not None:
+        endpoint = request.endpoint or 'sin_ruta'
+        observar('donaciones_http_request_segundos', time.perf_counter() - inicio,
+                 endpoint=endpoint, metodo=request.method)
+        contar('donaciones_http_respuestas_total', endpoint=endpoint, codigo=respuesta.status_code)
+    return respuesta
+
+
+# ============================================
+# CONEXIONES A LA BD
+# ============================================
+# La BD usa WAL: los lectores no se bloquean mientras una compra escribe.
+# Cada conexión se abre con los PRAGMA de abajo y se reutiliza entre
+# requests (un pool pequeño), así no se pierden las sentencias preparadas
+# en caché ni la caché de páginas en cada request.
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '30000'))
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')  # NORMAL es seguro con WAL
+SQLITE_CACHE_MB = int(os.getenv('SQLITE_CACHE_MB', '16'))
+SQLITE_MMAP_MB = int(os.getenv('SQLITE_MMAP_MB', '256'))
+SQLITE_SENTENCIAS_CACHE = int(os.getenv('SQLITE_SENTENCIAS_CACHE', '256'))
+# Conexiones libres que se guardan para reutilizar
+SQLITE_POOL = int(os.getenv('SQLITE_POOL', '8'))
+
+_pool_conexiones = queue.LifoQueue()
+_pool_pid = os.getpid()
+
+
+def abrir_conexion():
+    """Abre una conexión nueva a la BD (para hilos y generadores fuera del request)"""
+    conn = sqlite3.connect(DATABASE, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                           check_same_thread=False, cached_statements=SQLITE_SENTENCIAS_CACHE)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = {-SQLITE_CACHE_MB * 1024}")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_MB * 1024 * 1024}")
+    return conn
+
+
+def tomar_conexion():
+    """Una conexión del pool, o una nueva si no hay libres"""
+    global _pool_conexiones, _pool_pid
+    if os.getpid() != _pool_pid:
+        # Después de un fork no se usan las conexiones del proceso padre
+        _pool_conexiones = queue.LifoQueue()
+        _pool_pid = os.getpid()
+    try:
+        return _pool_conexiones.get_nowait()
+    except queue.Empty:
+        return abrir_conexion()
+
+
+def devolver_conexion(conn):
+    """Regresa la conexión al pool (deshaciendo lo que no se confirmó) o la cierra"""
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        if os.getpid() == _pool_pid and _pool_conexiones.qsize() < SQLITE_POOL:
+            _pool_conexiones.put(conn)
+            return
+    except sqlite3.Error:
+        pass
+    conn.close()
+
+
+def cerrar_conexiones():
+    """Cierra las conexiones libres del pool"""
+    while True:
+        try:
+            _pool_conexiones.get_nowait().close()
+        except queue.Empty:
+            return
+
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
+        db = g._database = tomar_conexion()
     return db
 
 @app.teardown_appcontext
 def close_connection(exception):
     db = getattr(g, '_database', None)
     if db is not None:
-        db.close()
+        devolver_conexion(db)
+
+# Tablas que la aplicación agrega al esquema original de la BD
+ESQUEMA_APP = """
+CREATE TABLE IF NOT EXISTS cola_correos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email_destino TEXT NOT NULL,
+    nombre_destinatario TEXT,
+    folio TEXT NOT NULL,
+    donacion_id INTEGER,  -- Correo de compra: adjunta los certificados de la donación
+    detalle_id INTEGER,  -- Reenvío: adjunta sólo este certificado
+    formato_imagen TEXT,  -- png, jpeg, webp o pdf (NULL: CORREO_FORMATO_IMAGEN)
+    estado TEXT NOT NULL DEFAULT 'pendiente' CHECK(estado IN ('pendiente', 'enviando', 'enviado', 'fallido')),
+    intentos INTEGER NOT NULL DEFAULT 0,
+    proximo_intento REAL NOT NULL,  -- Epoch en segundos
+    ultimo_error TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    enviado_at DATETIME,
+    FOREIGN KEY (donacion_id) REFERENCES donaciones(id) ON DELETE CASCADE,
+    FOREIGN KEY (detalle_id) REFERENCES donacion_detalles(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_cola_correos_pendientes ON cola_correos(estado, proximo_intento);
+-- El worker de emisión libera el correo de la compra por donacion_id
+CREATE INDEX IF NOT EXISTS idx_cola_correos_donacion ON cola_correos(donacion_id);
+-- ultima_descarga la escribe el contador de descargas (en hora local); este
+-- trigger hacía un UPDATE extra por descarga y la sobreescribía en UTC
+DROP TRIGGER IF EXISTS update_descargas;
+-- Páginas de /api/mis-certificados: rango del índice en el orden de la respuesta, sin leer la tabla
+CREATE INDEX IF NOT EXISTS idx_donaciones_email_fecha ON donaciones(email, fecha DESC, id DESC, folio, total);
+
+-- Versión del catálogo: cualquier cambio en certificados la incrementa (firma de la copia en memoria)
+CREATE TABLE IF NOT EXISTS versiones_tablas (
+    tabla TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO versiones_tablas (tabla, version) VALUES ('certificados', 0);
+CREATE TRIGGER IF NOT EXISTS trg_version_certificados_insert
+AFTER INSERT ON certificados
+BEGIN
+    UPDATE versiones_tablas SET version = version + 1 WHERE tabla = 'certificados';
+END;
+CREATE TRIGGER IF NOT EXISTS trg_version_certificados_update
+AFTER UPDATE ON certificados
+BEGIN
+    UPDATE versiones_tablas SET version = version + 1 WHERE tabla = 'certificados';
+END;
+CREATE TRIGGER IF NOT EXISTS trg_version_certificados_delete
+AFTER DELETE ON certificados
+BEGIN
+    UPDATE versiones_tablas SET version = version + 1 WHERE tabla = 'certificados';
+END;
+"""
+
+# Estadísticas acumuladas: los triggers las actualizan en cada escritura,
+# así /api/estadisticas lee una fila por día en vez de recorrer todas las
+# donaciones. reconstruir_estadisticas() las recalcula desde cero.
+ESQUEMA_ESTADISTICAS = """
+CREATE TABLE IF NOT EXISTS estadisticas_diarias (
+    dia TEXT PRIMARY KEY,  -- YYYY-MM-DD, sólo donaciones completadas
+    donaciones INTEGER NOT NULL DEFAULT 0,
+    monto REAL NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS estadisticas_certificados (
+    nombre_certificado TEXT PRIMARY KEY,
+    total_vendidos INTEGER NOT NULL DEFAULT 0,
+    total_recaudado REAL NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS estadisticas_globales (
+    clave TEXT PRIMARY KEY,  -- 'certificados_generados' o 'descargas'
+    valor INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS estadisticas_donantes (
+    email TEXT PRIMARY KEY,  -- sólo donaciones completadas
+    nombre_titular TEXT,  -- el de su última donación
+    donaciones INTEGER NOT NULL DEFAULT 0,
+    monto REAL NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_estadisticas_donantes_monto ON estadisticas_donantes(monto DESC);
+
+-- Donaciones completadas por día
+CREATE TRIGGER IF NOT EXISTS trg_estadisticas_donacion_insert
+AFTER INSERT ON donaciones
+WHEN NEW.estado = 'completada'
+BEGIN
+    INSERT INTO estadisticas_diarias (dia, donaciones, monto) VALUES (DATE(NEW.fecha), 1, NEW.total)
+    ON CONFLICT(dia) DO UPDATE SET donaciones = donaciones + 1, monto = monto + excluded.monto;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_estadisticas_donacion_update
+AFTER UPDATE OF estado, total, fecha ON donaciones
+BEGIN
+    UPDATE estadisticas_diarias SET donaciones = donaciones - 1, monto = monto - OLD.total
+    WHERE dia = DATE(OLD.fecha) AND OLD.estado = 'completada';
+    INSERT INTO estadisticas_diarias (dia, donaciones, monto)
+    SELECT DATE(NEW.fecha), 1, NEW.total WHERE NEW.estado = 'completada'
+    ON CONFLICT(dia) DO UPDATE SET donaciones = donaciones + 1, monto = monto + excluded.monto;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_estadisticas_donacion_delete
+AFTER DELETE ON donaciones
+WHEN OLD.estado = 'completada'
+BEGIN
+    UPDATE estadisticas_diarias SET donaciones = donaciones - 1, monto = monto - OLD.total
+    WHERE dia = DATE(OLD.fecha);
+END;
+
+-- Vendidos y recaudado por certificado
+CREATE TRIGGER IF NOT EXISTS trg_estadisticas_detalle_insert
+AFTER INSERT ON donacion_detalles
+BEGIN
+    INSERT INTO estadisticas_certificados (nombre_certificado, total_vendidos, total_recaudado)
+    VALUES (NEW.nombre_certificado, NEW.cantidad, NEW.cantidad * NEW.precio_unitario)
+    ON CONFLICT(nombre_certificado) DO UPDATE SET
+        total_vendidos = total_vendidos + excluded.total_vendidos,
+        total_recaudado = total_recaudado + excluded.total_recaudado;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_estadisticas_detalle_update
+AFTER UPDATE OF nombre_certificado, cantidad, precio_unitario ON donacion_detalles
+BEGIN
+    UPDATE estadisticas_certificados SET
+        total_vendidos = total_vendidos - OLD.cantidad,
+        total_recaudado = total_recaudado - OLD.cantidad * OLD.precio_unitario
+    WHERE nombre_certificado = OLD.nombre_certificado;
+    INSERT INTO estadisticas_certificados (nombre_certificado, total_vendidos, total_recaudado)
+    VALUES (NEW.nombre_certificado, NEW.cantidad, NEW.cantidad * NEW.precio_unitario)
+    ON CONFLICT(nombre_certificado) DO UPDATE SET
+        total_vendidos = total_vendidos + excluded.total_vendidos,
+        total_recaudado = total_recaudado + excluded.total_recaudado;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_estadisticas_detalle_delete
+AFTER DELETE ON donacion_detalles
+BEGIN
+    UPDATE estadisticas_certificados SET
+        total_vendidos = total_vendidos - OLD.cantidad,
+        total_recaudado = total_recaudado - OLD.cantidad * OLD.precio_unitario
+    WHERE nombre_certificado = OLD.nombre_certificado;
+END;
+
+-- Certificados generados y descargas
+CREATE TRIGGER IF NOT EXISTS trg_estadisticas_generado_insert
+AFTER INSERT ON certificados_generados
+BEGIN
+    UPDATE estadisticas_globales SET valor = valor + 1 WHERE clave = 'certificados_generados';
+    UPDATE estadisticas_globales SET valor = valor + COALESCE(NEW.veces_descargado, 0) WHERE clave = 'descargas';
+END;
+CREATE TRIGGER IF NOT EXISTS trg_estadisticas_generado_update
+AFTER UPDATE OF veces_descargado ON certificados_generados
+BEGIN
+    UPDATE estadisticas_globales
+    SET valor = valor + COALESCE(NEW.veces_descargado, 0) - COALESCE(OLD.veces_descargado, 0)
+    WHERE clave = 'descargas';
+END;
+CREATE TRIGGER IF NOT EXISTS trg_estadisticas_generado_delete
+AFTER DELETE ON certificados_generados
+BEGIN
+    UPDATE estadisticas_globales SET valor = valor - 1 WHERE clave = 'certificados_generados';
+    UPDATE estadisticas_globales SET valor = valor - COALESCE(OLD.veces_descargado, 0) WHERE clave = 'descargas';
+END;
+
+-- Donaciones completadas por donante (v_top_donantes)
+CREATE TRIGGER IF NOT EXISTS trg_estadisticas_donante_insert
+AFTER INSERT ON donaciones
+WHEN NEW.estado = 'completada'
+BEGIN
+    INSERT INTO estadisticas_donantes (email, nombre_titular, donaciones, monto)
+    VALUES (NEW.email, NEW.nombre_titular, 1, NEW.total)
+    ON CONFLICT(email) DO UPDATE SET
+        nombre_titular = excluded.nombre_titular,
+        donaciones = donaciones + 1,
+        monto = monto + excluded.monto;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_estadisticas_donante_update
+AFTER UPDATE OF estado, total, email ON donaciones
+BEGIN
+    UPDATE estadisticas_donantes SET donaciones = donaciones - 1, monto = monto - OLD.total
+    WHERE email = OLD.email AND OLD.estado = 'completada';
+    INSERT INTO estadisticas_donantes (email, nombre_titular, donaciones, monto)
+    SELECT NEW.email, NEW.nombre_titular, 1, NEW.total WHERE NEW.estado = 'completada'
+    ON CONFLICT(email) DO UPDATE SET
+        nombre_titular = excluded.nombre_titular,
+        donaciones = donaciones + 1,
+        monto = monto + excluded.monto;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_estadisticas_donante_delete
+AFTER DELETE ON donaciones
+WHEN OLD.estado = 'completada'
+BEGIN
+    UPDATE estadisticas_donantes SET donaciones = donaciones - 1, monto = monto - OLD.total
+    WHERE email = OLD.email;
+END;
+
+-- Lo cubría antes v_top_donantes; ahora sale de estadisticas_donantes
+DROP INDEX IF EXISTS idx_donaciones_estado_email;
+"""
+
+# Vistas del esquema original reescritas para no recorrer toda la tabla.
+# Se reemplazan al iniciar si su definición en la BD es distinta.
+VISTAS_APP = {
+    'v_estadisticas_diarias': """CREATE VIEW v_estadisticas_diarias AS
+SELECT 
+    dia,
+    donaciones,
+    monto as monto_total,
+    monto / donaciones as ticket_promedio
+FROM estadisticas_diarias
+WHERE donaciones > 0""",
+    'v_top_donantes': """CREATE VIEW v_top_donantes AS
+SELECT 
+    email,
+    nombre_titular,
+    donaciones as num_donaciones,
+    monto as monto_total_donado
+FROM estadisticas_donantes
+WHERE donaciones > 0
+ORDER BY monto DESC""",
+}
+
+
+def reconstruir_estadisticas(conn):
+    """Recalcula las tablas de estadísticas desde las tablas de donaciones (en una transacción)"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM estadisticas_diarias")
+        conn.execute("""
+            INSERT INTO estadisticas_diarias (dia, donaciones, monto)
+            SELECT DATE(fecha), COUNT(*), COALESCE(SUM(total), 0)
+            FROM donaciones
+            WHERE estado = 'completada'
+            GROUP BY DATE(fecha)
+        """)
+        conn.execute("DELETE FROM estadisticas_certificados")
+        conn.execute("""
+            INSERT INTO estadisticas_certificados (nombre_certificado, total_vendidos, total_recaudado)
+            SELECT nombre_certificado, SUM(cantidad), SUM(cantidad * precio_unitario)
+            FROM donacion_detalles
+            GROUP BY nombre_certificado
+        """)
+        conn.execute("DELETE FROM estadisticas_globales")
+        conn.execute("""
+            INSERT INTO estadisticas_globales (clave, valor)
+            SELECT 'certificados_generados', COUNT(*) FROM certificados_generados
+            UNION ALL
+            SELECT 'descargas', COALESCE(SUM(veces_descargado), 0) FROM certificados_generados
+        """)
+        conn.execute("DELETE FROM estadisticas_donantes")
+        conn.execute("""
+            INSERT INTO estadisticas_donantes (email, nombre_titular, donaciones, monto)
+            SELECT email, nombre_titular, donaciones, monto FROM (
+                -- nombre_titular sale de la fila de MAX(id): la última donación
+                SELECT email, nombre_titular, COUNT(*) as donaciones, SUM(total) as monto, MAX(id)
+                FROM donaciones
+                WHERE estado = 'completada'
+                GROUP BY email
+            )
+        """)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+# Columnas agregadas después de crear la tabla: (tabla, columna, definición)
+COLUMNAS_APP = [
+    ('cola_correos', 'formato_imagen', 'TEXT'),
+    ('certificados_generados', 'archivo_path', 'TEXT'),
+    ('certificados_generados', 'archivo_hash', 'TEXT'),
+    ('certificados_generados', 'plantilla_version', 'TEXT'),
+    ('donaciones', 'emision_error', 'TEXT'),  # Error de la última emisión en segundo plano
+]
+
+def inicializar_esquema():
+    """Activa WAL y crea las tablas auxiliares de la aplicación si no existen"""
+    conn = sqlite3.connect(DATABASE, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    try:
+        # journal_mode queda guardado en el archivo de la BD
+        conn.execute("PRAGMA journal_mode = WAL")
+        nueva_estadistica = conn.execute("""
+            SELECT COUNT(*) FROM sqlite_master
+            WHERE type = 'table' AND name IN ('estadisticas_globales', 'estadisticas_donantes')
+        """).fetchone()[0] < 2
+        conn.executescript(ESQUEMA_APP + ESQUEMA_ESTADISTICAS)
+        for tabla, columna, definicion in COLUMNAS_APP:
+            existentes = {fila[1] for fila in conn.execute(f"PRAGMA table_info({tabla})")}
+            if columna not in existentes:
+                conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}")
+        for nombre, sql in VISTAS_APP.items():
+            actual = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = ?", (nombre,)).fetchone()
+            if not actual or actual[0] != sql:
+                conn.execute(f"DROP VIEW IF EXISTS {nombre}")
+                conn.execute(sql)
+        conn.commit()
+        if nueva_estadistica:
+            # Primera vez: se llenan con lo que ya hay en la BD
+            print("📊 Calculando estadísticas acumuladas...")
+            reconstruir_estadisticas(conn)
+    finally:
+        conn.close()
+
+inicializar_esquema()
 
 # ============================================
 # FUNCIÓN PARA ENVIAR CERTIFICADOS POR MAIL
 # ============================================
-def enviar_certificado_email(email_destino, nombre_beneficiario, folio, img_bytes):
+# Se usa un solo cliente de Mailjet por proceso (reutiliza la conexión
+# HTTPS) y se pueden mandar varios mensajes en una sola llamada a send.
+# MAILJET_API_URL permite apuntar a un servidor local de pruebas.
+
+MAILJET_API_URL = os.getenv('MAILJET_API_URL', 'https://api.mailjet.com/')
+# Máximo de mensajes por llamada a la API v3.1
+MAILJET_LOTE_MAX = int(os.getenv('MAILJET_LOTE_MAX', '50'))
+
+_mailjet_cliente = None
+_mailjet_lock = threading.Lock()
+
 
-    api_key = os.getenv("MAILJET_API_KEY")
-    api_secret = os.getenv("MAILJET_SECRET_KEY")
+def obtener_cliente_mailjet():
+    """Devuelve el cliente de Mailjet compartido, creándolo la primera vez"""
+    global _mailjet_cliente
+    if _mailjet_cliente is None:
+        with _mailjet_lock:
+            if _mailjet_cliente is None:
+                api_key = os.getenv("MAILJET_API_KEY")
+                api_secret = os.getenv("MAILJET_SECRET_KEY")
+                _mailjet_cliente = Client(auth=(api_key, api_secret), version='v3.1', api_url=MAILJET_API_URL)
+    return _mailjet_cliente
 
-    mailjet = Client(auth=(api_key, api_secret), version='v3.1')
 
-    encoded_image = base64.b64encode(img_bytes.getvalue()).decode('utf-8')
+def construir_mensaje_certificado(email_destino, nombre_beneficiario, folio, adjuntos):
+    """
+    Arma el mensaje de Mailjet con los certificados adjuntos.
+    adjuntos: lista de (nombre_archivo, bytes, content_type)
+    """
+    plural = len(adjuntos) > 1
 
-    data = {
-        'Messages': [
+    return {
+        "From": {
+            "Email": os.getenv("MAIL_DEFAULT_SENDER"),
+            "Name": "TecSalud"
+        },
+        "To": [
+            {
+                "Email": email_destino,
+                "Name": nombre_beneficiario
+            }
+        ],
+        "Subject": f"Tu{'s' if plural else ''} certificado{'s' if plural else ''} - {folio}",
+        "HTMLPart": f"""
+            <h3>Gracias por tu donación</h3>
+            <p>Hola {nombre_beneficiario}</p>
+            <p>Adjunto encontrarás {'tus certificados' if plural else 'tu certificado'}.</p>
+            <p><strong>Folio:</strong> {folio}</p>
+        """,
+        "Attachments": [
             {
-                "From": {
-                    "Email": os.getenv("MAIL_DEFAULT_SENDER"),
-                    "Name": "TecSalud"
-                },
-                "To": [
-                    {
-                        "Email": email_destino,
-                        "Name": nombre_beneficiario
-                    }
-                ],
-                "Subject": f"Tu certificado - {folio}",
-                "HTMLPart": f"""
-                    <h3>Gracias por tu donación</h3>
-                    <p>Hola {nombre_beneficiario}</p>
-                    <p>Adjunto encontrarás tu certificado.</p>
-                    <p><strong>Folio:</strong> {folio}</p>
-                """,
-                "Attachments": [
-                    {
-                        "ContentType": "image/png",
-                        "Filename": f"certificado_{folio}.png",
-                        "Base64Content": encoded_image
-                    }
-                ]
+                "ContentType": content_type,
+                "Filename": nombre_archivo,
+                "Base64Content": base64.b64encode(contenido).decode('utf-8')
             }
+            for nombre_archivo, contenido, content_type in adjuntos
         ]
     }
 
-    result = mailjet.send.create(data=data)
 
-    print(result.status_code)
-    print(result.json())
+def enviar_mensajes(mensajes):
+    """
+    Envía hasta MAILJET_LOTE_MAX mensajes en una sola llamada.
+    Devuelve una lista de (enviado, error) en el mismo orden que mensajes
+    """
+    inicio = time.perf_counter()
+    try:
+        result = obtener_cliente_mailjet().send.create(data={'Messages': mensajes})
+        status, cuerpo = result.status_code, result.text
+    except Exception as e:
+        # Algunas versiones del SDK lanzan excepción en los 4xx, con el cuerpo adjunto
+        cuerpo = getattr(e, 'response_body', None)
+        if not cuerpo:
+            raise
+        status = getattr(e, 'status_code', 0)
+    finally:
+        observar('donaciones_mailjet_envio_segundos', time.perf_counter() - inicio)
+
+    try:
+        respuesta = json.loads(cuerpo)
+    except ValueError:
+        respuesta = {}
+    print(f"📨 Mailjet: {len(mensajes)} mensaje(s), status {status}")
+
+    # Mailjet reporta el estado de cada mensaje, incluso si la llamada regresa 400
+    estados = respuesta.get('Messages') if isinstance(respuesta, dict) else None
+    if not estados or len(estados) != len(mensajes):
+        error = None if status == 200 else f"HTTP {status}: {cuerpo}"
+        resultados = [(status == 200, error)] * len(mensajes)
+    else:
+        resultados = []
+        for estado in estados:
+            if estado.get('Status') == 'success':
+                resultados.append((True, None))
+            else:
+                errores = estado.get('Errors') or []
+                resultados.append((False, '; '.join(e.get('ErrorMessage', str(e)) for e in errores) or str(estado)))
+
+    enviados = sum(1 for enviado, _ in resultados if enviado)
+    contar('donaciones_mailjet_mensajes_total', enviados, resultado='enviado')
+    contar('donaciones_mailjet_mensajes_total', len(resultados) - enviados, resultado='fallido')
+    return resultados
+
+
+def enviar_certificado_email(email_destino, nombre_beneficiario, folio, img_bytes):
+    """Envía un solo certificado por correo"""
+    mensaje = construir_mensaje_certificado(
+        email_destino, nombre_beneficiario, folio,
+        [(f"certificado_{folio}.png", img_bytes.getvalue(), 'image/png')]
+    )
+    enviado, error = enviar_mensajes([mensaje])[0]
+    if error:
+        print(f"❌ Error enviando a {email_destino}: {error}")
+    return enviado
+
+
+# ============================================
+# COLA PERSISTENTE DE CORREOS (OUTBOX)
+# ============================================
+# Los correos se guardan en cola_correos dentro de la misma transacción que
+# la compra y un grupo fijo de hilos los envía. Si falla se reintenta con
+# espera exponencial; después de CORREO_MAX_INTENTOS queda como 'fallido'.
+# Un correo tomado por un worker queda reservado CORREO_RESERVA_SEGUNDOS,
+# así que si el proceso se reinicia a media entrega se vuelve a intentar
+# (también cuenta como intento).
+# Cada worker junta hasta MAILJET_LOTE_MAX correos (esperando como mucho
+# CORREO_VENTANA_SEGUNDOS a que lleguen más) y los manda en una llamada.
+
+CORREO_WORKERS = int(os.getenv('CORREO_WORKERS', '2'))
+CORREO_MAX_INTENTOS = int(os.getenv('CORREO_MAX_INTENTOS', '5'))
+CORREO_BACKOFF_SEGUNDOS = float(os.getenv('CORREO_BACKOFF_SEGUNDOS', '30'))
+CORREO_RESERVA_SEGUNDOS = float(os.getenv('CORREO_RESERVA_SEGUNDOS', '300'))
+CORREO_POLL_SEGUNDOS = float(os.getenv('CORREO_POLL_SEGUNDOS', '5'))
+CORREO_VENTANA_SEGUNDOS = float(os.getenv('CORREO_VENTANA_SEGUNDOS', '0.5'))
+# Formato de los adjuntos cuando el correo no pide uno (JPEG pesa mucho menos que PNG)
+CORREO_FORMATO_IMAGEN = os.getenv('CORREO_FORMATO_IMAGEN', 'jpeg')
+
+_correos_evento = threading.Event()
+_correos_detener = threading.Event()
+_correos_workers = []
+_correos_lock = threading.Lock()
+
+
+def encolar_correo(cursor, email_destino, nombre_destinatario, folio, donacion_id=None, detalle_id=None,
+                   formato_imagen=None, proximo_intento=None):
+    """
+    Guarda un correo pendiente; se envía cuando la transacción haga commit
+    (o a partir de proximo_intento, en epoch)
+    """
+    cursor.execute("""
+        INSERT INTO cola_correos 
+        (email_destino, nombre_destinatario, folio, donacion_id, detalle_id, formato_imagen, proximo_intento)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (email_destino, nombre_destinatario, folio, donacion_id, detalle_id, formato_imagen,
+          proximo_intento or time.time()))
+    return cursor.lastrowid
+
+
+def liberar_correo_compra(conn, donacion_id):
+    """Deja listo para enviar el correo de compra que esperaba la emisión de la donación"""
+    ahora = time.time()
+    conn.execute("""
+        UPDATE cola_correos SET proximo_intento = ?
+        WHERE donacion_id = ? AND detalle_id IS NULL AND estado = 'pendiente' AND proximo_intento > ?
+    """, (ahora, donacion_id, ahora))
+
+
+def avisar_workers_correo():
+    """Despierta a los workers después del commit de un correo nuevo"""
+    _correos_evento.set()
+
+
+def _tomar_correos(conn, limite):
+    """Reserva hasta `limite` correos listos para enviar"""
+    ahora = time.time()
+    inicio = time.perf_counter()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Un correo cuyo envío tumba al worker o al proceso nunca llega a
+        # _reprogramar_correo: al agotar sus intentos se marca aquí como fallido
+        agotados = conn.execute("""
+            UPDATE cola_correos
+            SET estado = 'fallido',
+                ultimo_error = COALESCE(ultimo_error, 'El envío no terminó en ningún intento')
+            WHERE estado IN ('pendiente', 'enviando') AND proximo_intento <= ? AND intentos >= ?
+        """, (ahora, CORREO_MAX_INTENTOS)).rowcount
+        correos = conn.execute("""
+            SELECT * FROM cola_correos
+            WHERE estado IN ('pendiente', 'enviando') AND proximo_intento <= ?
+            ORDER BY proximo_intento
+            LIMIT ?
+        """, (ahora, limite)).fetchall()
+        conn.executemany("""
+            UPDATE cola_correos 
+            SET estado = 'enviando', intentos = intentos + 1, proximo_intento = ?
+            WHERE id = ?
+        """, [(ahora + CORREO_RESERVA_SEGUNDOS, correo['id']) for correo in correos])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    observar('donaciones_sql_segundos', time.perf_counter() - inicio, grupo='cola_correos')
+    if agotados:
+        print(f"❌ {agotados} correo(s) fallido(s) tras {CORREO_MAX_INTENTOS} intentos sin terminar el envío")
+    return correos
+
+
+def _reprogramar_correo(conn, correo, error):
+    """Programa el siguiente intento con espera exponencial, o lo marca como fallido"""
+    intentos = correo['intentos'] + 1
+    if intentos >= CORREO_MAX_INTENTOS:
+        print(f"❌ Correo {correo['id']} a {correo['email_destino']} fallido tras {intentos} intentos: {error}")
+        conn.execute("""
+            UPDATE cola_correos SET estado = 'fallido', ultimo_error = ? WHERE id = ?
+        """, (error, correo['id']))
+    else:
+        espera = CORREO_BACKOFF_SEGUNDOS * 2 ** (intentos - 1)
+        print(f"⚠️ Correo {correo['id']} falló (intento {intentos}), reintento en {espera:.0f}s: {error}")
+        conn.execute("""
+            UPDATE cola_correos SET estado = 'pendiente', proximo_intento = ?, ultimo_error = ? WHERE id = ?
+        """, (time.time() + espera, error, correo['id']))
+
+
+def _marcar_correo_enviado(conn, correo):
+    conn.execute("""
+        UPDATE cola_correos 
+        SET estado = 'enviado', ultimo_error = NULL, enviado_at = datetime('now', 'localtime')
+        WHERE id = ?
+    """, (correo['id'],))
+    if correo['detalle_id']:
+        # Un reenvío cuenta como descarga
+        conn.execute("""
+            UPDATE certificados_generados 
+            SET veces_descargado = veces_descargado + 1,
+                ultima_descarga = datetime('now', 'localtime')
+            WHERE donacion_detalle_id = ?
+        """, (correo['detalle_id'],))
+
+
+def _liberar_correos(conn, correos, error):
+    """Devuelve a 'pendiente' los correos reservados de un lote que no se pudo terminar"""
+    conn.executemany("""
+        UPDATE cola_correos SET estado = 'pendiente', proximo_intento = ?, ultimo_error = ?
+        WHERE id = ? AND estado = 'enviando'
+    """, [(time.time() + CORREO_POLL_SEGUNDOS, error, correo['id']) for correo in correos])
+    conn.commit()
+
+
+def _preparar_mensaje(conn, correo):
+    """Genera los certificados del correo y arma el mensaje de Mailjet"""
+    if correo['detalle_id']:
+        detalle_ids = [correo['detalle_id']]
+    else:
+        # Correo de compra: se adjuntan todos los certificados de la donación
+        detalle_ids = [fila['id'] for fila in conn.execute("""
+            SELECT id FROM donacion_detalles WHERE donacion_id = ? ORDER BY id
+        """, (correo['donacion_id'],))]
+
+    emisiones = [obtener_datos_certificado(conn, detalle_id) for detalle_id in detalle_ids]
+    lista_datos = [datos for _, datos in emisiones]
+    if not lista_datos or not all(lista_datos):
+        raise ValueError("Certificado no encontrado")
+
+    formato = correo['formato_imagen'] or CORREO_FORMATO_IMAGEN
+    mimetype = FORMATOS_IMAGEN[formato]['mimetype']
+
+    emitidos = all(fila['cert_gen_id'] for fila, _ in emisiones)
+    if formato == 'pdf' and len(lista_datos) > 1:
+        # Varios certificados en PDF van como un solo adjunto de varias páginas
+        if emitidos:
+            pdf_bytes = pdf_de_archivos(emitir_certificados(conn, emisiones))
+        else:
+            pdf_bytes = generar_pdf_certificados(lista_datos)
+        adjuntos = [(f"certificados_{correo['folio']}.pdf", pdf_bytes, mimetype)]
+    else:
+        if formato == 'png' and emitidos:
+            # Los PNG ya emitidos se adjuntan tal cual
+            rutas = emitir_certificados(conn, emisiones)
+        else:
+            rutas = renderizar_certificados(lista_datos, formato)
+        if not all(rutas):
+            raise RuntimeError("Error al generar certificado")
+
+        extension = FORMATOS_IMAGEN[formato]['extension']
+        adjuntos = [
+            (f"certificado_{datos_certificado['folio']}.{extension}", leer_archivo(ruta), mimetype)
+            for datos_certificado, ruta in zip(lista_datos, rutas)
+        ]
+
+    return construir_mensaje_certificado(
+        email_destino=correo['email_destino'],
+        nombre_beneficiario=correo['nombre_destinatario'],
+        folio=correo['folio'],
+        adjuntos=adjuntos
+    )
+
+
+def _enviar_lote_correos(conn, correos, conn_emision):
+    """
+    Envía un lote de correos en una llamada y actualiza el estado de cada uno.
+    Los adjuntos se preparan con conn_emision (la emisión hace sus propios
+    commits); el estado de todo el lote se guarda al final en un solo commit de conn
+    """
+    listos = []
+    mensajes = []
+    fallidos = []
+    for correo in correos:
+        try:
+            mensajes.append(_preparar_mensaje(conn_emision, correo))
+            listos.append(correo)
+        except Exception as e:
+            conn_emision.rollback()
+            fallidos.append((correo, str(e)))
+
+    resultados = []
+    if mensajes:
+        print(f"📧 Enviando {len(mensajes)} correo(s): {', '.join(c['email_destino'] for c in listos)}")
+        try:
+            resultados = enviar_mensajes(mensajes)
+        except Exception as e:
+            resultados = [(False, str(e))] * len(mensajes)
+
+    for correo, error in fallidos:
+        _reprogramar_correo(conn, correo, error)
+    for correo, (enviado, error) in zip(listos, resultados):
+        if enviado:
+            _marcar_correo_enviado(conn, correo)
+        else:
+            _reprogramar_correo(conn, correo, error)
+    conn.commit()
+
+
+def _worker_correos():
+    """Ciclo de un worker: junta lotes de la cola y los envía"""
+    conn = abrir_conexion()
+    conn_emision = abrir_conexion()
+    while not _correos_detener.is_set():
+        try:
+            correos = _tomar_correos(conn, MAILJET_LOTE_MAX)
+            if correos and len(correos) < MAILJET_LOTE_MAX and CORREO_VENTANA_SEGUNDOS > 0:
+                # Dar un momento para que se junten más correos en el mismo lote
+                time.sleep(CORREO_VENTANA_SEGUNDOS)
+                correos += _tomar_correos(conn, MAILJET_LOTE_MAX - len(correos))
+        except sqlite3.Error as e:
+            print(f"❌ Error leyendo la cola de correos: {e}")
+            correos = []
+
+        if not correos:
+            _correos_evento.wait(CORREO_POLL_SEGUNDOS)
+            _correos_evento.clear()
+            continue
+
+        try:
+            _enviar_lote_correos(conn, correos, conn_emision)
+        except Exception as e:
+            # Un error de la BD (p. ej. bloqueada en un pico) no debe matar al worker
+            conn.rollback()
+            conn_emision.rollback()
+            print(f"❌ Error enviando un lote de {len(correos)} correo(s): {e}")
+            try:
+                _liberar_correos(conn, correos, str(e))
+            except sqlite3.Error as e:
+                # Si tampoco se puede, se vuelven a tomar al vencer la reserva
+                conn.rollback()
+                print(f"❌ No se pudieron liberar los correos del lote: {e}")
+    conn.close()
+    conn_emision.close()
+
+
+@app.before_request
+def iniciar_workers_correo():
+    """Arranca los workers de correo en el primer request de cada proceso"""
+    if _correos_workers:
+        return
+    with _correos_lock:
+        if _correos_workers:
+            return
+        for i in range(CORREO_WORKERS):
+            worker = threading.Thread(target=_worker_correos, name=f"correos-{i}", daemon=True)
+            worker.start()
+            _correos_workers.append(worker)
+
+
+# ============================================
+# CONTADOR DE DESCARGAS
+# ============================================
+# Ver o descargar un certificado no escribe en la BD: la descarga se suma
+# en memoria y un hilo guarda todas las acumuladas en una sola transacción
+# cada DESCARGAS_INTERVALO_SEGUNDOS. Al terminar el proceso se guardan las
+# que falten (DESCARGAS_VACIAR_AL_SALIR).
+
+DESCARGAS_INTERVALO_SEGUNDOS = float(os.getenv('DESCARGAS_INTERVALO_SEGUNDOS', '5'))
+DESCARGAS_VACIAR_AL_SALIR = os.getenv('DESCARGAS_VACIAR_AL_SALIR', '1') == '1'
+
+_descargas_pendientes = {}  # cert_gen_id -> [descargas, última descarga]
+_descargas_lock = threading.Lock()
+_descargas_hilo = None
+
+
+def registrar_descarga(cert_gen_id):
+    """Suma una descarga en memoria; se guarda en la BD en el siguiente vaciado"""
+    ahora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with _descargas_lock:
+        pendiente = _descargas_pendientes.get(cert_gen_id)
+        if pendiente:
+            pendiente[0] += 1
+            pendiente[1] = ahora
+        else:
+            _descargas_pendientes[cert_gen_id] = [1, ahora]
+
+
+def vaciar_descargas():
+    """Guarda en una transacción las descargas acumuladas; devuelve cuántos certificados actualizó"""
+    global _descargas_pendientes
+    with _descargas_lock:
+        pendientes, _descargas_pendientes = _descargas_pendientes, {}
+    if not pendientes:
+        return 0
+
+    conn = tomar_conexion()
+    try:
+        with medir('donaciones_sql_segundos', grupo='descargas'):
+            conn.executemany("""
+                UPDATE certificados_generados 
+                SET veces_descargado = veces_descargado + ?,
+                    ultima_descarga = MAX(COALESCE(ultima_descarga, ''), ?)
+                WHERE id = ?
+            """, [(veces, ultima, cert_gen_id) for cert_gen_id, (veces, ultima) in pendientes.items()])
+            conn.commit()
+    except Exception as e:
+        # Se regresan para el siguiente intento
+        print(f"⚠️ No se pudieron guardar {len(pendientes)} contadores de descarga: {e}")
+        with _descargas_lock:
+            for cert_gen_id, (veces, ultima) in pendientes.items():
+                pendiente = _descargas_pendientes.setdefault(cert_gen_id, [0, ultima])
+                pendiente[0] += veces
+                pendiente[1] = max(pendiente[1], ultima)
+        raise
+    finally:
+        devolver_conexion(conn)
+    return len(pendientes)
+
+
+def _hilo_contador_descargas():
+    while True:
+        time.sleep(DESCARGAS_INTERVALO_SEGUNDOS)
+        try:
+            vaciar_descargas()
+        except Exception as e:
+            # Las descargas ya regresaron a _descargas_pendientes; se reintenta en el siguiente ciclo
+            print(f"❌ Error guardando el contador de descargas: {e}")
+            contar('donaciones_descargas_errores_total')
+
+
+def _vaciar_descargas_al_salir():
+    try:
+        guardados = vaciar_descargas()
+        if guardados:
+            print(f"💾 Contadores de descarga guardados al salir: {guardados}")
+    except Exception:
+        pass
+
+
+if DESCARGAS_VACIAR_AL_SALIR:
+    atexit.register(_vaciar_descargas_al_salir)
+
+
+@app.before_request
+def iniciar_contador_descargas():
+    """Arranca el hilo que guarda las descargas en el primer request de cada proceso"""
+    global _descargas_hilo
+    if _descargas_hilo:
+        return
+    with _descargas_lock:
+        if not _descargas_hilo:
+            _descargas_hilo = threading.Thread(target=_hilo_contador_descargas, name="descargas", daemon=True)
+            _descargas_hilo.start()
+
+
+# ============================================
+# REGISTRO DE FUENTES
+# ============================================
+# Cada fuente se carga una sola vez por proceso para cada (archivo, tamaño).
+# Los objetos FreeTypeFont no se modifican después de cargarse y Pillow
+# dibuja con el GIL tomado, así que se comparten entre los hilos de Flask.
+
+FUENTES_CERTIFICADO = {
+    'titulo': ('PlayfairDisplay.ttf', 60),
+    'nombre': ('DancingScript.ttf', 60),
+    'texto': ('PlayfairDisplay.ttf', 30),
+    'mensaje': ('Abel-Regular.ttf', 35),
+    'folio': ('PlayfairDisplay.ttf', 30),
+}
+
+_fuentes = {}
+_fuentes_lock = threading.Lock()
+
+
+def obtener_fuente(archivo, tamano):
+    """Devuelve la fuente ya cargada; si falla se usa la default una sola vez"""
+    clave = (archivo, tamano)
+    fuente = _fuentes.get(clave)
+    if fuente is None:
+        with _fuentes_lock:
+            fuente = _fuentes.get(clave)
+            if fuente is None:
+                ruta = os.path.join(FUENTES_FOLDER, archivo)
+                try:
+                    with medir('donaciones_fuente_carga_segundos'):
+                        fuente = ImageFont.truetype(ruta, tamano)
+                except OSError as e:
+                    print(f"⚠️ No se pudo cargar la fuente {ruta} ({tamano}px): {e}")
+                    fuente = ImageFont.load_default()
+                _fuentes[clave] = fuente
+    return fuente
+
+
+def cargar_fuentes(escala=1):
+    """
+    Carga las fuentes del certificado por rol (al inicio, para reportar errores de una vez).
+    Con escala < 1 devuelve las mismas fuentes en tamaño reducido para las miniaturas
+    """
+    return {
+        rol: obtener_fuente(archivo, max(1, round(tamano * escala)))
+        for rol, (archivo, tamano) in FUENTES_CERTIFICADO.items()
+    }
+
+
+cargar_fuentes()
+
+
+# ============================================
+# LAYOUT DE LOS CERTIFICADOS
+# ============================================
+# Cada plantilla tiene un layout declarativo. 'estatico' son los textos
+# fijos: se dibujan una sola vez sobre la plantilla en caché. 'campos' se
+# dibujan en cada certificado; su 'texto' se llena con datos_certificado
+# usando str.format.
+#   x: píxeles desde la izquierda, 'centro' o ('derecha', margen)
+#   si: nombre de una condición de CONDICIONES_LAYOUT para dibujarlo
+#   ancho_max / interlineado: parte el texto en líneas por ancho en píxeles
+#   borde: (grosor, color) del contorno del texto
+
+LAYOUT_CERTIFICADO = {
+    'estatico': [
+        {'texto': "CERTIFICADO DE DONACIÓN", 'fuente': 'titulo', 'x': 'centro', 'y': 150, 'color': '#2c3e50'},
+        {'texto': "Otorgado a:", 'fuente': 'texto', 'x': 150, 'y': 300, 'color': '#34495e'},
+    ],
+    'campos': [
+        {'texto': "{folio}", 'si': 'folio', 'fuente': 'folio', 'x': ('derecha', 50), 'y': 100,
+         'color': '#38AB82', 'borde': (1, '#545454')},
+        {'texto': "{nombre_titular}", 'fuente': 'nombre', 'x': 150, 'y': 345, 'color': '#328531'},
+        {'texto': "A nombre de:", 'si': 'beneficiario_distinto', 'fuente': 'texto', 'x': 150, 'y': 430, 'color': '#204956'},
+        {'texto': "{nombre_beneficiario}", 'si': 'beneficiario_distinto', 'fuente': 'nombre', 'x': 150, 'y': 475, 'color': '#2980b9'},
+        {'texto': "Certificado: {certificado_nombre}", 'fuente': 'texto', 'x': 150, 'y': 570, 'color': '#34495e'},
+        {'texto': "Cantidad: {cantidad} | Monto: ${monto:,.2f} MXN", 'fuente': 'texto', 'x': 150, 'y': 630, 'color': '#34495e'},
+        {'texto': "{mensaje}", 'si': 'mensaje', 'fuente': 'mensaje', 'x': 150, 'y': 720, 'color': '#054570',
+         'ancho_max': 700, 'interlineado': 50},
+        {'texto': "Fecha: {fecha}", 'fuente': 'texto', 'x': 150, 'y': 950, 'color': '#34495e'},
+    ],
+}
+
+# Layouts propios de alguna plantilla (por nombre de archivo); las demás usan LAYOUT_CERTIFICADO
+LAYOUTS_PLANTILLA = {}
+
+CONDICIONES_LAYOUT = {
+    'folio': lambda datos: bool(datos.get('folio')),
+    'beneficiario_distinto': lambda datos: bool(datos.get('nombre_beneficiario'))
+        and datos['nombre_beneficiario'] != datos['nombre_titular'],
+    'mensaje': lambda datos: bool(datos.get('mensaje')),
+}
+
+# Cambia si se edita cualquier layout, para invalidar los certificados en caché
+HUELLA_LAYOUT = hashlib.sha1(
+    json.dumps([LAYOUT_CERTIFICADO, LAYOUTS_PLANTILLA], sort_keys=True).encode('utf-8')
+).hexdigest()[:12]
+
+
+def _posicion_x(x, texto, fuente, ancho_imagen):
+    """Convierte la x del layout ('centro', ('derecha', margen) o píxeles) a píxeles"""
+    if x == 'centro' or isinstance(x, (tuple, list)):
+        bbox = fuente.getbbox(texto)
+        ancho_texto = bbox[2] - bbox[0]
+        if x == 'centro':
+            return (ancho_imagen - ancho_texto) // 2
+        return ancho_imagen - ancho_texto - x[1]
+    return x
+
+
+def _dibujar_texto(draw, elemento, texto, fuente, ancho_imagen, y):
+    x = _posicion_x(elemento['x'], texto, fuente, ancho_imagen)
+    borde = elemento.get('borde')
+    if borde:
+        draw.text((x, y), texto, fill=elemento['color'], font=fuente, stroke_width=borde[0], stroke_fill=borde[1])
+    else:
+        draw.text((x, y), texto, fill=elemento['color'], font=fuente)
+
+
+def ajustar_texto(texto, fuente, ancho_max):
+    """Parte el texto en líneas que no pasen de ancho_max píxeles"""
+    lineas = []
+    actual = ''
+    for palabra in texto.split():
+        propuesta = f"{actual} {palabra}" if actual else palabra
+        if fuente.getlength(propuesta) <= ancho_max:
+            actual = propuesta
+            continue
+        if actual:
+            lineas.append(actual)
+        # Una palabra más ancha que la línea se parte por caracteres
+        while fuente.getlength(palabra) > ancho_max and len(palabra) > 1:
+            corte = len(palabra) - 1
+            while corte > 1 and fuente.getlength(palabra[:corte]) > ancho_max:
+                corte -= 1
+            lineas.append(palabra[:corte])
+            palabra = palabra[corte:]
+        actual = palabra
+    if actual:
+        lineas.append(actual)
+    return lineas
+
+
+def escalar_layout(layout, escala):
+    """Copia del layout con posiciones, anchos y bordes multiplicados por escala"""
+    def escalar(elemento):
+        elemento = dict(elemento, y=round(elemento['y'] * escala))
+        x = elemento['x']
+        if isinstance(x, (tuple, list)):
+            elemento['x'] = (x[0], round(x[1] * escala))
+        elif x != 'centro':
+            elemento['x'] = round(x * escala)
+        for clave in ('ancho_max', 'interlineado'):
+            if clave in elemento:
+                elemento[clave] = round(elemento[clave] * escala)
+        if 'borde' in elemento:
+            elemento['borde'] = (round(elemento['borde'][0] * escala), elemento['borde'][1])
+        return elemento
+
+    return {
+        'estatico': [escalar(elemento) for elemento in layout['estatico']],
+        'campos': [escalar(campo) for campo in layout['campos']],
+    }
+
+
+def compilar_layout(layout, imagen, escala=1):
+    """
+    Dibuja la capa estática del layout sobre la imagen y devuelve los campos
+    variables con sus fuentes ya resueltas
+    """
+    if escala != 1:
+        layout = escalar_layout(layout, escala)
+    fuentes = cargar_fuentes(escala)
+    draw = ImageDraw.Draw(imagen)
+    for elemento in layout['estatico']:
+        _dibujar_texto(draw, elemento, elemento['texto'], fuentes[elemento['fuente']], imagen.width, elemento['y'])
+
+    return [dict(campo, fuente=fuentes[campo['fuente']]) for campo in layout['campos']]
+
+
+def dibujar_campos(imagen, campos, datos_certificado):
+    """Dibuja los campos variables del certificado sobre una copia de la plantilla"""
+    valores = dict(datos_certificado)
+    valores.setdefault('fecha', datetime.now().strftime("%d de %B, %Y"))
+
+    draw = ImageDraw.Draw(imagen)
+    for campo in campos:
+        if campo.get('si') and not CONDICIONES_LAYOUT[campo['si']](valores):
+            continue
+        texto = campo['texto'].format(**valores)
+        if campo.get('ancho_max'):
+            lineas = ajustar_texto(texto, campo['fuente'], campo['ancho_max'])
+        else:
+            lineas = [texto]
+
+        y = campo['y']
+        for linea in lineas:
+            _dibujar_texto(draw, campo, linea, campo['fuente'], imagen.width, y)
+            y += campo.get('interlineado', 0)
+
+
+# ============================================
+# CACHÉ DE PLANTILLAS COMPILADAS
+# ============================================
+# Decodificar el JPEG de la plantilla es lo más caro de cada certificado,
+# así que se guarda por ruta la imagen ya decodificada, con la capa
+# estática del layout dibujada (y cada tamaño de miniatura por separado),
+# y se invalida si cambia el mtime del archivo. Se expulsa la menos usada (LRU) cuando se supera
+# PLANTILLAS_CACHE_MB.
+
+_plantillas_cache = OrderedDict()
+_plantillas_cache_bytes = 0
+_plantillas_lock = threading.Lock()
+
+
+def resolver_plantilla(nombre):
+    """
+    Devuelve (ruta, stat) de la plantilla pedida o de la default si no existe.
+    Si no hay ninguna plantilla en disco devuelve (None, None)
+    """
+    for candidato in (nombre, 'plantilla_default.jpg'):
+        ruta = os.path.join(TEMPLATES_FOLDER, candidato)
+        try:
+            return ruta, os.stat(ruta)
+        except OSError:
+            continue
+    return None, None
+
+
+def _abrir_imagen_plantilla(ruta, ancho=None):
+    """
+    Abre la plantilla decodificada. Con ancho la devuelve reducida a ese ancho;
+    en JPEG se decodifica directamente a 1/2, 1/4 u 1/8 con draft(), así que
+    el costo depende del tamaño de la miniatura y no del de la plantilla.
+    Devuelve (imagen, escala respecto a la plantilla original)
+    """
+    if ruta is None:
+        # Si no hay plantilla, crear imagen blanca
+        img = Image.new('RGB', (1200, 1600), color='white')
+        draw = ImageDraw.Draw(img)
+        # Marco
+        draw.rectangle([(50, 50), (1150, 1550)], outline='#2c3e50', width=5)
+    else:
+        img = Image.open(ruta)
+
+    if not ancho or ancho >= img.width:
+        img.load()
+        return img, 1
+
+    escala = ancho / img.width
+    tamano = (ancho, max(1, round(img.height * escala)))
+    if ruta is not None:
+        img.draft(img.mode, tamano)
+    return img.resize(tamano, Image.LANCZOS), escala
 
-    return result.status_code == 200
+
+def obtener_plantilla(nombre, ancho=None):
+    """
+    Devuelve la plantilla compilada: {'base': imagen con la capa estática, 'campos': [...]}.
+    Con ancho devuelve una versión reducida (para miniaturas), con fuentes y
+    posiciones escaladas. La imagen base es compartida; hay que copiarla antes de dibujar
+    """
+    global _plantillas_cache_bytes
+
+    ruta, st = resolver_plantilla(nombre)
+    mtime = st.st_mtime_ns if st else None
+    clave = (ruta, ancho)
+
+    with _plantillas_lock:
+        entrada = _plantillas_cache.get(clave)
+        if entrada and entrada['mtime'] == mtime:
+            _plantillas_cache.move_to_end(clave)
+            contar('donaciones_cache_total', cache='plantillas', resultado='acierto')
+            return entrada
+
+    contar('donaciones_cache_total', cache='plantillas', resultado='fallo')
+    with medir('donaciones_plantilla_carga_segundos', tamano='miniatura' if ancho else 'completo'):
+        base, escala = _abrir_imagen_plantilla(ruta, ancho)
+        layout = LAYOUTS_PLANTILLA.get(os.path.basename(ruta or ''), LAYOUT_CERTIFICADO)
+        campos = compilar_layout(layout, base, escala)
+    entrada = {
+        'base': base,
+        'campos': campos,
+        'mtime': mtime,
+        'bytes': base.width * base.height * len(base.getbands()),
+    }
+    limite = PLANTILLAS_CACHE_MB * 1024 * 1024
+
+    with _plantillas_lock:
+        anterior = _plantillas_cache.pop(clave, None)
+        if anterior:
+            _plantillas_cache_bytes -= anterior['bytes']
+        if entrada['bytes'] <= limite:
+            _plantillas_cache[clave] = entrada
+            _plantillas_cache_bytes += entrada['bytes']
+            while _plantillas_cache_bytes > limite:
+                _, expulsada = _plantillas_cache.popitem(last=False)
+                _plantillas_cache_bytes -= expulsada['bytes']
+
+    return entrada
 
 
 # ============================================
 # FUNCIÓN GENERADORA DE CERTIFICADOS 
 # ============================================
 
-def generar_imagen_certificado(datos_certificado, output_path=None):
+def dibujar_certificado(datos_certificado, ancho=None):
+    """Dibuja el certificado (o su miniatura de `ancho` píxeles) y devuelve la imagen de Pillow"""
+    # Plantilla con la capa estática ya dibujada (o default si no existe)
+    plantilla = obtener_plantilla(datos_certificado.get('plantilla', 'plantilla_default.jpg'), ancho)
+    img = plantilla['base'].copy()
+    
+    # Sólo se dibujan los campos que cambian en cada certificado
+    with medir('donaciones_dibujo_segundos', tamano='miniatura' if ancho else 'completo'):
+        dibujar_campos(img, plantilla['campos'], datos_certificado)
+    return img
+
+
+def generar_imagen_certificado(datos_certificado, output_path=None, formato='png', ancho=None):
     """
     Genera un certificado y retorna los bytes de la imagen o la guarda en output_path
+    formato: 'png', 'jpeg', 'webp' o 'pdf' (ver FORMATOS_IMAGEN)
+    ancho: si se indica, genera una miniatura de ese ancho
     datos_certificado: {
         'nombre_titular': 'Juan Pérez',
         'nombre_beneficiario': 'María García',
@@ -118,97 +1397,15 @@ def generar_imagen_certificado(datos_certificado, output_path=None):
     }
     """
     try:
-        # Determinar qué plantilla usar
-        plantilla = datos_certificado.get('plantilla', 'plantilla_default.jpg')
-        plantilla_path = os.path.join(TEMPLATES_FOLDER, plantilla)
-        
-        # Si no existe la plantilla específica, usar default
-        if not os.path.exists(plantilla_path):
-            plantilla_path = os.path.join(TEMPLATES_FOLDER, 'plantilla_default.jpg')
-            if not os.path.exists(plantilla_path):
-                # Si no hay plantilla, crear imagen blanca
-                img = Image.new('RGB', (1200, 1600), color='white')
-                draw = ImageDraw.Draw(img)
-                # Marco
-                draw.rectangle([(50, 50), (1150, 1550)], outline='#2c3e50', width=5)
-            else:
-                img = Image.open(plantilla_path)
-                draw = ImageDraw.Draw(img)
-        else:
-            img = Image.open(plantilla_path)
-            draw = ImageDraw.Draw(img)
-        
-        # Cargar fuentes
-        try:
-            font_titulo = ImageFont.truetype("data/sys-donaciones/fuentes/PlayfairDisplay.ttf", 60)
-            font_nombre = ImageFont.truetype("data/sys-donaciones/fuentes/DancingScript.ttf", 60)
-            font_texto = ImageFont.truetype("data/sys-donaciones/fuentes/PlayfairDisplay.ttf", 30)
-            font_mensaje = ImageFont.truetype("data/sys-donaciones/fuentes/Abel-Regular.ttf", 35)
-            font_folio = ImageFont.truetype("data/sys-donaciones/fuentes/PlayfairDisplay.ttf", 30)
-        except:
-            font_titulo = ImageFont.load_default()
-            font_nombre = ImageFont.load_default()
-            font_texto = ImageFont.load_default()
-            font_mensaje = ImageFont.load_default()
-            font_folio = ImageFont.load_default()
-        
-        # Título
-        titulo = "CERTIFICADO DE DONACIÓN"
-        bbox = draw.textbbox((0, 0), titulo, font=font_titulo)
-        titulo_ancho = bbox[2] - bbox[0]
-        titulo_x = (img.width - titulo_ancho) // 2
-        draw.text((titulo_x, 150), titulo, fill='#2c3e50', font=font_titulo)
-        
-        # Folio
-        folio = datos_certificado.get('folio', '')
-        if folio:
-            bbox_folio = draw.textbbox((0, 0), folio, font=font_folio)
-            folio_ancho = bbox_folio[2] - bbox_folio[0]
-            draw.text((img.width - folio_ancho - 50, 100), folio, stroke_width=1, stroke_fill='#545454', fill='#38AB82', font=font_folio)
-        
-        # Otorgado a
-        draw.text((150, 300), "Otorgado a:", fill='#34495e', font=font_texto)
-        draw.text((150, 345), datos_certificado['nombre_titular'], fill='#328531', font=font_nombre)
-        
-        # A nombre de
-        if datos_certificado.get('nombre_beneficiario') and datos_certificado['nombre_beneficiario'] != datos_certificado['nombre_titular']:
-            draw.text((150, 430), "A nombre de:", fill='#204956', font=font_texto)
-            draw.text((150, 475), datos_certificado['nombre_beneficiario'], fill='#2980b9', font=font_nombre)
-        
-        # Tipo de certificado
-        draw.text((150, 570), f"Certificado: {datos_certificado['certificado_nombre']}", 
-                 fill='#34495e', font=font_texto)
-        
-        # Cantidad y monto
-        draw.text((150, 630), f"Cantidad: {datos_certificado['cantidad']} | Monto: ${datos_certificado['monto']:,.2f} MXN", 
-                 fill='#34495e', font=font_texto)
-        
-        # Mensaje personalizado
-        if datos_certificado.get('mensaje'):
-            mensaje = datos_certificado['mensaje']
-            wrapper = textwrap.TextWrapper(width=50)
-            lines = wrapper.wrap(text=mensaje)
-            
-            y_position = 720
-            for line in lines:
-                draw.text((150, y_position), line, fill='#054570', font=font_mensaje)
-                y_position += 50
-        
-        # Fecha
-        fecha = datos_certificado.get('fecha', datetime.now().strftime("%d de %B, %Y"))
-        draw.text((150, 950), f"Fecha: {fecha}", fill='#34495e', font=font_texto)
-        
-        # Firma
-        #draw.line([(150, 1300), (500, 1300)], fill='black', width=2)
-        #draw.text((150, 1320), "Firma TecSalud", fill='#2c3e50', font=font_texto)
+        img = dibujar_certificado(datos_certificado, ancho)
         
         # Guardar o retornar bytes
         if output_path:
-            img.save(output_path, 'PNG', quality=95)
+            codificar_imagen(img, formato, output_path)
             return output_path
         else:
             img_bytes = io.BytesIO()
-            img.save(img_bytes, format='PNG')
+            codificar_imagen(img, formato, img_bytes)
             img_bytes.seek(0)
             return img_bytes
         
@@ -216,6 +1413,875 @@ def generar_imagen_certificado(datos_certificado, output_path=None):
         print(f"Error generando certificado: {e}")
         return None
 
+# ============================================
+# FORMATOS DE SALIDA
+# ============================================
+# PNG es sin pérdida y pesa varios MB con las plantillas fotográficas.
+# JPEG y WebP pesan una fracción, y PDF (con las páginas en JPEG) sirve
+# para juntar varios certificados en un solo archivo.
+
+FORMATOS_IMAGEN = {
+    'png': {'mimetype': 'image/png', 'extension': 'png'},
+    'jpeg': {'mimetype': 'image/jpeg', 'extension': 'jpg'},
+    'webp': {'mimetype': 'image/webp', 'extension': 'webp'},
+    'pdf': {'mimetype': 'application/pdf', 'extension': 'pdf'},
+}
+
+# Cuando el cliente acepta varios, se elige el primero de esta lista (el más chico)
+PREFERENCIA_FORMATOS = ['webp', 'jpeg', 'png']
+
+JPEG_CALIDAD = int(os.getenv('JPEG_CALIDAD', '85'))
+WEBP_CALIDAD = int(os.getenv('WEBP_CALIDAD', '80'))
+# Resolución con la que se declara la página del PDF
+PDF_DPI = int(os.getenv('PDF_DPI', '150'))
+
+
+def codificar_imagen(imagenes, formato, destino):
+    """
+    Escribe la imagen en el formato pedido en destino (ruta o archivo).
+    Para 'pdf' se puede pasar una lista de imágenes: una página por imagen
+    """
+    with medir('donaciones_codificacion_segundos', formato=formato):
+        _codificar_imagen(imagenes, formato, destino)
+
+
+def _codificar_imagen(imagenes, formato, destino):
+    if not isinstance(imagenes, (list, tuple)):
+        imagenes = [imagenes]
+    primera = imagenes[0]
+
+    if formato == 'png':
+        primera.save(destino, 'PNG')
+    elif formato == 'jpeg':
+        primera.convert('RGB').save(destino, 'JPEG', quality=JPEG_CALIDAD, optimize=True, progressive=True)
+    elif formato == 'webp':
+        primera.save(destino, 'WEBP', quality=WEBP_CALIDAD, method=4)
+    elif formato == 'pdf':
+        paginas = [img.convert('RGB') for img in imagenes]
+        paginas[0].save(destino, 'PDF', save_all=True, append_images=paginas[1:],
+                        resolution=PDF_DPI, quality=JPEG_CALIDAD)
+    else:
+        raise ValueError(f"Formato no soportado: {formato}")
+
+
+def _acepta_explicitamente(mimetype):
+    """True si el header Accept nombra el mimetype (sin contar comodines como */*)"""
+    return any(valor == mimetype and calidad > 0 for valor, calidad in request.accept_mimetypes)
+
+
+def elegir_formato_imagen(solicitado=None, defecto='png'):
+    """
+    Formato pedido con formato_imagen o, si no hay, el más chico que el
+    cliente nombre en Accept. Sin preferencia explícita se usa defecto.
+    Lanza ValueError si el formato pedido no existe
+    """
+    if solicitado:
+        formato = solicitado.lower()
+        formato = 'jpeg' if formato == 'jpg' else formato
+        if formato not in FORMATOS_IMAGEN:
+            raise ValueError(f"formato_imagen debe ser uno de: {', '.join(FORMATOS_IMAGEN)}")
+        return formato
+    for formato in PREFERENCIA_FORMATOS:
+        if _acepta_explicitamente(FORMATOS_IMAGEN[formato]['mimetype']):
+            return formato
+    return defecto
+
+
+# ============================================
+# MINIATURAS
+# ============================================
+# ?formato=thumb&w= dibuja sobre una copia reducida de la plantilla, así
+# que el trabajo es proporcional a los píxeles de la miniatura. El ancho se
+# redondea a múltiplos de MINIATURA_PASO para que haya pocos tamaños
+# distintos en caché.
+
+MINIATURA_ANCHO = int(os.getenv('MINIATURA_ANCHO', '320'))
+MINIATURA_ANCHO_MIN = 80
+MINIATURA_ANCHO_MAX = int(os.getenv('MINIATURA_ANCHO_MAX', '800'))
+MINIATURA_PASO = 40
+
+
+def ancho_miniatura(valor=None):
+    """Ancho pedido (w) limitado al rango permitido y redondeado a MINIATURA_PASO"""
+    try:
+        ancho = int(valor) if valor else MINIATURA_ANCHO
+    except ValueError:
+        ancho = MINIATURA_ANCHO
+    ancho = min(max(ancho, MINIATURA_ANCHO_MIN), MINIATURA_ANCHO_MAX)
+    return max(MINIATURA_ANCHO_MIN, round(ancho / MINIATURA_PASO) * MINIATURA_PASO)
+
+
+# ============================================
+# CACHÉ EN DISCO DE CERTIFICADOS GENERADOS
+# ============================================
+# Un certificado sólo depende de datos_certificado y de la plantilla, así
+# que el archivo se guarda con el hash de ambos como nombre (y la extensión
+# del formato). Al leerlo se
+# actualiza su mtime y, si la carpeta supera CERTIFICADOS_CACHE_MB, se
+# borran los menos usados.
+
+# Subir cuando cambie la forma de dibujar el certificado (los layouts ya
+# cuentan por su cuenta con HUELLA_LAYOUT)
+VERSION_RENDER = '2'
+
+_render_cache_bytes = None
+_render_cache_lock = threading.Lock()
+
+
+def version_plantilla(nombre_plantilla):
+    """Identidad de la plantilla y de la forma de dibujarla; cambia si cambia cualquiera de las dos"""
+    ruta, st = resolver_plantilla(nombre_plantilla)
+    identidad = f"{ruta}:{st.st_mtime_ns}:{st.st_size}" if ruta else 'sin-plantilla'
+    return hashlib.sha1(f"{VERSION_RENDER}|{HUELLA_LAYOUT}|{identidad}".encode('utf-8')).hexdigest()[:16]
+
+
+def clave_certificado(datos_certificado):
+    """Hash del contenido del certificado y de la versión de su plantilla"""
+    version = version_plantilla(datos_certificado.get('plantilla', 'plantilla_default.jpg'))
+    contenido = json.dumps(datos_certificado, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(f"{version}|{contenido}".encode('utf-8')).hexdigest()
+
+
+def _escribir_archivo(ruta, contenido):
+    """Escribe a un temporal y renombra para que nadie lea un archivo a medias"""
+    temporal = f"{ruta}.{uuid.uuid4().hex}.tmp"
+    with open(temporal, 'wb') as f:
+        f.write(contenido)
+    os.replace(temporal, ruta)
+
+
+def _limpiar_cache_render():
+    """Borra los archivos menos usados hasta quedar debajo del límite (llamar con el lock)"""
+    global _render_cache_bytes
+
+    archivos = []
+    for entrada in os.scandir(CACHE_RENDER_FOLDER):
+        if entrada.is_file() and not entrada.name.endswith('.tmp'):
+            st = entrada.stat()
+            archivos.append((st.st_mtime, st.st_size, entrada.path))
+
+    total = sum(a[1] for a in archivos)
+    limite = CERTIFICADOS_CACHE_MB * 1024 * 1024
+    if total > limite:
+        # Dejar un margen para no limpiar en cada escritura
+        objetivo = int(limite * 0.9)
+        for _, tamano, ruta in sorted(archivos):
+            if total <= objetivo:
+                break
+            try:
+                os.remove(ruta)
+                total -= tamano
+            except OSError:
+                pass
+    _render_cache_bytes = total
+
+
+def _ruta_en_cache(clave, formato='png'):
+    """Ruta del archivo en caché si existe (y lo marca como usado), o None"""
+    ruta = os.path.join(CACHE_RENDER_FOLDER, f"{clave}.{FORMATOS_IMAGEN[formato]['extension']}")
+    try:
+        os.utime(ruta)
+    except FileNotFoundError:
+        contar('donaciones_cache_total', cache='disco', resultado='fallo')
+        return None
+    contar('donaciones_cache_total', cache='disco', resultado='acierto')
+    return ruta
+
+
+def _guardar_en_cache(clave, contenido, formato='png'):
+    """Guarda los bytes del certificado en la caché y devuelve su ruta"""
+    global _render_cache_bytes
+
+    ruta = os.path.join(CACHE_RENDER_FOLDER, f"{clave}.{FORMATOS_IMAGEN[formato]['extension']}")
+    _escribir_archivo(ruta, contenido)
+
+    with _render_cache_lock:
+        if _render_cache_bytes is None:
+            _limpiar_cache_render()
+        else:
+            _render_cache_bytes += len(contenido)
+            if _render_cache_bytes > CERTIFICADOS_CACHE_MB * 1024 * 1024:
+                _limpiar_cache_render()
+
+    return ruta
+
+
+def obtener_certificado_cacheado(datos_certificado, clave=None, formato='png', ancho=None):
+    """Devuelve la ruta del certificado (o miniatura) en la caché de disco, generándolo si no existe"""
+    clave = clave or clave_certificado(datos_certificado)
+    if ancho:
+        clave = f"{clave}-w{ancho}"
+    ruta = _ruta_en_cache(clave, formato)
+    if ruta:
+        return ruta
+
+    img_bytes = generar_imagen_certificado(datos_certificado, formato=formato, ancho=ancho)
+    if not img_bytes:
+        return None
+    return _guardar_en_cache(clave, img_bytes.getvalue(), formato)
+
+
+# ============================================
+# GENERACIÓN EN PARALELO (POOL DE PROCESOS)
+# ============================================
+# Dibujar con Pillow usa CPU y no suelta el GIL, así que las órdenes con
+# varios certificados se generan en un pool de RENDER_PROCESOS procesos.
+# En Linux se usa fork para que los hijos hereden plantillas y fuentes ya
+# cargadas.
+
+RENDER_PROCESOS = int(os.getenv('RENDER_PROCESOS', str(os.cpu_count() or 1)))
+
+_pool_render = None
+_pool_render_lock = threading.Lock()
+
+
+def _reiniciar_locks_en_hijo():
+    """
+    Un lock tomado por otro hilo al momento del fork quedaría bloqueado para
+    siempre en el hijo, y los hilos del padre no existen en el hijo: se
+    reinician todos los locks, colas y listas de workers del proceso
+    """
+    global _plantillas_lock, _fuentes_lock, _render_cache_lock, _descargas_lock, _descargas_pendientes, _descargas_hilo
+    global _metricas_lock, _histogramas, _contadores
+    global _mailjet_lock, _mailjet_cliente, _correos_lock, _correos_evento, _correos_detener, _correos_workers
+    global _pool_render_lock, _pool_render, _render_workers_lock, _render_workers, _cola_render
+    global _emisiones_cond, _catalogo_lock
+    _plantillas_lock = threading.Lock()
+    _fuentes_lock = threading.Lock()
+    _render_cache_lock = threading.Lock()
+    _catalogo_lock = threading.Lock()
+    # Las descargas pendientes las guarda el proceso padre, no cada hijo
+    _descargas_lock = threading.Lock()
+    _descargas_pendientes = {}
+    _descargas_hilo = None
+    # Cada proceso reporta sólo lo que mide él
+    _metricas_lock = threading.Lock()
+    _histogramas, _contadores = {}, {}
+    # La sesión HTTP de Mailjet no se comparte entre procesos
+    _mailjet_lock = threading.Lock()
+    _mailjet_cliente = None
+    # Workers de correo y de emisión, y el pool de render, son del proceso padre
+    _correos_lock = threading.Lock()
+    _correos_evento = threading.Event()
+    _correos_detener = threading.Event()
+    _correos_workers = []
+    _pool_render_lock = threading.Lock()
+    _pool_render = None
+    _render_workers_lock = threading.Lock()
+    _render_workers = []
+    _cola_render = queue.Queue(maxsize=RENDER_COLA_MAX)
+    _emisiones_cond = threading.Condition()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reiniciar_locks_en_hijo)
+
+
+def _tarea_pool(funcion, *args):
+    """Se ejecuta en el pool: el resultado de la función y las métricas que registró"""
+    resultado = funcion(*args)
+    return resultado, tomar_metricas()
+
+
+def mapear_en_pool(funcion, *iterables):
+    """Como pool.map, pero suma en este proceso las métricas de los procesos del pool"""
+    listas = [list(iterable) for iterable in iterables]
+    for resultado, metricas in obtener_pool_render().map(_tarea_pool, [funcion] * len(listas[0]), *listas):
+        sumar_metricas(metricas)
+        yield resultado
+
+
+def obtener_pool_render():
+    """Devuelve el pool de procesos para generar certificados, creándolo la primera vez"""
+    global _pool_render
+    with _pool_render_lock:
+        if _pool_render is None:
+            contexto = None
+            if 'fork' in multiprocessing.get_all_start_methods():
+                contexto = multiprocessing.get_context('fork')
+            _pool_render = ProcessPoolExecutor(max_workers=RENDER_PROCESOS, mp_context=contexto)
+    return _pool_render
+
+
+def _renderizar(datos_certificado, formato='png'):
+    """Se ejecuta en el pool: devuelve los bytes del certificado o None"""
+    img_bytes = generar_imagen_certificado(datos_certificado, formato=formato)
+    return img_bytes.getvalue() if img_bytes else None
+
+
+def renderizar_certificados(lista_datos, formato='png'):
+    """
+    Devuelve la ruta en caché de cada certificado de la lista (None si falló),
+    generando en paralelo los que no estén en caché
+    """
+    claves = [clave_certificado(datos) for datos in lista_datos]
+    rutas = [_ruta_en_cache(clave, formato) for clave in claves]
+    faltantes = [i for i, ruta in enumerate(rutas) if ruta is None]
+    datos_faltantes = [lista_datos[i] for i in faltantes]
+
+    if len(faltantes) > 1 and RENDER_PROCESOS > 1:
+        resultados = mapear_en_pool(_renderizar, datos_faltantes, [formato] * len(faltantes))
+    else:
+        resultados = (_renderizar(datos, formato) for datos in datos_faltantes)
+
+    for i, contenido in zip(faltantes, resultados):
+        if contenido:
+            rutas[i] = _guardar_en_cache(claves[i], contenido, formato)
+    return rutas
+
+
+def generar_pdf_certificados(lista_datos):
+    """Un solo PDF con una página por certificado; las páginas se dibujan en paralelo"""
+    if len(lista_datos) > 1 and RENDER_PROCESOS > 1:
+        imagenes = list(mapear_en_pool(dibujar_certificado, lista_datos))
+    else:
+        imagenes = [dibujar_certificado(datos) for datos in lista_datos]
+    pdf_bytes = io.BytesIO()
+    codificar_imagen(imagenes, 'pdf', pdf_bytes)
+    return pdf_bytes.getvalue()
+
+
+# ============================================
+# CERTIFICADOS EMITIDOS
+# ============================================
+# Cada fila de certificados_generados se dibuja una vez, al terminar la
+# compra, y su PNG se guarda en EMITIDOS_FOLDER. La fila guarda la ruta
+# (archivo_path), la clave del contenido (archivo_hash, la misma de
+# clave_certificado) y la versión de la plantilla con que se dibujó.
+# Las vistas y reenvíos mandan ese archivo tal cual; sólo se vuelve a
+# dibujar si cambió la plantilla o el layout (cambia la clave) o si el
+# archivo ya no está. Los otros formatos y las miniaturas se derivan en la
+# caché de disco.
+
+def _ruta_emitido(cert_gen_id):
+    return os.path.join(EMITIDOS_FOLDER, f"certificado_{cert_gen_id}.png")
+
+
+def _dibujar_emision(datos_certificado, formato_extra=None):
+    """Se ejecuta en el pool: el PNG a guardar y, si se pide, el mismo dibujo en otro formato"""
+    imagen = dibujar_certificado(datos_certificado)
+    png = io.BytesIO()
+    codificar_imagen(imagen, 'png', png)
+    extra = None
+    if formato_extra:
+        salida = io.BytesIO()
+        codificar_imagen(imagen, formato_extra, salida)
+        extra = salida.getvalue()
+    return png.getvalue(), extra
+
+
+def emitir_certificados(conn, emisiones, formato_extra=None, forzar=False, en_pool=False):
+    """
+    Devuelve la ruta del PNG guardado de cada (fila, datos_certificado) de
+    emisiones, donde la fila trae cert_gen_id, archivo_path y archivo_hash.
+    Dibuja (en paralelo) sólo los que no están al día y actualiza sus filas.
+    Con formato_extra, los que se dibujan quedan también en la caché en ese formato.
+    Con en_pool se dibuja en el pool aunque sea uno solo (para no ocupar el GIL del proceso web)
+    """
+    claves = [clave_certificado(datos) for _, datos in emisiones]
+    rutas = [fila['archivo_path'] for fila, _ in emisiones]
+    faltantes = [
+        i for i, (fila, _) in enumerate(emisiones)
+        if forzar or fila['archivo_hash'] != claves[i] or not rutas[i] or not os.path.exists(rutas[i])
+    ]
+    contar('donaciones_cache_total', len(emisiones) - len(faltantes), cache='emitidos', resultado='acierto')
+    if not faltantes:
+        return rutas
+    contar('donaciones_cache_total', len(faltantes), cache='emitidos', resultado='fallo')
+
+    datos_faltantes = [emisiones[i][1] for i in faltantes]
+    if RENDER_PROCESOS > 1 and (en_pool or len(faltantes) > 1):
+        resultados = mapear_en_pool(_dibujar_emision, datos_faltantes, [formato_extra] * len(faltantes))
+    else:
+        resultados = (_dibujar_emision(datos, formato_extra) for datos in datos_faltantes)
+
+    filas = []
+    for i, (png, extra) in zip(faltantes, resultados):
+        fila, datos_certificado = emisiones[i]
+        rutas[i] = _ruta_emitido(fila['cert_gen_id'])
+        _escribir_archivo(rutas[i], png)
+        if extra:
+            _guardar_en_cache(claves[i], extra, formato_extra)
+        filas.append((rutas[i], claves[i],
+                      version_plantilla(datos_certificado.get('plantilla', 'plantilla_default.jpg')),
+                      fila['cert_gen_id']))
+
+    with medir('donaciones_sql_segundos', grupo='emision'):
+        conn.executemany("""
+            UPDATE certificados_generados
+            SET archivo_path = ?, archivo_hash = ?, plantilla_version = ?
+            WHERE id = ?
+        """, filas)
+        conn.commit()
+    return rutas
+
+
+def pdf_de_archivos(rutas):
+    """Un solo PDF con una página por imagen ya guardada (no se vuelven a dibujar)"""
+    imagenes = [Image.open(ruta) for ruta in rutas]
+    try:
+        pdf_bytes = io.BytesIO()
+        codificar_imagen(imagenes, 'pdf', pdf_bytes)
+        return pdf_bytes.getvalue()
+    finally:
+        for imagen in imagenes:
+            imagen.close()
+
+
+def ruta_certificado(conn, detalle, datos_certificado, formato='png'):
+    """Ruta del certificado en el formato pedido: el PNG emitido o, si no aplica, la caché"""
+    if formato == 'png' and detalle['cert_gen_id']:
+        return emitir_certificados(conn, [(detalle, datos_certificado)])[0]
+    return obtener_certificado_cacheado(datos_certificado, formato=formato)
+
+
+# ============================================
+# EMISIÓN EN SEGUNDO PLANO
+# ============================================
+# procesar_pago no dibuja: hace commit, mete la donación en _cola_render y
+# responde 202 con la URL de estado. RENDER_WORKERS hilos toman las
+# donaciones de la cola y las emiten (el dibujo va al pool de procesos).
+# La cola tiene tope: si está llena, la compra responde 503 con
+# Retry-After en lugar de acumular trabajo sin límite.
+# Una donación está lista cuando todos sus certificados tienen archivo, y
+# si su emisión falló el error queda en donaciones.emision_error; las dos
+# cosas se leen de la BD, así que el estado se puede consultar en
+# cualquier proceso (o worker de gunicorn). Si una emisión se pierde
+# (p. ej. un reinicio), los certificados se dibujan igual la primera vez
+# que se piden.
+
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', '2'))
+RENDER_COLA_MAX = int(os.getenv('RENDER_COLA_MAX', '100'))
+# Segundos que se le sugieren al cliente (Retry-After) cuando la cola está llena
+RENDER_REINTENTO_SEGUNDOS = int(os.getenv('RENDER_REINTENTO_SEGUNDOS', '5'))
+# Máximo de segundos que /api/donacion/<id>/estado espera a que esté lista
+ESTADO_ESPERA_MAX = 30
+
+_cola_render = queue.Queue(maxsize=RENDER_COLA_MAX)
+_render_workers = []
+_render_workers_lock = threading.Lock()
+# Se avisa cada vez que termina una emisión en este proceso, para los que
+# esperan el estado; las de otros procesos se ven al volver a leer la BD
+_emisiones_cond = threading.Condition()
+
+
+def cola_render_llena():
+    return _cola_render.full()
+
+
+def encolar_emision(donacion_id, formato_extra=None):
+    """Pide la emisión de los certificados de una donación; lanza queue.Full si no hay lugar"""
+    _cola_render.put_nowait((donacion_id, formato_extra))
+
+
+def _emitir_donacion(conn, donacion_id, formato_extra=None):
+    """Emite todos los certificados de una donación y devuelve cuántos son"""
+    detalle_ids = [fila['id'] for fila in conn.execute("""
+        SELECT id FROM donacion_detalles WHERE donacion_id = ? ORDER BY id
+    """, (donacion_id,)).fetchall()]
+    emisiones = [obtener_datos_certificado(conn, detalle_id) for detalle_id in detalle_ids]
+    emisiones = [(fila, datos) for fila, datos in emisiones if fila and fila['cert_gen_id']]
+    emitir_certificados(conn, emisiones, formato_extra=formato_extra, en_pool=True)
+    return len(emisiones)
+
+
+def _worker_render():
+    """Ciclo de un worker: emite las donaciones de la cola una por una"""
+    conn = abrir_conexion()
+    while True:
+        donacion_id, formato_extra = _cola_render.get()
+        if donacion_id is None:
+            # detener_workers()
+            _cola_render.task_done()
+            conn.close()
+            return
+        # En el mismo commit se libera el correo de la compra: ya puede adjuntar
+        # los archivos emitidos (si la emisión falló, el worker de correo los
+        # dibuja al enviarlo; si no se pudo guardar, sale al vencer su espera)
+        try:
+            total = _emitir_donacion(conn, donacion_id, formato_extra)
+            conn.execute("""
+                UPDATE donaciones SET emision_error = NULL WHERE id = ? AND emision_error IS NOT NULL
+            """, (donacion_id,))
+            liberar_correo_compra(conn, donacion_id)
+            conn.commit()
+            print(f"🖼️ Donación {donacion_id}: {total} certificado(s) emitidos")
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ Error emitiendo la donación {donacion_id}: {e}")
+            try:
+                conn.execute("UPDATE donaciones SET emision_error = ? WHERE id = ?", (str(e), donacion_id))
+                liberar_correo_compra(conn, donacion_id)
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                print(f"❌ No se pudo guardar el error de la donación {donacion_id}: {e}")
+        finally:
+            _cola_render.task_done()
+
+        with _emisiones_cond:
+            _emisiones_cond.notify_all()
+        avisar_workers_correo()
+
+
+@app.before_request
+def iniciar_workers_render():
+    """Arranca los workers de emisión en el primer request de cada proceso"""
+    if _render_workers:
+        return
+    with _render_workers_lock:
+        if _render_workers:
+            return
+        for i in range(RENDER_WORKERS):
+            worker = threading.Thread(target=_worker_render, name=f"render-{i}", daemon=True)
+            worker.start()
+            _render_workers.append(worker)
+
+
+def detener_workers():
+    """
+    Detiene los workers de correo y de emisión y cierra el pool de render
+    (p. ej. antes de cambiar DATABASE); se vuelven a crear en el siguiente request
+    """
+    global _pool_render
+    with _correos_lock:
+        _correos_detener.set()
+        _correos_evento.set()
+        for worker in _correos_workers:
+            worker.join()
+        _correos_workers.clear()
+        _correos_detener.clear()
+    with _render_workers_lock:
+        for _ in _render_workers:
+            _cola_render.put((None, None))
+        for worker in _render_workers:
+            worker.join()
+        _render_workers.clear()
+    with _pool_render_lock:
+        if _pool_render is not None:
+            _pool_render.shutdown()
+            _pool_render = None
+
+
+def esperar_emision(donacion_id, segundos=0):
+    """Espera hasta `segundos` a que todos los certificados de la donación tengan archivo."""
+    conn = get_db()
+    limite = time.monotonic() + segundos
+    while True:
+        inicio = time.perf_counter()
+        estado = conn.execute("""
+            SELECT d.folio, d.emision_error, COUNT(dd.id) AS certificados,
+                   COUNT(cg.archivo_path) AS listos, MIN(dd.id) AS detalle_id
+            FROM donaciones d
+            LEFT JOIN donacion_detalles dd ON dd.donacion_id = d.id
+            LEFT JOIN certificados_generados cg ON cg.donacion_detalle_id = dd.id
+            WHERE d.id = ?
+        """, (donacion_id,)).fetchone()
+        observar('donaciones_sql_segundos', time.perf_counter() - inicio, grupo='estado')
+        if estado['folio'] is None:
+            return None, None
+
+        error = estado['emision_error']
+        restante = limite - time.monotonic()
+        if estado['listos'] >= estado['certificados'] or error or restante <= 0:
+            return estado, error
+        with _emisiones_cond:
+            _emisiones_cond.wait(min(restante, 0.5))
+
+
+# ============================================
+# ZIP EN STREAMING
+# ============================================
+
+class _BufferZip(io.RawIOBase):
+    """Destino sin seek para zipfile: acumula lo escrito hasta que se vacía"""
+
+    def __init__(self):
+        super().__init__()
+        self._partes = []
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        return len(datos)
+
+    def vaciar(self):
+        datos = b''.join(self._partes)
+        self._partes = []
+        return datos
+
+
+def zip_en_streaming(entradas):
+    """
+    Genera un ZIP por partes a partir de un iterable de (nombre_archivo, bytes).
+    Las entradas se consumen una por una, así que la memoria no crece con el número de archivos.
+    Los PNG ya vienen comprimidos, por eso se guardan sin volver a comprimir
+    """
+    buffer = _BufferZip()
+    zf = zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED)
+    for nombre_archivo, contenido in entradas:
+        zf.writestr(nombre_archivo, contenido)
+        yield buffer.vaciar()
+    zf.close()
+    yield buffer.vaciar()
+
+
+def leer_archivo(ruta):
+    with open(ruta, 'rb') as f:
+        return f.read()
+
+
+def respuesta_zip(entradas, nombre_zip):
+    """Respuesta que descarga en streaming el ZIP de las entradas (nombre_archivo, bytes)"""
+    respuesta = Response(zip_en_streaming(entradas), mimetype='application/zip')
+    respuesta.headers.set('Content-Disposition', 'attachment', filename=nombre_zip)
+    return respuesta
+
+
+def respuesta_zip_certificados(detalle_ids, nombre_zip, formato='png'):
+    """ZIP con los certificados indicados, generando y agregando uno a la vez"""
+    extension = FORMATOS_IMAGEN[formato]['extension']
+
+    def entradas():
+        # La conexión del request ya se cerró cuando se empieza a enviar el ZIP
+        conn = tomar_conexion()
+        try:
+            for detalle_id in detalle_ids:
+                detalle, datos_certificado = obtener_datos_certificado(conn, detalle_id)
+                if not datos_certificado:
+                    continue
+                ruta = ruta_certificado(conn, detalle, datos_certificado, formato)
+                if ruta:
+                    yield f"certificado_{datos_certificado['folio']}.{extension}", leer_archivo(ruta)
+        finally:
+            devolver_conexion(conn)
+
+    return respuesta_zip(entradas(), nombre_zip)
+
+
+# ============================================
+# DATOS DE UN CERTIFICADO GUARDADO
+# ============================================
+
+def obtener_datos_certificado(conn, detalle_id):
+    """
+    Lee un donacion_detalle y arma el datos_certificado para regenerarlo.
+    Devuelve (fila, datos_certificado) o (None, None) si no existe
+    """
+    inicio = time.perf_counter()
+    detalle = conn.execute("""
+        SELECT 
+            d.nombre_titular,
+            d.email,
+            d.fecha,
+            d.folio as folio_donacion,
+            dd.nombre_beneficiario,
+            dd.mensaje_personalizado as mensaje,
+            dd.nombre_certificado,
+            dd.cantidad,
+            dd.precio_unitario,
+            dd.certificado_id,
+            dd.folio_certificado,
+            cg.id as cert_gen_id,
+            cg.veces_descargado,
+            cg.archivo_path,
+            cg.archivo_hash,
+            c.imagen_url
+        FROM donacion_detalles dd
+        JOIN donaciones d ON dd.donacion_id = d.id
+        LEFT JOIN certificados c ON dd.certificado_id = c.id
+        LEFT JOIN certificados_generados cg ON dd.id = cg.donacion_detalle_id
+        WHERE dd.id = ?
+    """, (detalle_id,)).fetchone()
+    observar('donaciones_sql_segundos', time.perf_counter() - inicio, grupo='certificado')
+    
+    if not detalle:
+        return None, None
+    
+    # Formatear fecha
+    fecha_donacion = datetime.strptime(detalle['fecha'], '%Y-%m-%d %H:%M:%S')
+    fecha_formateada = fecha_donacion.strftime("%d de %B, %Y")
+    
+    # Determinar plantilla a usar
+    nombre_plantilla = 'plantilla_default.jpg'
+    if detalle['imagen_url']:
+        nombre_plantilla = detalle['imagen_url']
+    elif detalle['certificado_id']:
+        nombre_plantilla = f"plantilla_{detalle['certificado_id']}.jpg"
+    
+    datos_certificado = {
+        'nombre_titular': detalle['nombre_titular'],
+        'nombre_beneficiario': detalle['nombre_beneficiario'] or detalle['nombre_titular'],
+        'email': detalle['email'],
+        'mensaje': detalle['mensaje'] or '',
+        'certificado_nombre': detalle['nombre_certificado'],
+        'cantidad': detalle['cantidad'],
+        'monto': detalle['cantidad'] * detalle['precio_unitario'],
+        'fecha': fecha_formateada,
+        'folio': detalle['folio_certificado'] or detalle['folio_donacion'],
+        'plantilla': nombre_plantilla
+    }
+    return detalle, datos_certificado
+
+
+def agregar_cabeceras_cache(respuesta, etag):
+    """Agrega ETag y Cache-Control a una respuesta con la imagen del certificado"""
+    respuesta.set_etag(etag)
+    # send_file pone no-cache por defecto
+    respuesta.cache_control.no_cache = None
+    respuesta.cache_control.private = True
+    respuesta.cache_control.max_age = CERTIFICADOS_MAX_AGE
+    # El formato puede salir del header Accept
+    respuesta.vary.add('Accept')
+    return respuesta
+
+
+def respuesta_no_modificado(etag):
+    """Respuesta 304 para un If-None-Match que coincide con el ETag"""
+    return agregar_cabeceras_cache(app.response_class(status=304), etag)
+
+
+# ============================================
+# PAGINACIÓN POR CURSOR
+# ============================================
+# Las listas se piden por páginas con ?limit=N&after=<cursor>. El cursor
+# son los valores de orden de la última fila entregada, así que la
+# siguiente página es una lectura de rango del índice (no un OFFSET que
+# tenga que saltarse todas las filas anteriores).
+
+PAGINA_DEFECTO = int(os.getenv('PAGINA_DEFECTO', '50'))
+PAGINA_MAX = 200
+
+
+def codificar_cursor(valores):
+    return base64.urlsafe_b64encode(json.dumps(valores).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor(cursor, campos):
+    """Lista con los valores del cursor; lanza ValueError si no es válido"""
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Cursor 'after' inválido")
+    if not isinstance(valores, list) or len(valores) != campos:
+        raise ValueError("Cursor 'after' inválido")
+    return valores
+
+
+def parametros_pagina(campos_cursor):
+    """(limit, valores del cursor o None) de ?limit= y ?after=; lanza ValueError si no son válidos"""
+    try:
+        limite = int(request.args.get('limit', PAGINA_DEFECTO))
+    except ValueError:
+        raise ValueError("limit debe ser un número")
+    limite = min(max(limite, 1), PAGINA_MAX)
+    after = request.args.get('after')
+    return limite, decodificar_cursor(after, campos_cursor) if after else None
+
+
+# ============================================
+# CATÁLOGO DE CERTIFICADOS EN MEMORIA
+# ============================================
+# La tabla certificados casi no cambia, así que se guarda una copia en
+# memoria con el JSON de /api/certificados ya serializado. Cada
+# CATALOGO_REVISION_SEGUNDOS se compara la versión de la tabla en
+# versiones_tablas, que los triggers incrementan en cada INSERT, UPDATE o
+# DELETE (updated_at no sirve: tiene resolución de un segundo). Si
+# cambió, se vuelve a cargar.
+
+CATALOGO_REVISION_SEGUNDOS = float(os.getenv('CATALOGO_REVISION_SEGUNDOS', '5'))
+
+_catalogo = None
+_catalogo_lock = threading.Lock()
+
+
+def _firma_catalogo(conn):
+    return conn.execute("SELECT version FROM versiones_tablas WHERE tabla = 'certificados'").fetchone()[0]
+
+
+def _serializar_catalogo(datos):
+    """JSON igual al de jsonify y su ETag"""
+    contenido = f"{app.json.dumps(datos)}\n".encode('utf-8')
+    return contenido, hashlib.sha1(contenido).hexdigest()
+
+
+def cargar_catalogo(conn):
+    """Lee la tabla certificados y arma la copia en memoria"""
+    firma = _firma_catalogo(conn)
+    filas = conn.execute("""
+        SELECT id, nombre, descripcion, precio, imagen_url, activo FROM certificados ORDER BY id
+    """).fetchall()
+
+    por_id = {fila['id']: dict(fila) for fila in filas}
+    publicos = {
+        fila['id']: {
+            'id': fila['id'],
+            'nombre': fila['nombre'],
+            'descripcion': fila['descripcion'],
+            'precio': fila['precio'],
+            'imagen_url': fila['imagen_url'] or '/static/default-cert.jpg'
+        }
+        for fila in filas if fila['activo'] == 1
+    }
+    json_lista, etag_lista = _serializar_catalogo({"certificados": list(publicos.values())})
+
+    return {
+        'firma': firma,
+        'revisado': time.monotonic(),
+        'por_id': por_id,  # Todos, incluso inactivos (para compras y regeneración)
+        'json_lista': json_lista,
+        'etag_lista': etag_lista,
+        'json_por_id': {cert_id: _serializar_catalogo(cert) for cert_id, cert in publicos.items()},
+    }
+
+
+def obtener_catalogo(conn=None):
+    """Devuelve la copia del catálogo, recargándola si la tabla cambió"""
+    global _catalogo
+    catalogo = _catalogo
+    if catalogo and time.monotonic() - catalogo['revisado'] < CATALOGO_REVISION_SEGUNDOS:
+        return catalogo
+
+    with _catalogo_lock:
+        catalogo = _catalogo
+        if catalogo and time.monotonic() - catalogo['revisado'] < CATALOGO_REVISION_SEGUNDOS:
+            return catalogo
+
+        propia = conn is None
+        conn = tomar_conexion() if propia else conn
+        try:
+            with medir('donaciones_sql_segundos', grupo='catalogo'):
+                vigente = catalogo and _firma_catalogo(conn) == catalogo['firma']
+            if vigente:
+                catalogo['revisado'] = time.monotonic()
+                contar('donaciones_cache_total', cache='catalogo', resultado='acierto')
+            else:
+                with medir('donaciones_sql_segundos', grupo='catalogo'):
+                    catalogo = _catalogo = cargar_catalogo(conn)
+                contar('donaciones_cache_total', cache='catalogo', resultado='fallo')
+                print(f"📚 Catálogo cargado: {len(catalogo['por_id'])} certificados")
+        finally:
+            if propia:
+                devolver_conexion(conn)
+    return catalogo
+
+
+def respuesta_catalogo(contenido, etag):
+    """Respuesta con el JSON ya serializado; el navegador revalida con If-None-Match"""
+    if request.if_none_match.contains(etag):
+        respuesta = app.response_class(status=304)
+    else:
+        respuesta = app.response_class(contenido, mimetype='application/json')
+    respuesta.set_etag(etag)
+    respuesta.cache_control.no_cache = True
+    return respuesta
+
+
+obtener_catalogo()
+
+
 # ============================================
 # RUTAS PARA CERTIFICADOS (TIPOS)
 # ============================================
@@ -224,22 +2290,8 @@ def generar_imagen_certificado(datos_certificado, output_path=None):
 def get_certificados():
     """Obtiene todos los certificados activos"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, nombre, descripcion, precio, imagen_url FROM certificados WHERE activo = 1")
-        certificados = cursor.fetchall()
-        
-        result = []
-        for cert in certificados:
-            result.append({
-                'id': cert['id'],
-                'nombre': cert['nombre'],
-                'descripcion': cert['descripcion'],
-                'precio': cert['precio'],
-                'imagen_url': cert['imagen_url'] or '/static/default-cert.jpg'
-            })
-        
-        return jsonify({"certificados": result}), 200
+        catalogo = obtener_catalogo(get_db())
+        return respuesta_catalogo(catalogo['json_lista'], catalogo['etag_lista'])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -247,23 +2299,13 @@ def get_certificados():
 def get_certificado(id):
     """Obtiene un certificado específico"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, nombre, descripcion, precio, imagen_url FROM certificados WHERE id = ? AND activo = 1", (id,))
-        cert = cursor.fetchone()
+        catalogo = obtener_catalogo(get_db())
+        cert = catalogo['json_por_id'].get(id)
         
         if not cert:
             return jsonify({"error": "Certificado no encontrado"}), 404
         
-        result = {
-            'id': cert['id'],
-            'nombre': cert['nombre'],
-            'descripcion': cert['descripcion'],
-            'precio': cert['precio'],
-            'imagen_url': cert['imagen_url'] or '/static/default-cert.jpg'
-        }
-        
-        return jsonify(result), 200
+        return respuesta_catalogo(*cert)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -274,7 +2316,8 @@ def get_certificado(id):
 @app.route("/api/procesar-pago", methods=['POST'])
 def procesar_pago():
     """
-    Procesa el pago, guarda en BD y descarga certificado inmediatamente
+    Procesa el pago, lo guarda en BD y encola la emisión de los certificados.
+    Responde 202 con la URL donde consultar cuándo están listos para descargar
     """
     try:
         data = request.get_json()
@@ -287,19 +2330,50 @@ def procesar_pago():
             if field not in data:
                 return jsonify({"error": f"Falta el campo {field}"}), 400
         
-        # Calcular total
-        total = 0
-        for item in data['items']:
-            total += item['precio'] * item['cantidad']
+        # Formato de la descarga (y de los adjuntos del correo, si se pidió uno)
+        try:
+            formato_imagen = elegir_formato_imagen(data.get('formato_imagen'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Si los workers de emisión no dan abasto, no se acepta la compra todavía
+        if cola_render_llena():
+            respuesta = jsonify({"error": "Estamos procesando muchas compras, intenta de nuevo en unos segundos"})
+            respuesta.headers['Retry-After'] = str(RENDER_REINTENTO_SEGUNDOS)
+            return respuesta, 503
         
         conn = get_db()
         cursor = conn.cursor()
         
+        # Plantilla y precio de cada certificado, del catálogo en memoria
+        catalogo = obtener_catalogo(conn)['por_id']
+        
+        if not isinstance(data['items'], list) or not data['items']:
+            return jsonify({"error": "items debe ser una lista con al menos un certificado"}), 400
+        
+        # Cada item tiene que ser un certificado del catálogo; el precio, el
+        # nombre y la plantilla son los de la BD, no los que manda el cliente
+        certificados = []
+        for item in data['items']:
+            try:
+                certificado_id = int(item.get('certificado_id'))
+            except (AttributeError, TypeError, ValueError):
+                return jsonify({"error": "Cada item necesita un certificado_id numérico"}), 400
+            cert_info = catalogo.get(certificado_id)
+            if not cert_info:
+                return jsonify({"error": f"El certificado {certificado_id} no existe"}), 400
+            certificados.append(cert_info)
+        precios = [cert_info['precio'] for cert_info in certificados]
+        
+        # Calcular total
+        total = sum(precio * item['cantidad'] for precio, item in zip(precios, data['items']))
+        
         # Generar folio único
         fecha = datetime.now()
         folio = f"DON-{fecha.strftime('%Y%m%d')}-{uuid.uuid4().hex[:6].upper()}"
         
         # Insertar donación
+        inicio_sql = time.perf_counter()
         cursor.execute("""
             INSERT INTO donaciones (nombre_titular, email, total, fecha, estado, folio)
             VALUES (?, ?, ?, datetime('now', 'localtime'), 'completada', ?)
@@ -307,126 +2381,133 @@ def procesar_pago():
         
         donacion_id = cursor.lastrowid
         
-        # Procesar cada item
+        # Preparar cada item
         certificados_generados = []
+        filas_detalle = []
 
-        for item in data['items']:
-            # Insertar detalle
-            cursor.execute("""
-                INSERT INTO donacion_detalles 
-                (donacion_id, certificado_id, cantidad, precio_unitario, nombre_certificado, 
-                nombre_beneficiario, mensaje_personalizado, folio_certificado)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
+        folios_usados = set()
+        for indice, (item, cert_info) in enumerate(zip(data['items'], certificados), start=1):
+            precio = cert_info['precio']
+            # El folio de cada certificado es UNIQUE: si la orden repite el
+            # mismo certificado, se agrega el número de item
+            folio_item = f"{folio}-{cert_info['id']}"
+            if folio_item in folios_usados:
+                folio_item = f"{folio_item}-{indice}"
+            folios_usados.add(folio_item)
+            
+            nombre_beneficiario = item.get('nombre_beneficiario', data['nombre_titular'])
+            filas_detalle.append((
                 donacion_id,
-                item.get('certificado_id'),
+                cert_info['id'],
                 item['cantidad'],
-                item['precio'],
-                item['nombre'],
-                item.get('nombre_beneficiario', data['nombre_titular']),
+                precio,
+                cert_info['nombre'],
+                nombre_beneficiario,
                 item.get('mensaje', ''),
-                f"{folio}-{item.get('certificado_id', 'GEN')}"
+                folio_item
             ))
             
-            detalle_id = cursor.lastrowid
-            
-            # OBTENER LA IMAGEN_URL DEL CERTIFICADO
-            nombre_plantilla = 'plantilla_default.jpg'
-            if item.get('certificado_id'):
-                cursor.execute("SELECT imagen_url FROM certificados WHERE id = ?", (item.get('certificado_id'),))
-                cert_info = cursor.fetchone()
-                if cert_info and cert_info['imagen_url']:
-                    nombre_plantilla = cert_info['imagen_url']
+            # La imagen_url del certificado
+            nombre_plantilla = cert_info['imagen_url'] or 'plantilla_default.jpg'
             
             # Preparar datos para el certificado
-            datos_certificado = {
-                'nombre_titular': data['nombre_titular'],
-                'nombre_beneficiario': item.get('nombre_beneficiario', data['nombre_titular']),
-                'email': data['email'],
-                'mensaje': item.get('mensaje', ''),
-                'certificado_nombre': item['nombre'],
-                'cantidad': item['cantidad'],
-                'monto': item['precio'] * item['cantidad'],
-                'fecha': fecha.strftime("%d de %B, %Y"),
-                'folio': f"{folio}-{item.get('certificado_id', 'GEN')}",
-                'plantilla': nombre_plantilla
-            }
-            
-            # Guardar en certificados_generados
-            cursor.execute("""
-                INSERT INTO certificados_generados 
-                (donacion_detalle_id, nombre_donante, email_donante, nombre_beneficiario, mensaje, veces_descargado)
-                VALUES (?, ?, ?, ?, ?, 0)
-            """, (
-                detalle_id,
-                data['nombre_titular'],
-                data['email'],
-                item.get('nombre_beneficiario', data['nombre_titular']),
-                item.get('mensaje', '')
-            ))
-            
-            cert_gen_id = cursor.lastrowid
-            
             certificados_generados.append({
-                'detalle_id': detalle_id,
-                'cert_gen_id': cert_gen_id,
-                'datos': datos_certificado
+                'datos': {
+                    'nombre_titular': data['nombre_titular'],
+                    'nombre_beneficiario': nombre_beneficiario,
+                    'email': data['email'],
+                    'mensaje': item.get('mensaje', ''),
+                    'certificado_nombre': cert_info['nombre'],
+                    'cantidad': item['cantidad'],
+                    'monto': precio * item['cantidad'],
+                    'fecha': fecha.strftime("%d de %B, %Y"),
+                    'folio': folio_item,
+                    'plantilla': nombre_plantilla
+                }
             })
         
-        conn.commit()
+        # Insertar todos los detalles de una vez
+        cursor.executemany("""
+            INSERT INTO donacion_detalles 
+            (donacion_id, certificado_id, cantidad, precio_unitario, nombre_certificado, 
+            nombre_beneficiario, mensaje_personalizado, folio_certificado)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, filas_detalle)
+        
+        # Los ids se asignaron en el orden de inserción
+        cursor.execute("SELECT id FROM donacion_detalles WHERE donacion_id = ? ORDER BY id", (donacion_id,))
+        for cert, fila in zip(certificados_generados, cursor.fetchall()):
+            cert['detalle_id'] = fila['id']
+        
+        # Guardar en certificados_generados
+        cursor.executemany("""
+            INSERT INTO certificados_generados 
+            (donacion_detalle_id, nombre_donante, email_donante, nombre_beneficiario, mensaje, veces_descargado)
+            VALUES (?, ?, ?, ?, ?, 0)
+        """, [
+            (
+                cert['detalle_id'],
+                data['nombre_titular'],
+                data['email'],
+                cert['datos']['nombre_beneficiario'],
+                cert['datos']['mensaje']
+            )
+            for cert in certificados_generados
+        ])
         
-        # Tomamos el primer certificado para descargar
+        # El correo va a nombre del primer beneficiario
         cert_data = certificados_generados[0]['datos']
         
-        # Generar imagen
-        img_bytes = generar_imagen_certificado(cert_data)
-        
-        if not img_bytes:
-            return jsonify({"error": "Error al generar certificado"}), 500
-        
         # ============================================
-        # ENVIAR POR EMAIL - AHORA SÍ SE EJECUTARÁ
+        # ENVIAR POR EMAIL - se encola junto con la compra
         # ============================================
-        def enviar_email_thread():
-            with app.app_context():
-                try:
-                    # Crear una copia de los bytes para el email
-                    img_bytes_copy = io.BytesIO(img_bytes.getvalue())
-                    
-                    print(f"\n{'='*50}")
-                    print(f"📧 Intentando enviar email a: {data['email']}")
-                    print(f"{'='*50}")
-                    
-                    # Enviar email real (ya no simulamos)
-                    enviar_certificado_email(
-                        email_destino=data['email'],
-                        nombre_beneficiario=cert_data['nombre_beneficiario'],
-                        folio=folio,
-                        img_bytes=img_bytes_copy
-                    )
-                except Exception as e:
-                    print(f"❌ Error en thread de email: {e}")
-
-        # Iniciar thread para no bloquear la respuesta
-        email_thread = threading.Thread(target=enviar_email_thread)
-        email_thread.daemon = True
-        email_thread.start()
-        
-        # ============================================
-        # Crear respuesta con la imagen
-        # ============================================
-        response = send_file(
-            img_bytes,
-            as_attachment=True,
-            download_name=f"certificado_{cert_data['nombre_beneficiario'].replace(' ', '_')}.png",
-            mimetype='image/png'
+        # Espera a que _worker_render emita la donación y lo libere, para no
+        # dibujar dos veces; si el proceso se cae antes, sale al vencer la espera
+        correo_id = encolar_correo(
+            cursor,
+            email_destino=data['email'],
+            nombre_destinatario=cert_data['nombre_beneficiario'],
+            folio=folio,
+            donacion_id=donacion_id,
+            formato_imagen=elegir_formato_imagen(data['formato_imagen']) if data.get('formato_imagen') else None,
+            proximo_intento=time.time() + CORREO_RESERVA_SEGUNDOS
         )
         
+        conn.commit()
+        observar('donaciones_sql_segundos', time.perf_counter() - inicio_sql, grupo='compra')
+        
+        # La emisión dibuja una vez y guarda también el formato de la descarga
+        # (o el del correo) para no volver a dibujar
+        formato_correo = formato_imagen if data.get('formato_imagen') else CORREO_FORMATO_IMAGEN
+        formato_extra = next((f for f in (formato_imagen, formato_correo) if f not in ('png', 'pdf')), None)
+        try:
+            encolar_emision(donacion_id, formato_extra)
+        except queue.Full:
+            # Ya está guardada: los certificados se dibujan cuando se pidan
+            # (el del correo, al enviarlo)
+            print(f"⚠️ Cola de emisión llena, la donación {donacion_id} se emitirá al pedirla")
+            liberar_correo_compra(conn, donacion_id)
+            conn.commit()
+            avisar_workers_correo()
+        print(f"📧 Correo {correo_id} encolado para: {data['email']}")
+        
+        url_estado = url_for('estado_donacion', donacion_id=donacion_id, formato_imagen=formato_imagen)
+        response = jsonify({
+            'donacion_id': donacion_id,
+            'folio': folio,
+            'certificados': len(certificados_generados),
+            'estado': 'procesando',
+            'url_estado': url_estado
+        })
+        response.status_code = 202
+        response.headers['Location'] = url_estado
+        
         # Agregar headers con info de la donación
         response.headers['X-Donacion-ID'] = str(donacion_id)
         response.headers['X-Folio'] = folio
         response.headers['X-Certificados'] = str(len(certificados_generados))
-        response.headers['X-Email-Enviado'] = 'true'
+        response.headers['X-Email-Enviado'] = 'encolado'
+        response.headers['X-Correo-ID'] = str(correo_id)
         
         return response
         
@@ -435,6 +2516,55 @@ def procesar_pago():
         return jsonify({"error": str(e)}), 500
 
 
+# ============================================
+# ESTADO DE LA EMISIÓN DE UNA DONACIÓN
+# ============================================
+
+@app.route("/api/donacion/<int:donacion_id>/estado", methods=['GET'])
+def estado_donacion(donacion_id):
+    """
+    Indica si los certificados de la donación ya están emitidos.
+    Con ?esperar=N (segundos) la respuesta espera hasta que lo estén (long-poll)
+    """
+    try:
+        esperar = min(max(float(request.args.get('esperar', 0)), 0), ESTADO_ESPERA_MAX)
+        formato_imagen = elegir_formato_imagen(request.args.get('formato_imagen'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    try:
+        estado, error = esperar_emision(donacion_id, esperar)
+        if not estado:
+            return jsonify({"error": "Donación no encontrada"}), 404
+        
+        # Un certificado se descarga suelto; varios, en un ZIP (o un solo PDF)
+        if estado['certificados'] == 1:
+            url_descarga = url_for('get_certificado_by_id', detalle_id=estado['detalle_id'],
+                                   formato='download', formato_imagen=formato_imagen)
+        else:
+            url_descarga = url_for('get_certificados_donacion', donacion_id=donacion_id,
+                                   formato='pdf' if formato_imagen == 'pdf' else 'zip',
+                                   formato_imagen=formato_imagen)
+        
+        lista = estado['listos'] >= estado['certificados']
+        respuesta = jsonify({
+            'donacion_id': donacion_id,
+            'folio': estado['folio'],
+            'estado': 'lista' if lista else ('error' if error else 'procesando'),
+            'error': error,
+            'certificados': estado['certificados'],
+            'listos': estado['listos'],
+            'url_descarga': url_descarga,
+            'url_certificados': url_for('get_certificados_donacion', donacion_id=donacion_id)
+        })
+        if not lista and not error:
+            respuesta.headers['Retry-After'] = '1'
+        return respuesta
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 # ============================================
 # RUTA PARA REGENERAR CERTIFICADO POR ID
 # ============================================
@@ -447,97 +2577,67 @@ def get_certificado_by_id(detalle_id):
     """
     try:
         conn = get_db()
-        cursor = conn.cursor()
         
         # Obtener datos completos incluyendo imagen_url
-        cursor.execute("""
-            SELECT 
-                d.nombre_titular,
-                d.email,
-                d.fecha,
-                d.folio as folio_donacion,
-                dd.nombre_beneficiario,
-                dd.mensaje_personalizado as mensaje,
-                dd.nombre_certificado,
-                dd.cantidad,
-                dd.precio_unitario,
-                dd.certificado_id,
-                dd.folio_certificado,
-                cg.id as cert_gen_id,
-                cg.veces_descargado,
-                c.imagen_url
-            FROM donacion_detalles dd
-            JOIN donaciones d ON dd.donacion_id = d.id
-            LEFT JOIN certificados c ON dd.certificado_id = c.id
-            LEFT JOIN certificados_generados cg ON dd.id = cg.donacion_detalle_id
-            WHERE dd.id = ?
-        """, (detalle_id,))
-        
-        detalle = cursor.fetchone()
+        detalle, datos_certificado = obtener_datos_certificado(conn, detalle_id)
         
         if not detalle:
             return jsonify({"error": "Certificado no encontrado"}), 404
         
-        # Actualizar contador de descargas
-        if detalle['cert_gen_id']:
-            cursor.execute("""
-                UPDATE certificados_generados 
-                SET veces_descargado = veces_descargado + 1,
-                    ultima_descarga = datetime('now', 'localtime')
-                WHERE id = ?
-            """, (detalle['cert_gen_id'],))
-            conn.commit()
-        
-        # Formatear fecha
-        fecha_donacion = datetime.strptime(detalle['fecha'], '%Y-%m-%d %H:%M:%S')
-        fecha_formateada = fecha_donacion.strftime("%d de %B, %Y")
-        
-        # Determinar plantilla a usar
-        nombre_plantilla = 'plantilla_default.jpg'
-        if detalle['imagen_url']:
-            nombre_plantilla = detalle['imagen_url']
-        elif detalle['certificado_id']:
-            nombre_plantilla = f"plantilla_{detalle['certificado_id']}.jpg"
-        
-        # Preparar datos para regenerar
-        datos_certificado = {
-            'nombre_titular': detalle['nombre_titular'],
-            'nombre_beneficiario': detalle['nombre_beneficiario'] or detalle['nombre_titular'],
-            'email': detalle['email'],
-            'mensaje': detalle['mensaje'] or '',
-            'certificado_nombre': detalle['nombre_certificado'],
-            'cantidad': detalle['cantidad'],
-            'monto': detalle['cantidad'] * detalle['precio_unitario'],
-            'fecha': fecha_formateada,
-            'folio': detalle['folio_certificado'] or detalle['folio_donacion'],
-            'plantilla': nombre_plantilla
-        }
-        
         # Determinar el formato de respuesta
         formato = request.args.get('formato', 'view')
         
+        if formato == 'json':
+            return jsonify(datos_certificado), 200
+        
+        # PNG, JPEG, WebP o PDF según formato_imagen o el header Accept
+        # (las miniaturas salen en JPEG si el cliente no pide otro)
+        ancho = ancho_miniatura(request.args.get('w')) if formato == 'thumb' else None
+        try:
+            formato_imagen = elegir_formato_imagen(request.args.get('formato_imagen'),
+                                                   defecto='jpeg' if ancho else 'png')
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if ancho and formato_imagen == 'pdf':
+            return jsonify({"error": "Las miniaturas no se generan en PDF"}), 400
+        mimetype = FORMATOS_IMAGEN[formato_imagen]['mimetype']
+        
+        # El ETag es el hash del contenido: si el navegador ya lo tiene,
+        # se responde 304 sin abrir la imagen
+        clave = clave_certificado(datos_certificado)
+        etag = f"{clave}-{formato_imagen}" + (f"-w{ancho}" if ancho else "")
+        if request.if_none_match.contains(etag):
+            return respuesta_no_modificado(etag)
+        
+        if formato_imagen == 'png' and not ancho and detalle['cert_gen_id']:
+            # El PNG emitido en la compra (se vuelve a dibujar sólo si cambió la plantilla)
+            ruta = emitir_certificados(conn, [(detalle, datos_certificado)])[0]
+        else:
+            ruta = obtener_certificado_cacheado(datos_certificado, clave=clave, formato=formato_imagen, ancho=ancho)
+        if not ruta:
+            return jsonify({"error": "Error al generar el certificado"}), 500
+        
         if formato == 'download':
             # Forzar descarga
-            img_bytes = generar_imagen_certificado(datos_certificado)
-            if not img_bytes:
-                return jsonify({"error": "Error al generar el certificado"}), 500
-            
-            nombre_archivo = f"certificado_{datos_certificado['nombre_beneficiario'].replace(' ', '_')}.png"
-            return send_file(
-                img_bytes,
+            nombre_archivo = (f"certificado_{datos_certificado['nombre_beneficiario'].replace(' ', '_')}"
+                              f".{FORMATOS_IMAGEN[formato_imagen]['extension']}")
+            respuesta = send_file(
+                ruta,
                 as_attachment=True,
                 download_name=nombre_archivo,
-                mimetype='image/png'
+                mimetype=mimetype,
+                etag=etag
             )
-        elif formato == 'json':
-            return jsonify(datos_certificado), 200
         else:
             # Ver en navegador
-            img_bytes = generar_imagen_certificado(datos_certificado)
-            if not img_bytes:
-                return jsonify({"error": "Error al generar el certificado"}), 500
-            
-            return send_file(img_bytes, mimetype='image/png')
+            respuesta = send_file(ruta, mimetype=mimetype, etag=etag)
+        
+        # Sólo cuenta como descarga si se mandó la imagen completa (no un 304
+        # ni la miniatura); se guarda en segundo plano
+        if detalle['cert_gen_id'] and formato != 'thumb' and respuesta.status_code == 200:
+            registrar_descarga(detalle['cert_gen_id'])
+        
+        return agregar_cabeceras_cache(respuesta, etag)
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -549,13 +2649,55 @@ def get_certificado_by_id(detalle_id):
 @app.route("/api/donacion/<int:donacion_id>/certificados", methods=['GET'])
 def get_certificados_donacion(donacion_id):
     """
-    Lista todos los certificados de una donación
+    Lista los certificados de una donación, por páginas (?limit=&after=).
+    Con ?formato=zip o ?formato=pdf descarga todos en un archivo
     """
     try:
         conn = get_db()
         cursor = conn.cursor()
         
-        cursor.execute("""
+        if request.args.get('formato') == 'pdf':
+            # Todos los certificados en un solo PDF, una página por certificado
+            emisiones = [obtener_datos_certificado(conn, fila['id']) for fila in cursor.execute("""
+                SELECT id FROM donacion_detalles WHERE donacion_id = ? ORDER BY id
+            """, (donacion_id,)).fetchall()]
+            if not emisiones:
+                return jsonify({"error": "Donación no encontrada"}), 404
+            if all(fila['cert_gen_id'] for fila, _ in emisiones):
+                pdf_bytes = pdf_de_archivos(emitir_certificados(conn, emisiones))
+            else:
+                pdf_bytes = generar_pdf_certificados([datos for _, datos in emisiones])
+            return send_file(
+                io.BytesIO(pdf_bytes),
+                as_attachment=True,
+                download_name=f"certificados_{emisiones[0][0]['folio_donacion']}.pdf",
+                mimetype=FORMATOS_IMAGEN['pdf']['mimetype']
+            )
+        
+        if request.args.get('formato') == 'zip':
+            # El ZIP siempre lleva todos los certificados
+            try:
+                formato_imagen = elegir_formato_imagen(request.args.get('formato_imagen'))
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            detalle_ids = [fila['id'] for fila in cursor.execute("""
+                SELECT id FROM donacion_detalles WHERE donacion_id = ? ORDER BY id
+            """, (donacion_id,))]
+            if not detalle_ids:
+                return jsonify({"error": "Donación no encontrada"}), 404
+            return respuesta_zip_certificados(
+                detalle_ids,
+                f"certificados_donacion_{donacion_id}.zip",
+                formato_imagen
+            )
+        
+        try:
+            limite, despues = parametros_pagina(1)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        inicio_sql = time.perf_counter()
+        cursor.execute(f"""
             SELECT 
                 dd.id as detalle_id,
                 dd.nombre_certificado,
@@ -571,10 +2713,16 @@ def get_certificados_donacion(donacion_id):
             FROM donacion_detalles dd
             JOIN donaciones d ON dd.donacion_id = d.id
             LEFT JOIN certificados_generados cg ON dd.id = cg.donacion_detalle_id
-            WHERE dd.donacion_id = ?
-        """, (donacion_id,))
+            WHERE dd.donacion_id = ? {'AND dd.id > ?' if despues else ''}
+            ORDER BY dd.id
+            LIMIT ?
+        """, (donacion_id, *(despues or []), limite + 1))
         
         certificados = cursor.fetchall()
+        observar('donaciones_sql_segundos', time.perf_counter() - inicio_sql, grupo='donacion')
+        # Se pide una fila de más para saber si hay otra página
+        hay_mas = len(certificados) > limite
+        certificados = certificados[:limite]
         
         result = []
         for cert in certificados:
@@ -589,12 +2737,18 @@ def get_certificados_donacion(donacion_id):
                 'veces_descargado': cert['veces_descargado'] or 0,
                 'ultima_descarga': cert['ultima_descarga'],
                 'url_ver': f"/api/certificado/{cert['detalle_id']}",
-                'url_descargar': f"/api/certificado/{cert['detalle_id']}?formato=download"
+                'url_descargar': f"/api/certificado/{cert['detalle_id']}?formato=download",
+                'url_miniatura': f"/api/certificado/{cert['detalle_id']}?formato=thumb"
             })
         
+        siguiente = codificar_cursor([certificados[-1]['detalle_id']]) if hay_mas else None
+        
         return jsonify({
             'donacion_id': donacion_id,
-            'certificados': result
+            'certificados': result,
+            'siguiente': siguiente,
+            'url_siguiente': url_for('get_certificados_donacion', donacion_id=donacion_id, limit=limite, after=siguiente) if siguiente else None,
+            'url_zip': url_for('get_certificados_donacion', donacion_id=donacion_id, formato='zip')
         }), 200
         
     except Exception as e:
@@ -604,16 +2758,45 @@ def get_certificados_donacion(donacion_id):
 # RUTA PARA BUSCAR CERTIFICADOS POR EMAIL
 # ============================================
 
-@app.route("/api/mis-certificados/<string:email>", methods=['GET'])
+@app.route("/api/mis-certificados/<path:email>", methods=['GET'])
 def mis_certificados(email):
     """
-    Devuelve todos los certificados de un email
+    Devuelve los certificados de un email, del más reciente al más antiguo,
+    por páginas (?limit=&after=)
     """
     try:
         conn = get_db()
         cursor = conn.cursor()
         
-        cursor.execute("""
+        if request.args.get('formato') == 'zip':
+            # El ZIP siempre lleva todos los certificados
+            try:
+                formato_imagen = elegir_formato_imagen(request.args.get('formato_imagen'))
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            detalle_ids = [fila['id'] for fila in cursor.execute("""
+                SELECT dd.id
+                FROM donaciones d
+                JOIN donacion_detalles dd ON d.id = dd.donacion_id
+                WHERE d.email = ?
+                ORDER BY d.fecha DESC, d.id DESC, dd.id DESC
+            """, (email,))]
+            if not detalle_ids:
+                return jsonify({"error": "No se encontraron certificados"}), 404
+            return respuesta_zip_certificados(
+                detalle_ids,
+                f"certificados_{email}.zip",
+                formato_imagen
+            )
+        
+        try:
+            limite, despues = parametros_pagina(3)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # El cursor es (fecha, donacion_id, detalle_id) de la última fila entregada
+        inicio_sql = time.perf_counter()
+        cursor.execute(f"""
             SELECT 
                 d.id as donacion_id,
                 d.fecha,
@@ -630,11 +2813,16 @@ def mis_certificados(email):
             FROM donaciones d
             JOIN donacion_detalles dd ON d.id = dd.donacion_id
             LEFT JOIN certificados_generados cg ON dd.id = cg.donacion_detalle_id
-            WHERE d.email = ?
-            ORDER BY d.fecha DESC
-        """, (email,))
+            WHERE d.email = ? {'AND (d.fecha, d.id, dd.id) < (?, ?, ?)' if despues else ''}
+            ORDER BY d.fecha DESC, d.id DESC, dd.id DESC
+            LIMIT ?
+        """, (email, *(despues or []), limite + 1))
         
         certificados = cursor.fetchall()
+        observar('donaciones_sql_segundos', time.perf_counter() - inicio_sql, grupo='mis_certificados')
+        # Se pide una fila de más para saber si hay otra página
+        hay_mas = len(certificados) > limite
+        certificados = certificados[:limite]
         
         result = []
         for cert in certificados:
@@ -649,14 +2837,31 @@ def mis_certificados(email):
                 'nombre_beneficiario': cert['nombre_beneficiario'] or 'No especificado',
                 'veces_descargado': cert['veces_descargado'] or 0,
                 'url_ver': f"/api/certificado/{cert['detalle_id']}",
-                'url_descargar': f"/api/certificado/{cert['detalle_id']}?formato=download"
+                'url_descargar': f"/api/certificado/{cert['detalle_id']}?formato=download",
+                'url_miniatura': f"/api/certificado/{cert['detalle_id']}?formato=thumb"
             })
         
-        return jsonify({
+        siguiente = None
+        if hay_mas:
+            ultimo = certificados[-1]
+            siguiente = codificar_cursor([ultimo['fecha'], ultimo['donacion_id'], ultimo['detalle_id']])
+        
+        respuesta = {
             'email': email,
-            'total_certificados': len(result),
-            'certificados': result
-        }), 200
+            'certificados': result,
+            'siguiente': siguiente,
+            'url_siguiente': url_for('mis_certificados', email=email, limit=limite, after=siguiente) if siguiente else None,
+            'url_zip': url_for('mis_certificados', email=email, formato='zip')
+        }
+        if not despues:
+            # El total sólo se cuenta en la primera página
+            respuesta['total_certificados'] = cursor.execute("""
+                SELECT COUNT(*) FROM donaciones d
+                JOIN donacion_detalles dd ON d.id = dd.donacion_id
+                WHERE d.email = ?
+            """, (email,)).fetchone()[0]
+        
+        return jsonify(respuesta), 200
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -667,94 +2872,227 @@ def mis_certificados(email):
 
 @app.route("/api/reenviar-certificado/<int:detalle_id>", methods=['POST'])
 def reenviar_certificado(detalle_id):
-    """Reenvía un certificado por email"""
+    """Encola el reenvío de un certificado por email"""
     try:
         conn = get_db()
         cursor = conn.cursor()
         
         # Obtener datos del certificado
-        cursor.execute("""
-            SELECT 
-                d.email,
-                d.nombre_titular,
-                dd.nombre_beneficiario,
-                dd.folio_certificado,
-                dd.nombre_certificado,
-                dd.cantidad,
-                dd.precio_unitario,
-                dd.mensaje_personalizado,
-                d.fecha,
-                c.imagen_url
-            FROM donacion_detalles dd
-            JOIN donaciones d ON dd.donacion_id = d.id
-            LEFT JOIN certificados c ON dd.certificado_id = c.id
-            WHERE dd.id = ?
-        """, (detalle_id,))
-        
-        detalle = cursor.fetchone()
+        detalle, datos_certificado = obtener_datos_certificado(conn, detalle_id)
         
         if not detalle:
             return jsonify({"error": "Certificado no encontrado"}), 404
         
-        # Formatear fecha
-        fecha_donacion = datetime.strptime(detalle['fecha'], '%Y-%m-%d %H:%M:%S')
-        fecha_formateada = fecha_donacion.strftime("%d de %B, %Y")
-        
-        # Determinar plantilla
-        nombre_plantilla = 'plantilla_default.jpg'
-        if detalle['imagen_url']:
-            nombre_plantilla = detalle['imagen_url']
-        
-        # Preparar datos para regenerar
-        datos_certificado = {
-            'nombre_titular': detalle['nombre_titular'],
-            'nombre_beneficiario': detalle['nombre_beneficiario'] or detalle['nombre_titular'],
-            'email': detalle['email'],
-            'mensaje': detalle['mensaje_personalizado'] or '',
-            'certificado_nombre': detalle['nombre_certificado'],
-            'cantidad': detalle['cantidad'],
-            'monto': detalle['cantidad'] * detalle['precio_unitario'],
-            'fecha': fecha_formateada,
-            'folio': detalle['folio_certificado'],
-            'plantilla': nombre_plantilla
-        }
-        
-        # Generar imagen
-        img_bytes = generar_imagen_certificado(datos_certificado)
-        
-        if not img_bytes:
-            return jsonify({"error": "Error al generar certificado"}), 500
+        # Opcional: {"formato_imagen": "pdf"} para el adjunto
+        formato_imagen = (request.get_json(silent=True) or {}).get('formato_imagen')
+        if formato_imagen:
+            try:
+                formato_imagen = elegir_formato_imagen(formato_imagen)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
         
-        # Enviar por email
-        enviado = enviar_certificado_email(
+        correo_id = encolar_correo(
+            cursor,
             email_destino=detalle['email'],
-            nombre_beneficiario=datos_certificado['nombre_beneficiario'],
+            nombre_destinatario=datos_certificado['nombre_beneficiario'],
             folio=detalle['folio_certificado'],
-            img_bytes=img_bytes
+            detalle_id=detalle_id,
+            formato_imagen=formato_imagen
         )
+        conn.commit()
+        avisar_workers_correo()
         
-        if enviado:
-            # Actualizar contador de veces_descargado (opcional)
-            cursor.execute("""
-                UPDATE certificados_generados 
-                SET veces_descargado = veces_descargado + 1,
-                    ultima_descarga = datetime('now', 'localtime')
-                WHERE donacion_detalle_id = ?
-            """, (detalle_id,))
-            conn.commit()
-            
-            return jsonify({
-                "success": True, 
-                "message": "Certificado reenviado correctamente"
-            }), 200
-        else:
-            return jsonify({
-                "error": "Error al enviar el email"
-            }), 500
+        return jsonify({
+            "success": True, 
+            "message": "Certificado en cola de envío",
+            "correo_id": correo_id,
+            "url_estado": f"/api/correos/{correo_id}"
+        }), 202
             
     except Exception as e:
         print(f"Error reenviando certificado: {e}")
         return jsonify({"error": str(e)}), 500
+
+@app.route("/api/correos/<int:correo_id>", methods=['GET'])
+def get_estado_correo(correo_id):
+    """Estado de un correo de la cola"""
+    try:
+        conn = get_db()
+        correo = conn.execute("""
+            SELECT id, email_destino, folio, formato_imagen, estado, intentos, ultimo_error, created_at, enviado_at
+            FROM cola_correos WHERE id = ?
+        """, (correo_id,)).fetchone()
+        
+        if not correo:
+            return jsonify({"error": "Correo no encontrado"}), 404
+        
+        return jsonify(dict(correo)), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# ============================================
+# CONSULTAS DE ESTADÍSTICAS POR VENTANA DE TIEMPO
+# ============================================
+# Toda ventana de tiempo se expresa como rango semiabierto [inicio, fin)
+# sobre una columna indexada (dia o fecha), nunca como DATE(fecha) = ...
+# o strftime(...) = ..., que obligan a recorrer la tabla entera.
+# Todas las consultas de estadísticas están en CONSULTAS_ESTADISTICAS para
+# que revisar_planes_estadisticas() compruebe su plan con EXPLAIN.
+
+AGRUPACIONES_SERIE = {
+    'dia': "dia",
+    'semana': "DATE(dia, '-6 days', 'weekday 1')",  # Lunes de esa semana
+    'mes': "strftime('%Y-%m-01', dia)",
+}
+
+# Tablas que crecen con el historial: ninguna consulta de estadísticas debe recorrerlas.
+# Sólo se aceptan búsquedas acotadas por un rango de fechas o por igualdad en
+# la llave primaria o el email; (estado=?) sigue leyendo todo el historial
+TABLAS_HISTORIAL = {'donaciones', 'donacion_detalles', 'certificados_generados'}
+COLUMNAS_RANGO_HISTORIAL = {'fecha', 'dia', 'fecha_generacion'}
+COLUMNAS_IGUALDAD_HISTORIAL = {'rowid', 'id', 'email', 'email_donante'}
+
+CONSULTAS_ESTADISTICAS = {
+    'totales': ("""
+        SELECT 
+            COALESCE(SUM(donaciones), 0) as donaciones,
+            COALESCE(SUM(monto), 0) as monto
+        FROM estadisticas_diarias
+    """, ()),
+    'ventana': ("""
+        SELECT 
+            COALESCE(SUM(donaciones), 0) as donaciones,
+            COALESCE(SUM(monto), 0) as monto
+        FROM estadisticas_diarias 
+        WHERE dia >= ? AND dia < ?
+    """, ('2024-01-01', '2024-02-01')),
+    'top_certificados': ("""
+        SELECT nombre_certificado, total_vendidos, total_recaudado
+        FROM estadisticas_certificados
+        WHERE total_vendidos > 0
+        ORDER BY total_recaudado DESC
+        LIMIT 5
+    """, ()),
+    'globales': ("SELECT clave, valor FROM estadisticas_globales", ()),
+    'vista_diaria': ("SELECT * FROM v_estadisticas_diarias WHERE dia >= ? AND dia < ?", ('2024-01-01', '2024-02-01')),
+    'vista_top_donantes': ("SELECT * FROM v_top_donantes LIMIT 10", ()),
+}
+for _agrupar, _expresion in AGRUPACIONES_SERIE.items():
+    CONSULTAS_ESTADISTICAS[f'serie_{_agrupar}'] = (f"""
+        SELECT {_expresion} as periodo, SUM(donaciones) as donaciones, SUM(monto) as monto
+        FROM estadisticas_diarias
+        WHERE dia >= ? AND dia < ?
+        GROUP BY periodo
+        ORDER BY periodo
+    """, ('2024-01-01', '2024-02-01'))
+
+
+def ventana_tiempo(periodo=None, desde=None, hasta=None, hoy=None):
+    """
+    Devuelve (inicio, fin) como 'YYYY-MM-DD', con fin exclusivo.
+    periodo: 'hoy', 'semana', 'mes' o 'anio'; o bien desde/hasta (YYYY-MM-DD, hasta inclusive).
+    Lanza ValueError si los parámetros no son válidos
+    """
+    hoy = hoy or datetime.now().date()
+    if desde or hasta:
+        inicio = datetime.strptime(desde, '%Y-%m-%d').date() if desde else datetime(2000, 1, 1).date()
+        fin = datetime.strptime(hasta, '%Y-%m-%d').date() + timedelta(days=1) if hasta else hoy + timedelta(days=1)
+        if fin <= inicio:
+            raise ValueError("'hasta' debe ser igual o posterior a 'desde'")
+    elif periodo in (None, 'hoy'):
+        inicio, fin = hoy, hoy + timedelta(days=1)
+    elif periodo == 'semana':
+        inicio = hoy - timedelta(days=hoy.weekday())
+        fin = inicio + timedelta(days=7)
+    elif periodo == 'mes':
+        inicio = hoy.replace(day=1)
+        fin = (inicio + timedelta(days=32)).replace(day=1)
+    elif periodo == 'anio':
+        inicio = hoy.replace(month=1, day=1)
+        fin = inicio.replace(year=inicio.year + 1)
+    else:
+        raise ValueError("periodo debe ser 'hoy', 'semana', 'mes' o 'anio'")
+    return inicio.isoformat(), fin.isoformat()
+
+
+def _linea_plan(linea, alias, indices):
+    """
+    (tabla, restricciones) de una línea 'SCAN|SEARCH x [USING ... INDEX idx] [(a=? AND b>?)]'
+    del plan, o None si la línea no lee una tabla
+    """
+    coincidencia = re.match(r'(?:SCAN|SEARCH) (\w+)(?: AS \w+)?(?: USING (.*?))?(?: \((.*)\))?$', linea)
+    if not coincidencia:
+        return None
+    nombre, uso, restricciones = coincidencia.groups()
+    indice = re.search(r'INDEX (\w+)', uso or '')
+    tabla = indices.get(indice.group(1)) if indice else None
+    return tabla or alias.get(nombre, nombre), restricciones or ''
+
+
+def _busqueda_acotada(restricciones):
+    """True si las restricciones del índice incluyen un rango de fechas o una igualdad en llave o email"""
+    for restriccion in restricciones.split(' AND '):
+        coincidencia = re.match(r'(\w+)([<>=]+)', restriccion.strip())
+        if not coincidencia:
+            continue
+        columna, operador = coincidencia.groups()
+        if columna in COLUMNAS_RANGO_HISTORIAL:
+            return True
+        if columna in COLUMNAS_IGUALDAD_HISTORIAL and operador == '=':
+            return True
+    return False
+
+
+def revisar_planes_estadisticas(conn):
+    """
+    Corre EXPLAIN QUERY PLAN sobre cada consulta de estadísticas.
+    Devuelve {nombre: {'plan': [...], 'ok': bool}}; no está ok si lee una tabla
+    del historial sin acotarla (ver _busqueda_acotada).
+    El plan nombra las tablas por su alias (SCAN d), así que se buscan los
+    alias en la consulta y en las vistas, y los índices en sqlite_master
+    """
+    resultado = {}
+    for nombre, (sql, parametros) in CONSULTAS_ESTADISTICAS.items():
+        plan = planear_consulta(conn, sql, parametros)
+        resultado[nombre] = {'plan': plan, 'ok': plan_acotado(conn, sql, plan)}
+    return resultado
+
+
+def planear_consulta(conn, sql, parametros=()):
+    """Líneas de EXPLAIN QUERY PLAN de una consulta"""
+    return [fila['detail'] for fila in conn.execute(f"EXPLAIN QUERY PLAN {sql}", parametros)]
+
+
+def plan_acotado(conn, sql, plan):
+    """True si ninguna línea del plan lee una tabla del historial sin acotarla"""
+    indices = dict(conn.execute("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'").fetchall())
+    vistas = [fila[0] for fila in conn.execute("SELECT sql FROM sqlite_master WHERE type = 'view'")]
+    alias = {
+        alias_tabla: tabla
+        for texto in [sql] + vistas
+        for tabla, alias_tabla in re.findall(r'\b(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?(\w+)', texto, re.IGNORECASE)
+    }
+    for linea in plan:
+        leida = _linea_plan(linea, alias, indices)
+        if leida and leida[0] in TABLAS_HISTORIAL and not _busqueda_acotada(leida[1]):
+            return False
+    return True
+
+
+@app.cli.command('revisar-planes')
+def revisar_planes_comando():
+    """Falla si alguna consulta de estadísticas recorre una tabla completa del historial"""
+    conn = abrir_conexion()
+    try:
+        planes = revisar_planes_estadisticas(conn)
+    finally:
+        conn.close()
+    for nombre, revision in planes.items():
+        print(f"{'✅' if revision['ok'] else '❌'} {nombre}: {' | '.join(revision['plan'])}")
+    if not all(revision['ok'] for revision in planes.values()):
+        raise SystemExit(1)
+
+
 # ============================================
 # RUTA PARA ESTADÍSTICAS
 # ============================================
@@ -766,59 +3104,22 @@ def get_estadisticas():
         conn = get_db()
         cursor = conn.cursor()
         
-        # Totales generales
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as total_donaciones,
-                COALESCE(SUM(total), 0) as monto_total,
-                COALESCE(AVG(total), 0) as promedio_donacion
-            FROM donaciones 
-            WHERE estado = 'completada'
-        """)
-        totales = cursor.fetchone()
+        # Todo sale de las tablas de estadísticas acumuladas (ver ESQUEMA_ESTADISTICAS)
         
-        # Donaciones hoy
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as donaciones_hoy,
-                COALESCE(SUM(total), 0) as monto_hoy
-            FROM donaciones 
-            WHERE DATE(fecha) = DATE('now', 'localtime')
-            AND estado = 'completada'
-        """)
-        hoy = cursor.fetchone()
+        # Totales generales
+        inicio_sql = time.perf_counter()
+        totales = cursor.execute(CONSULTAS_ESTADISTICAS['totales'][0]).fetchone()
         
-        # Donaciones este mes
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as donaciones_mes,
-                COALESCE(SUM(total), 0) as monto_mes
-            FROM donaciones 
-            WHERE strftime('%Y-%m', fecha) = strftime('%Y-%m', 'now', 'localtime')
-            AND estado = 'completada'
-        """)
-        mes = cursor.fetchone()
+        # Donaciones hoy y este mes
+        hoy = cursor.execute(CONSULTAS_ESTADISTICAS['ventana'][0], ventana_tiempo('hoy')).fetchone()
+        mes = cursor.execute(CONSULTAS_ESTADISTICAS['ventana'][0], ventana_tiempo('mes')).fetchone()
         
         # Top certificados
-        cursor.execute("""
-            SELECT 
-                nombre_certificado,
-                SUM(cantidad) as total_vendidos,
-                SUM(cantidad * precio_unitario) as total_recaudado
-            FROM donacion_detalles
-            GROUP BY nombre_certificado
-            ORDER BY total_recaudado DESC
-            LIMIT 5
-        """)
-        top = cursor.fetchall()
+        top = cursor.execute(CONSULTAS_ESTADISTICAS['top_certificados'][0]).fetchall()
         
-        # Total certificados generados
-        cursor.execute("SELECT COUNT(*) as total_gen FROM certificados_generados")
-        total_gen = cursor.fetchone()
-        
-        # Descargas totales
-        cursor.execute("SELECT COALESCE(SUM(veces_descargado), 0) as total_descargas FROM certificados_generados")
-        total_desc = cursor.fetchone()
+        # Certificados generados y descargas totales
+        globales = dict(cursor.execute(CONSULTAS_ESTADISTICAS['globales'][0]).fetchall())
+        observar('donaciones_sql_segundos', time.perf_counter() - inicio_sql, grupo='estadisticas')
         
         top_list = []
         for t in top:
@@ -830,29 +3131,69 @@ def get_estadisticas():
         
         result = {
             'totales': {
-                'donaciones': totales['total_donaciones'] or 0,
-                'monto': totales['monto_total'] or 0,
-                'promedio': round(totales['promedio_donacion'] or 0, 2)
+                'donaciones': totales['donaciones'],
+                'monto': totales['monto'],
+                'promedio': round(totales['monto'] / totales['donaciones'], 2) if totales['donaciones'] else 0
             },
             'hoy': {
-                'donaciones': hoy['donaciones_hoy'] or 0,
-                'monto': hoy['monto_hoy'] or 0
+                'donaciones': hoy['donaciones'],
+                'monto': hoy['monto']
             },
             'mes': {
-                'donaciones': mes['donaciones_mes'] or 0,
-                'monto': mes['monto_mes'] or 0
+                'donaciones': mes['donaciones'],
+                'monto': mes['monto']
             },
             'certificados': {
-                'generados': total_gen['total_gen'] or 0,
-                'descargas': total_desc['total_descargas'] or 0
+                'generados': globales.get('certificados_generados', 0),
+                'descargas': globales.get('descargas', 0)
             },
             'top_certificados': top_list
         }
         
+        # Ventana opcional: ?periodo=semana o ?desde=2026-02-01&hasta=2026-02-28
+        if any(request.args.get(param) for param in ('periodo', 'desde', 'hasta')):
+            try:
+                inicio, fin = ventana_tiempo(request.args.get('periodo'), request.args.get('desde'), request.args.get('hasta'))
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            ventana = cursor.execute(CONSULTAS_ESTADISTICAS['ventana'][0], (inicio, fin)).fetchone()
+            result['ventana'] = {'inicio': inicio, 'fin': fin, 'donaciones': ventana['donaciones'], 'monto': ventana['monto']}
+        
         return jsonify(result), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/estadisticas/serie", methods=['GET'])
+def get_serie_estadisticas():
+    """
+    Donaciones y monto agrupados por día, semana o mes.
+    ?agrupar=dia|semana|mes y la ventana con ?periodo= o ?desde=&hasta= (por defecto, el mes actual)
+    """
+    try:
+        agrupar = request.args.get('agrupar', 'dia')
+        if agrupar not in AGRUPACIONES_SERIE:
+            return jsonify({"error": f"agrupar debe ser uno de: {', '.join(AGRUPACIONES_SERIE)}"}), 400
+        try:
+            inicio, fin = ventana_tiempo(request.args.get('periodo', 'mes'), request.args.get('desde'), request.args.get('hasta'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        conn = get_db()
+        with medir('donaciones_sql_segundos', grupo='estadisticas'):
+            filas = conn.execute(CONSULTAS_ESTADISTICAS[f'serie_{agrupar}'][0], (inicio, fin)).fetchall()
+        
+        return jsonify({
+            'agrupar': agrupar,
+            'inicio': inicio,
+            'fin': fin,  # Exclusivo
+            'serie': [
+                {'periodo': fila['periodo'], 'donaciones': fila['donaciones'], 'monto': fila['monto']}
+                for fila in filas
+            ]
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 # ============================================
 # RUTA PARA TEST HTML
 # ============================================
@@ -907,17 +3248,42 @@ def check_database():
             LIMIT 5
         """).fetchall()
         
+        # Plan de las consultas de estadísticas (ninguna debe recorrer el historial)
+        planes = revisar_planes_estadisticas(conn)
+        
         return jsonify({
-            'status': 'ok',
+            'status': 'ok' if all(p['ok'] for p in planes.values()) else 'planes_con_escaneo',
             'timestamp': datetime.now().isoformat(),
             'tablas': tables,
-            'ultimas_donaciones': [dict(u) for u in ultimas]
+            'ultimas_donaciones': [dict(u) for u in ultimas],
+            'planes_estadisticas': planes
         }), 200
     except Exception as e:
         return jsonify({'error': str(e), 'status': 'error'}), 500
 
 
 
+# ============================================
+# MÉTRICAS PARA PROMETHEUS
+# ============================================
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """Métricas de este proceso en el formato de texto de Prometheus"""
+    medidores = {
+        ('donaciones_cola_render', ()): _cola_render.qsize(),
+        ('donaciones_plantillas_cache_bytes', ()): _plantillas_cache_bytes,
+        ('donaciones_descargas_pendientes', ()): len(_descargas_pendientes),
+        ('donaciones_conexiones_libres', ()): _pool_conexiones.qsize(),
+    }
+    try:
+        for estado, cantidad in get_db().execute("SELECT estado, COUNT(*) FROM cola_correos GROUP BY estado"):
+            medidores[('donaciones_cola_correos', (('estado', estado),))] = cantidad
+    except sqlite3.Error as e:
+        print(f"⚠️ No se pudo leer la cola de correos para /metrics: {e}")
+    return Response(exportar_metricas(medidores), mimetype='text/plain; version=0.0.4')
+
+
 # ============================================
 # RUTAS PRINCIPALES
 # ============================================
@@ -950,6 +3316,61 @@ def miscertificadosrender():
 
 
 
+# ============================================
+# PRECARGA ANTES DEL FORK
+# ============================================
+# Con un servidor de varios workers (gunicorn --preload) la app se importa
+# una vez en el proceso maestro y los workers se crean con fork. Lo que se
+# carga en el maestro queda en páginas compartidas entre todos los workers
+# (copy-on-write): catálogo, fuentes y plantillas decodificadas ocupan
+# memoria física una sola vez y el primer request de cada worker no paga
+# la carga. Pillow no vuelve a escribir los píxeles de la plantilla
+# (dibujar_certificado trabaja sobre una copia), así que esas páginas no se
+# duplican.
+# Antes del fork no debe quedar nada que no sobreviva a él: ni conexiones
+# a la BD ni hilos. Los workers de correo y de emisión, el contador de
+# descargas y el pool de procesos se arrancan en el primer request de cada
+# worker.
+#
+#     gunicorn --preload -w 4 -b 0.0.0.0:7070 'app:crear_app()'
+
+EXTENSIONES_PLANTILLA = ('.jpg', '.jpeg', '.png')
+
+
+def calentar():
+    """Carga catálogo, fuentes y todas las plantillas compiladas (tamaño completo y miniatura)"""
+    inicio = time.perf_counter()
+    obtener_catalogo()
+    # Los codificadores de Pillow (JPEG, WebP, PDF) se registran la primera vez que se usan
+    Image.init()
+
+    nombres = sorted(
+        nombre for nombre in os.listdir(TEMPLATES_FOLDER)
+        if nombre.lower().endswith(EXTENSIONES_PLANTILLA)
+    )
+    for nombre in nombres:
+        obtener_plantilla(nombre)
+        obtener_plantilla(nombre, MINIATURA_ANCHO)
+
+    # Ninguna conexión del maestro debe llegar a los workers
+    cerrar_conexiones()
+
+    # Que el recolector de basura de cada worker no toque los objetos ya
+    # cargados (escribir en sus cabeceras copiaría las páginas compartidas)
+    gc.collect()
+    gc.freeze()
+
+    print(f"🔥 Precarga: {len(nombres)} plantillas ({_plantillas_cache_bytes / (1024 * 1024):.0f} MB) "
+          f"en {time.perf_counter() - inicio:.2f}s")
+
+
+def crear_app(precargar=True):
+    """Devuelve la app lista para servir; con precargar hace el calentamiento antes de crear los workers"""
+    if precargar:
+        calentar()
+    return app
+
+
 # ============================================
 # INICIO DEL SERVIDOR
 # ============================================
@@ -963,4 +3384,4 @@ if __name__ == '__main__':
     print(f"📁 Certificados: {UPLOAD_FOLDER}")
     print("="*60)
     
-    app.run(debug=True, host='0.0.0.0', port=7070)
\ No newline at end of file
+    crear_app().run(debug=True, host='0.0.0.0', port=7070)
\ No newline at end of file
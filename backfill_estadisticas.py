@@ -0,0 +1,99 @@
+"""
+Recalcula las tablas de estadísticas acumuladas (estadisticas_diarias,
+estadisticas_certificados, estadisticas_globales y estadisticas_donantes)
+a partir de las donaciones guardadas.
+
+La aplicación las llena sola la primera vez que arranca y los triggers
+las mantienen al día; este script sirve si se cargaron datos con los
+triggers desactivados, se editó la BD a mano o para revisar que cuadren.
+
+Ejemplos:
+    python backfill_estadisticas.py
+    python backfill_estadisticas.py --verificar
+"""
+import argparse
+import sys
+
+import app
+
+
+def comparar(conn):
+    """Diferencias entre las estadísticas acumuladas y las calculadas en vivo"""
+    diferencias = []
+
+    en_vivo = {fila[0]: (fila[1], fila[2]) for fila in conn.execute("""
+        SELECT DATE(fecha), COUNT(*), SUM(total) FROM donaciones
+        WHERE estado = 'completada' GROUP BY DATE(fecha)
+    """)}
+    acumulado = {fila[0]: (fila[1], fila[2]) for fila in conn.execute("""
+        SELECT dia, donaciones, monto FROM estadisticas_diarias WHERE donaciones <> 0 OR monto <> 0
+    """)}
+    for dia in sorted(set(en_vivo) | set(acumulado)):
+        esperado, actual = en_vivo.get(dia, (0, 0)), acumulado.get(dia, (0, 0))
+        if esperado[0] != actual[0] or abs(esperado[1] - actual[1]) > 0.005:
+            diferencias.append(f"día {dia}: esperado {esperado}, acumulado {actual}")
+
+    en_vivo = {fila[0]: (fila[1], fila[2]) for fila in conn.execute("""
+        SELECT nombre_certificado, SUM(cantidad), SUM(cantidad * precio_unitario)
+        FROM donacion_detalles GROUP BY nombre_certificado
+    """)}
+    acumulado = {fila[0]: (fila[1], fila[2]) for fila in conn.execute("""
+        SELECT nombre_certificado, total_vendidos, total_recaudado FROM estadisticas_certificados
+        WHERE total_vendidos <> 0 OR total_recaudado <> 0
+    """)}
+    for nombre in sorted(set(en_vivo) | set(acumulado)):
+        esperado, actual = en_vivo.get(nombre, (0, 0)), acumulado.get(nombre, (0, 0))
+        if esperado[0] != actual[0] or abs(esperado[1] - actual[1]) > 0.005:
+            diferencias.append(f"certificado {nombre}: esperado {esperado}, acumulado {actual}")
+
+    en_vivo = {fila[0]: (fila[1], fila[2]) for fila in conn.execute("""
+        SELECT email, COUNT(*), SUM(total) FROM donaciones
+        WHERE estado = 'completada' GROUP BY email
+    """)}
+    acumulado = {fila[0]: (fila[1], fila[2]) for fila in conn.execute("""
+        SELECT email, donaciones, monto FROM estadisticas_donantes WHERE donaciones <> 0 OR monto <> 0
+    """)}
+    for email in sorted(set(en_vivo) | set(acumulado)):
+        esperado, actual = en_vivo.get(email, (0, 0)), acumulado.get(email, (0, 0))
+        if esperado[0] != actual[0] or abs(esperado[1] - actual[1]) > 0.005:
+            diferencias.append(f"donante {email}: esperado {esperado}, acumulado {actual}")
+
+    esperado = tuple(conn.execute("""
+        SELECT COUNT(*), COALESCE(SUM(veces_descargado), 0) FROM certificados_generados
+    """).fetchone())
+    globales = dict(conn.execute("SELECT clave, valor FROM estadisticas_globales").fetchall())
+    actual = (globales.get('certificados_generados', 0), globales.get('descargas', 0))
+    if esperado != actual:
+        diferencias.append(f"generados/descargas: esperado {esperado}, acumulado {actual}")
+
+    return diferencias
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recalcula las estadísticas acumuladas")
+    parser.add_argument('--verificar', action='store_true',
+                        help="Sólo compara contra los datos en vivo, sin modificar nada")
+    args = parser.parse_args(argv)
+
+    conn = app.abrir_conexion()
+    try:
+        if args.verificar:
+            diferencias = comparar(conn)
+            for diferencia in diferencias:
+                print(f"❌ {diferencia}")
+            if not diferencias:
+                print("✅ Las estadísticas acumuladas cuadran con los datos")
+            return 1 if diferencias else 0
+
+        app.reconstruir_estadisticas(conn)
+        dias = conn.execute("SELECT COUNT(*) FROM estadisticas_diarias").fetchone()[0]
+        certificados = conn.execute("SELECT COUNT(*) FROM estadisticas_certificados").fetchone()[0]
+        donantes = conn.execute("SELECT COUNT(*) FROM estadisticas_donantes").fetchone()[0]
+        print(f"✅ Estadísticas recalculadas: {dias} días, {certificados} certificados, {donantes} donantes")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
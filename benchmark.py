@@ -0,0 +1,864 @@
+"""
+Mediciones de rendimiento de la aplicación.
+
+Cada medición es un subcomando:
+    render       Certificados por segundo de generar_imagen_certificado con
+                 cada plantilla de plantillas/, con mensaje corto y largo.
+    compra       /api/procesar-pago con 1, 10 y 50 items (test client sobre
+                 una copia temporal de la BD): tiempo de respuesta y tiempo
+                 hasta que la emisión está lista.
+    lecturas     Endpoints de lectura con la BD poblada a un tamaño
+                 realista (copia temporal).
+    suite        render, compra y lecturas seguidos, en un solo JSON.
+    comparar     Compara dos JSON de resultados y falla si algo empeoró
+                 más de la tolerancia.
+    formatos     Tamaño y tiempo de codificación de un certificado en cada
+                 formato de salida (PNG, JPEG, WebP y PDF), incluyendo lo que
+                 pesa en base64 como adjunto de Mailjet.
+    concurrencia Compras escribiendo mientras otros hilos leen
+                 /api/estadisticas y /api/mis-certificados, con la BD en modo
+                 rollback journal (DELETE) y en WAL. Trabaja sobre copias
+                 temporales de la BD.
+    memoria      Memoria de cada worker (RSS, PSS y privada) y latencia de
+                 su primer request, con y sin la precarga de crear_app()
+                 antes del fork, como en gunicorn --preload. Sólo Linux.
+
+Todos los resultados guardados con --json llevan la fecha, el commit y las
+versiones de Python y Pillow, para poder comparar corridas.
+
+Ejemplos:
+    python benchmark.py suite --json base.json
+    python benchmark.py suite --json nuevo.json
+    python benchmark.py comparar base.json nuevo.json --tolerancia 15
+    python benchmark.py render --segundos 5
+    python benchmark.py lecturas --donaciones 500000
+    python benchmark.py formatos
+    python benchmark.py formatos --plantilla plantilla_1.jpg --repeticiones 10
+    python benchmark.py formatos --json resultados_formatos.json
+    python benchmark.py concurrencia --segundos 10 --lectores 8
+    python benchmark.py memoria --workers 4
+"""
+import argparse
+import atexit
+import base64
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.request import pathname2url
+
+import PIL
+
+
+def copiar_bd(origen, destino):
+    """Copia consistente de una BD SQLite (incluye lo que esté en el WAL), sin escribir en el origen"""
+    fuente = sqlite3.connect(f"file:{pathname2url(os.path.abspath(origen))}?mode=ro", uri=True)
+    copia = sqlite3.connect(destino)
+    try:
+        fuente.backup(copia)
+    finally:
+        copia.close()
+        fuente.close()
+
+
+# Importar app migra la BD (inicializar_esquema), así que se importa
+# apuntando a una copia temporal: la BD real no se modifica ni le quedan
+# archivos -wal/-shm. Las mediciones copian a su vez esta copia.
+BD_ORIGEN = os.getenv('DATABASE_PATH', 'data/sys-donaciones/sys-donaciones')
+_CARPETA_BD = tempfile.mkdtemp(prefix='bench_bd_')
+_PID_BD = os.getpid()
+os.environ['DATABASE_PATH'] = os.path.join(_CARPETA_BD, 'sys-donaciones')
+copiar_bd(BD_ORIGEN, os.environ['DATABASE_PATH'])
+
+
+@atexit.register
+def _borrar_bd_temporal():
+    if os.getpid() == _PID_BD:
+        shutil.rmtree(_CARPETA_BD, ignore_errors=True)
+
+
+import app  # noqa: E402
+
+
+DATOS_EJEMPLO = {
+    'nombre_titular': 'Juan Pérez',
+    'nombre_beneficiario': 'María García',
+    'email': 'juan@email.com',
+    'mensaje': 'Gracias por tu apoyo a las familias afectadas. Cada aportación cuenta.',
+    'certificado_nombre': 'Certificado por damnificados',
+    'cantidad': 2,
+    'monto': 5000,
+    'fecha': '15 de enero, 2024',
+    'folio': 'DON-2024-0001',
+    'plantilla': 'plantilla_default.jpg'
+}
+
+
+MENSAJES = {
+    'corto': 'Gracias.',
+    'largo': ('Gracias por tu apoyo a las familias afectadas. Cada aportación cuenta y llega a quien más '
+              'lo necesita: alimentos, medicinas y materiales para reconstruir sus casas. Este certificado '
+              'es un reconocimiento a tu generosidad y a la de todas las personas que se sumaron a la campaña '
+              'para que nadie se quede atrás.'),
+}
+
+
+def percentil(valores, p):
+    """Percentil p (0-100) de una lista de valores"""
+    if not valores:
+        return 0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p / 100))]
+
+
+def metadatos():
+    """Con qué se corrió: para que dos JSON se puedan comparar"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'cpus': os.cpu_count(),
+        'plataforma': platform.platform(),
+    }
+
+
+def guardar_json(resultados, ruta):
+    if ruta:
+        with open(ruta, 'w') as f:
+            json.dump(dict(resultados, metadatos=metadatos()), f, indent=2, ensure_ascii=False)
+        print(f"💾 Resultados guardados en {ruta}")
+
+
+def apuntar_bd(ruta):
+    """Cambia la BD de la app: detiene los workers (tienen su propia conexión) y cierra el pool"""
+    app.detener_workers()
+    app.cerrar_conexiones()
+    app.DATABASE = ruta
+    app._catalogo = None
+
+
+class BDTemporal:
+    """
+    Copia de la BD en una carpeta temporal, con la app apuntando a ella (y a
+    carpetas temporales para los certificados), sin workers de correo
+    """
+
+    def __init__(self, origen):
+        self.carpeta = tempfile.mkdtemp(prefix='bench_bd_')
+        self.ruta = os.path.join(self.carpeta, 'sys-donaciones')
+        copiar_bd(origen, self.ruta)
+
+    def __enter__(self):
+        self.anterior = (app.DATABASE, app.EMITIDOS_FOLDER, app.CACHE_RENDER_FOLDER, app.CORREO_WORKERS)
+        apuntar_bd(self.ruta)
+        # El origen puede ser una BD guardada con un esquema anterior
+        app.inicializar_esquema()
+        app.EMITIDOS_FOLDER = os.path.join(self.carpeta, 'emitidos')
+        app.CACHE_RENDER_FOLDER = os.path.join(self.carpeta, 'cache')
+        os.makedirs(app.EMITIDOS_FOLDER)
+        os.makedirs(app.CACHE_RENDER_FOLDER)
+        app.CORREO_WORKERS = 0
+        return self
+
+    def __exit__(self, *_):
+        app.vaciar_descargas()
+        apuntar_bd(self.anterior[0])
+        app.DATABASE, app.EMITIDOS_FOLDER, app.CACHE_RENDER_FOLDER, app.CORREO_WORKERS = self.anterior
+        shutil.rmtree(self.carpeta, ignore_errors=True)
+
+
+def email_donante(rnd, donantes):
+    """Email de un donante con distribución de cola larga; donante0 es el más frecuente"""
+    return f"donante{min(int((rnd.paretovariate(1.2) - 1) * donantes / 20), donantes - 1)}@example.com"
+
+
+def poblar_bd(conn, donaciones, semilla=7, lote=10000):
+    """
+    Agrega `donaciones` donaciones completadas de 1 a 3 certificados, con
+    fechas de los últimos dos años. Los emails siguen una distribución de
+    cola larga (pocos donantes con muchas donaciones), el más frecuente es
+    donante0@example.com. Los triggers mantienen las estadísticas acumuladas
+    """
+    rnd = random.Random(semilla)
+    catalogo = conn.execute("SELECT id, nombre, precio FROM certificados").fetchall()
+    id_donacion = conn.execute("SELECT COALESCE(MAX(id), 0) FROM donaciones").fetchone()[0] + 1
+    id_detalle = conn.execute("SELECT COALESCE(MAX(id), 0) FROM donacion_detalles").fetchone()[0] + 1
+    donantes = max(1, donaciones // 5)
+    ahora = datetime.now()
+    prefijo = f"BENCH{semilla}-{id_donacion}"
+
+    hechas = 0
+    while hechas < donaciones:
+        filas_donacion, filas_detalle, filas_generado = [], [], []
+        for _ in range(min(lote, donaciones - hechas)):
+            email = email_donante(rnd, donantes)
+            fecha = (ahora - timedelta(seconds=rnd.randrange(2 * 365 * 86400))).strftime('%Y-%m-%d %H:%M:%S')
+            folio = f"{prefijo}-{id_donacion}"
+            total = 0
+            for indice in range(rnd.randint(1, 3)):
+                certificado_id, nombre, precio = rnd.choice(catalogo)
+                cantidad = rnd.randint(1, 3)
+                total += precio * cantidad
+                filas_detalle.append((id_detalle, id_donacion, certificado_id, cantidad, precio, nombre,
+                                      'Beneficiario', rnd.choice(list(MENSAJES.values())),
+                                      f"{folio}-{certificado_id}-{indice}"))
+                filas_generado.append((id_detalle, 'Benchmark', email, 'Beneficiario', '', rnd.randint(0, 5)))
+                id_detalle += 1
+            filas_donacion.append((id_donacion, 'Benchmark', email, total, fecha, folio))
+            id_donacion += 1
+        conn.executemany("""
+            INSERT INTO donaciones (id, nombre_titular, email, total, fecha, estado, folio)
+            VALUES (?, ?, ?, ?, ?, 'completada', ?)
+        """, filas_donacion)
+        conn.executemany("""
+            INSERT INTO donacion_detalles (id, donacion_id, certificado_id, cantidad, precio_unitario,
+                nombre_certificado, nombre_beneficiario, mensaje_personalizado, folio_certificado)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, filas_detalle)
+        conn.executemany("""
+            INSERT INTO certificados_generados (donacion_detalle_id, nombre_donante, email_donante,
+                nombre_beneficiario, mensaje, veces_descargado)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, filas_generado)
+        conn.commit()
+        hechas += len(filas_donacion)
+    conn.execute("ANALYZE")
+    return id_donacion - 1
+
+
+# ============================================
+# RENDER POR PLANTILLA
+# ============================================
+
+def correr_render(args):
+    plantillas = sorted(
+        nombre for nombre in os.listdir(app.TEMPLATES_FOLDER)
+        if nombre.lower().endswith(app.EXTENSIONES_PLANTILLA)
+    )
+    resultados = []
+    for plantilla in plantillas:
+        for tipo, mensaje in MENSAJES.items():
+            datos_certificado = dict(DATOS_EJEMPLO, plantilla=plantilla, mensaje=mensaje)
+            # El primero carga la plantilla; se mide con la plantilla ya en caché
+            app.generar_imagen_certificado(datos_certificado, formato=args.formato)
+
+            tiempos, errores = [], 0
+            fin = time.perf_counter() + args.segundos
+            while time.perf_counter() < fin or len(tiempos) < 3:
+                inicio = time.perf_counter()
+                if app.generar_imagen_certificado(datos_certificado, formato=args.formato) is None:
+                    errores += 1
+                tiempos.append((time.perf_counter() - inicio) * 1000)
+
+            resultados.append({
+                'plantilla': plantilla,
+                'mensaje': tipo,
+                'formato': args.formato,
+                'renders': len(tiempos),
+                'renders_por_s': round(len(tiempos) / (sum(tiempos) / 1000), 2),
+                'render_p50_ms': round(percentil(tiempos, 50), 1),
+                'render_p95_ms': round(percentil(tiempos, 95), 1),
+                'errores': errores,
+            })
+    return resultados
+
+
+def imprimir_render(resultados):
+    print("🖼️ generar_imagen_certificado por plantilla y largo del mensaje")
+    print(f"{'plantilla':<26} {'mensaje':<8} {'formato':<7} {'render/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'errores':>8}")
+    for r in resultados:
+        print(f"{r['plantilla']:<26} {r['mensaje']:<8} {r['formato']:<7} {r['renders_por_s']:>9} "
+              f"{r['render_p50_ms']:>8} {r['render_p95_ms']:>8} {r['errores']:>8}")
+
+
+def medir_render(args):
+    resultados = correr_render(args)
+    imprimir_render(resultados)
+    guardar_json({'render': resultados}, args.json)
+    return 0
+
+
+# ============================================
+# COMPRAS DE PUNTA A PUNTA
+# ============================================
+
+def _esperar_lista(cliente, url_estado, limite):
+    """Long-poll del estado hasta que la emisión esté lista o se pase el límite"""
+    estado = {}
+    while time.perf_counter() < limite:
+        espera = max(1, min(app.ESTADO_ESPERA_MAX, int(limite - time.perf_counter())))
+        estado = cliente.get(f"{url_estado}&esperar={espera}").get_json()
+        if estado.get('estado') != 'procesando':
+            break
+    return estado
+
+
+def correr_compra(args):
+    resultados = []
+    with BDTemporal(args.bd):
+        catalogo = [cert for _, cert in sorted(app.obtener_catalogo()['por_id'].items()) if cert['activo'] == 1]
+        cliente = app.app.test_client()
+        for cantidad in args.items:
+            items = [
+                {'certificado_id': cert['id'], 'nombre': cert['nombre'], 'precio': cert['precio'],
+                 'cantidad': 1, 'mensaje': MENSAJES['corto']}
+                for cert in (catalogo[i % len(catalogo)] for i in range(cantidad))
+            ]
+            respuestas, listas, errores = [], [], 0
+            for _ in range(args.compras):
+                inicio = time.perf_counter()
+                respuesta = cliente.post('/api/procesar-pago', json={
+                    'nombre_titular': 'Benchmark', 'email': 'benchmark@example.com',
+                    'items': items, 'formato_imagen': args.formato,
+                })
+                respuestas.append((time.perf_counter() - inicio) * 1000)
+                if respuesta.status_code != 202:
+                    errores += 1
+                    continue
+                estado = _esperar_lista(cliente, respuesta.get_json()['url_estado'], inicio + args.espera)
+                if estado.get('estado') != 'lista':
+                    errores += 1
+                    continue
+                listas.append((time.perf_counter() - inicio) * 1000)
+
+            resultados.append({
+                'items': cantidad,
+                'formato': args.formato,
+                'compras': args.compras,
+                'respuesta_p50_ms': round(percentil(respuestas, 50), 1),
+                'respuesta_p95_ms': round(percentil(respuestas, 95), 1),
+                'lista_p50_ms': round(percentil(listas, 50), 1),
+                'lista_p95_ms': round(percentil(listas, 95), 1),
+                'certificados_por_s': round(cantidad * len(listas) / (sum(listas) / 1000), 2) if listas else 0,
+                'errores': errores,
+            })
+    return resultados
+
+
+def imprimir_compra(resultados):
+    print("🛒 /api/procesar-pago: respuesta (202) y hasta que los certificados están emitidos")
+    print(f"{'items':>6} {'resp p50':>9} {'resp p95':>9} {'lista p50':>10} {'lista p95':>10} {'cert/s':>8} {'errores':>8}")
+    for r in resultados:
+        print(f"{r['items']:>6} {r['respuesta_p50_ms']:>9} {r['respuesta_p95_ms']:>9} {r['lista_p50_ms']:>10} "
+              f"{r['lista_p95_ms']:>10} {r['certificados_por_s']:>8} {r['errores']:>8}")
+
+
+def medir_compra(args):
+    resultados = correr_compra(args)
+    imprimir_compra(resultados)
+    guardar_json({'compra': resultados}, args.json)
+    return 0
+
+
+# ============================================
+# ENDPOINTS DE LECTURA
+# ============================================
+
+def correr_lecturas(args):
+    resultados = []
+    with BDTemporal(args.bd) as bd:
+        conn = sqlite3.connect(bd.ruta)
+        inicio = time.perf_counter()
+        ultima_donacion = poblar_bd(conn, args.donaciones, args.semilla)
+        filas = {
+            tabla: conn.execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0]
+            for tabla in ('donaciones', 'donacion_detalles', 'certificados_generados')
+        }
+        print(f"🌱 BD poblada en {time.perf_counter() - inicio:.1f}s: {filas}")
+        detalle_id = conn.execute("SELECT MIN(id) FROM donacion_detalles WHERE donacion_id = ?",
+                                  (ultima_donacion,)).fetchone()[0]
+        certificado_id = conn.execute("SELECT MIN(id) FROM certificados").fetchone()[0]
+        conn.close()
+
+        cliente = app.app.test_client()
+        email = 'donante0@example.com'
+        primera = cliente.get(f'/api/mis-certificados/{email}?limit=50').get_json()
+        urls = {
+            'catalogo': '/api/certificados',
+            'catalogo_uno': f'/api/certificados/{certificado_id}',
+            'estadisticas': '/api/estadisticas',
+            'estadisticas_mes': '/api/estadisticas?periodo=mes',
+            'serie_diaria_anio': '/api/estadisticas/serie?agrupar=dia&periodo=anio',
+            'mis_certificados': f'/api/mis-certificados/{email}?limit=50',
+            'mis_certificados_pagina2': primera.get('url_siguiente'),
+            'donacion_certificados': f'/api/donacion/{ultima_donacion}/certificados',
+            'donacion_estado': f'/api/donacion/{ultima_donacion}/estado',
+            'certificado_json': f'/api/certificado/{detalle_id}?formato=json',
+            'certificado_png': f'/api/certificado/{detalle_id}',
+            'miniatura': f'/api/certificado/{detalle_id}?formato=thumb',
+            'metrics': '/metrics',
+        }
+
+        for nombre, url in urls.items():
+            if not url:
+                continue
+            # La primera vez se dibuja el certificado o se llena la caché
+            cliente.get(url).close()
+            tiempos, errores = [], 0
+            for _ in range(args.peticiones):
+                inicio = time.perf_counter()
+                respuesta = cliente.get(url)
+                respuesta.get_data()
+                respuesta.close()
+                tiempos.append((time.perf_counter() - inicio) * 1000)
+                if respuesta.status_code != 200:
+                    errores += 1
+            resultados.append({
+                'endpoint': nombre,
+                'url': url,
+                'p50_ms': round(percentil(tiempos, 50), 2),
+                'p95_ms': round(percentil(tiempos, 95), 2),
+                'peticiones_por_s': round(len(tiempos) / (sum(tiempos) / 1000), 1),
+                'errores': errores,
+            })
+    return {'filas': filas, 'endpoints': resultados}
+
+
+def imprimir_lecturas(resultados):
+    print(f"📖 Endpoints de lectura con {resultados['filas']['donaciones']:,} donaciones")
+    print(f"{'endpoint':<26} {'p50 ms':>8} {'p95 ms':>8} {'pet/s':>9} {'errores':>8}")
+    for r in resultados['endpoints']:
+        print(f"{r['endpoint']:<26} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['peticiones_por_s']:>9} {r['errores']:>8}")
+
+
+def medir_lecturas(args):
+    resultados = correr_lecturas(args)
+    imprimir_lecturas(resultados)
+    guardar_json({'lecturas': resultados}, args.json)
+    return 0
+
+
+# ============================================
+# SUITE COMPLETA Y COMPARACIÓN
+# ============================================
+
+def medir_suite(args):
+    resultados = {}
+    resultados['render'] = correr_render(args)
+    imprimir_render(resultados['render'])
+    resultados['compra'] = correr_compra(args)
+    imprimir_compra(resultados['compra'])
+    resultados['lecturas'] = correr_lecturas(args)
+    imprimir_lecturas(resultados['lecturas'])
+    guardar_json(resultados, args.json)
+    return 0
+
+
+# Campos que identifican una fila de resultados (no son mediciones)
+IDENTIDAD = ('modo', 'precarga', 'plantilla', 'mensaje', 'formato', 'items', 'endpoint')
+
+
+def aplanar(datos, prefijo=''):
+    """{'render/damnificados.jpg/corto/png/renders_por_s': 12.3, ...}"""
+    valores = {}
+    if isinstance(datos, dict):
+        for clave, valor in datos.items():
+            if clave not in ('metadatos', 'url'):
+                valores.update(aplanar(valor, f"{prefijo}{clave}/"))
+    elif isinstance(datos, list):
+        for fila in datos:
+            if isinstance(fila, dict):
+                identidad = '/'.join(str(fila[campo]) for campo in IDENTIDAD if campo in fila)
+                mediciones = {clave: valor for clave, valor in fila.items() if clave not in IDENTIDAD}
+                valores.update(aplanar(mediciones, f"{prefijo}{identidad}/"))
+    elif isinstance(datos, (int, float)) and not isinstance(datos, bool):
+        valores[prefijo.rstrip('/')] = datos
+    return valores
+
+
+def sentido(clave):
+    """-1 si menos es mejor (tiempos, memoria), 1 si más es mejor (por segundo), None si no se compara"""
+    medicion = clave.rsplit('/', 1)[-1]
+    if medicion.endswith(('_ms', '_mb')):
+        return -1
+    if medicion.endswith('_por_s'):
+        return 1
+    return None
+
+
+def comparar_resultados(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.nuevo) as f:
+        nuevo = json.load(f)
+    valores_base, valores_nuevo = aplanar(base), aplanar(nuevo)
+
+    print(f"🔎 {args.base} ({base.get('metadatos', {}).get('commit')}) → "
+          f"{args.nuevo} ({nuevo.get('metadatos', {}).get('commit')}), tolerancia {args.tolerancia}%")
+    regresiones = 0
+    for clave in sorted(set(valores_base) & set(valores_nuevo)):
+        direccion = sentido(clave)
+        antes, despues = valores_base[clave], valores_nuevo[clave]
+        if direccion is None or not antes:
+            continue
+        cambio = (despues - antes) / antes * 100
+        if cambio * direccion < -args.tolerancia:
+            regresiones += 1
+            print(f"❌ {clave}: {antes} → {despues} ({cambio:+.1f}%)")
+        elif cambio * direccion > args.tolerancia:
+            print(f"✅ {clave}: {antes} → {despues} ({cambio:+.1f}%)")
+
+    faltantes = sorted(set(valores_base) - set(valores_nuevo))
+    if faltantes:
+        print(f"⚠️ {len(faltantes)} mediciones de la base no están en la nueva corrida")
+    print(f"{'❌' if regresiones else '✅'} {regresiones} regresiones")
+    return 1 if regresiones else 0
+
+
+# ============================================
+# FORMATOS DE SALIDA
+# ============================================
+
+def medir_formatos(args):
+    datos_certificado = dict(DATOS_EJEMPLO, plantilla=args.plantilla)
+    imagen = app.dibujar_certificado(datos_certificado)
+
+    resultados = []
+    for formato in app.FORMATOS_IMAGEN:
+        tiempos = []
+        for _ in range(args.repeticiones):
+            salida = io.BytesIO()
+            inicio = time.perf_counter()
+            app.codificar_imagen(imagen, formato, salida)
+            tiempos.append((time.perf_counter() - inicio) * 1000)
+        contenido = salida.getvalue()
+        resultados.append({
+            'formato': formato,
+            'bytes': len(contenido),
+            'bytes_base64': len(base64.b64encode(contenido)),
+            'codificar_ms': round(statistics.median(tiempos), 1),
+        })
+
+    referencia = resultados[0]['bytes']
+    print(f"🖼️ Plantilla {args.plantilla} ({imagen.width}x{imagen.height}), mediana de {args.repeticiones} repeticiones")
+    print(f"{'formato':<8} {'bytes':>12} {'base64':>12} {'vs png':>8} {'ms':>8}")
+    for r in resultados:
+        print(f"{r['formato']:<8} {r['bytes']:>12,} {r['bytes_base64']:>12,} "
+              f"{r['bytes'] / referencia:>7.0%} {r['codificar_ms']:>8.1f}")
+
+    guardar_json({'plantilla': args.plantilla, 'formatos': resultados}, args.json)
+    return 0
+
+
+# ============================================
+# CONCURRENCIA DE LA BD
+# ============================================
+
+def _comprar(conn, items, retencion):
+    """Las mismas escrituras que procesar_pago, manteniendo la transacción abierta `retencion` segundos"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO donaciones (nombre_titular, email, total, fecha, estado, folio)
+        VALUES ('Benchmark', 'benchmark@example.com', 100, datetime('now', 'localtime'), 'completada', ?)
+    """, (f"BENCH-{time.time_ns()}-{threading.get_ident()}",))
+    donacion_id = cursor.lastrowid
+    for _ in range(items):
+        cursor.execute("""
+            INSERT INTO donacion_detalles (donacion_id, cantidad, precio_unitario, nombre_certificado)
+            VALUES (?, 1, 100, 'Benchmark')
+        """, (donacion_id,))
+        cursor.execute("""
+            INSERT INTO certificados_generados (donacion_detalle_id, nombre_donante, email_donante, veces_descargado)
+            VALUES (?, 'Benchmark', 'benchmark@example.com', 0)
+        """, (cursor.lastrowid,))
+    time.sleep(retencion)
+    conn.commit()
+
+
+def _correr_concurrencia(args, modo):
+    """Una corrida con la copia de la BD en el journal_mode indicado"""
+    carpeta = tempfile.mkdtemp(prefix='bench_bd_')
+    copia = os.path.join(carpeta, 'sys-donaciones')
+    copiar_bd(args.bd, copia)
+    conn = sqlite3.connect(copia)
+    conn.execute(f"PRAGMA journal_mode = {modo}")
+    email = conn.execute("SELECT email FROM donaciones ORDER BY id LIMIT 1").fetchone()[0]
+    conn.close()
+
+    anterior = app.DATABASE
+    apuntar_bd(copia)
+
+    fin = time.perf_counter() + args.segundos
+    lecturas, escrituras, errores = [], [], []
+
+    def lector():
+        cliente = app.app.test_client()
+        urls = ['/api/estadisticas', f'/api/mis-certificados/{email}']
+        i = 0
+        while time.perf_counter() < fin:
+            inicio = time.perf_counter()
+            respuesta = cliente.get(urls[i % len(urls)])
+            lecturas.append((time.perf_counter() - inicio) * 1000)
+            if respuesta.status_code != 200:
+                errores.append(respuesta.get_json().get('error'))
+            i += 1
+
+    def escritor():
+        while time.perf_counter() < fin:
+            conn = app.tomar_conexion()
+            inicio = time.perf_counter()
+            try:
+                _comprar(conn, args.items, args.retencion / 1000)
+                escrituras.append((time.perf_counter() - inicio) * 1000)
+            except sqlite3.Error as e:
+                errores.append(str(e))
+            finally:
+                app.devolver_conexion(conn)
+
+    hilos = [threading.Thread(target=lector) for _ in range(args.lectores)]
+    hilos += [threading.Thread(target=escritor) for _ in range(args.escritores)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    apuntar_bd(anterior)
+    shutil.rmtree(carpeta, ignore_errors=True)
+    return {
+        'modo': modo,
+        'lecturas_por_s': round(len(lecturas) / args.segundos, 1),
+        'lectura_p50_ms': round(percentil(lecturas, 50), 1),
+        'lectura_p95_ms': round(percentil(lecturas, 95), 1),
+        'lectura_max_ms': round(max(lecturas, default=0), 1),
+        'compras_por_s': round(len(escrituras) / args.segundos, 1),
+        'compra_p95_ms': round(percentil(escrituras, 95), 1),
+        'errores': len(errores),
+    }
+
+
+def medir_concurrencia(args):
+    resultados = [_correr_concurrencia(args, modo) for modo in ('delete', 'wal')]
+
+    print(f"🗄️ {args.lectores} lectores y {args.escritores} escritores durante {args.segundos}s "
+          f"(compras de {args.items} items, transacción abierta {args.retencion}ms)")
+    print(f"{'modo':<7} {'lect/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'compras/s':>10} {'errores':>8}")
+    for r in resultados:
+        print(f"{r['modo']:<7} {r['lecturas_por_s']:>8} {r['lectura_p50_ms']:>8} {r['lectura_p95_ms']:>8} "
+              f"{r['lectura_max_ms']:>8} {r['compras_por_s']:>10} {r['errores']:>8}")
+
+    guardar_json({'concurrencia': resultados}, args.json)
+    return 0
+
+
+# ============================================
+# MEMORIA DE LOS WORKERS
+# ============================================
+
+def uso_memoria():
+    """RSS, PSS y memoria privada (MB) del proceso actual"""
+    valores = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for linea in f:
+            partes = linea.split()
+            if len(partes) == 3 and partes[2] == 'kB':
+                valores[partes[0].rstrip(':')] = int(partes[1]) / 1024
+    return {
+        'rss_mb': valores['Rss'],
+        'pss_mb': valores['Pss'],
+        'privada_mb': valores['Private_Clean'] + valores['Private_Dirty'],
+    }
+
+
+def _worker_memoria(barrera, cola, detalle_id):
+    """Un worker: su primer request del catálogo y de un certificado, y luego su memoria"""
+    # Caché de disco vacía para que el certificado se dibuje de verdad
+    app.CACHE_RENDER_FOLDER = tempfile.mkdtemp(prefix='bench_cache_')
+    cliente = app.app.test_client()
+
+    inicio = time.perf_counter()
+    cliente.get('/api/certificados')
+    catalogo_ms = (time.perf_counter() - inicio) * 1000
+
+    inicio = time.perf_counter()
+    respuesta = cliente.get(f'/api/certificado/{detalle_id}?formato_imagen=jpeg')
+    certificado_ms = (time.perf_counter() - inicio) * 1000
+    respuesta.close()
+
+    # Con el tiempo cada worker termina usando todas las plantillas
+    for nombre in os.listdir(app.TEMPLATES_FOLDER):
+        if nombre.lower().endswith(app.EXTENSIONES_PLANTILLA):
+            app.obtener_plantilla(nombre)
+            app.obtener_plantilla(nombre, app.MINIATURA_ANCHO)
+
+    # Todos los workers siguen vivos mientras se mide, para que PSS reparta lo compartido
+    barrera.wait()
+    memoria = uso_memoria()
+    barrera.wait()
+
+    shutil.rmtree(app.CACHE_RENDER_FOLDER, ignore_errors=True)
+    cola.put(dict(memoria, catalogo_ms=catalogo_ms, certificado_ms=certificado_ms,
+                  estado=respuesta.status_code))
+
+
+def _maestro_memoria(args, precargar, cola):
+    """Hace de proceso maestro: (opcionalmente) precarga y crea los workers con fork"""
+    contexto = multiprocessing.get_context('fork')
+    app.crear_app(precargar=precargar)
+    barrera = contexto.Barrier(args.workers)
+    workers = [
+        contexto.Process(target=_worker_memoria, args=(barrera, cola, args.detalle_id))
+        for _ in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def _correr_memoria(args, precargar):
+    contexto = multiprocessing.get_context('fork')
+    cola = contexto.Queue()
+    maestro = contexto.Process(target=_maestro_memoria, args=(args, precargar, cola))
+    maestro.start()
+    workers = [cola.get() for _ in range(args.workers)]
+    maestro.join()
+
+    errores = sum(1 for w in workers if w['estado'] != 200)
+    return {
+        'precarga': precargar,
+        'workers': args.workers,
+        'rss_mb': round(statistics.mean(w['rss_mb'] for w in workers), 1),
+        'pss_mb': round(statistics.mean(w['pss_mb'] for w in workers), 1),
+        'privada_mb': round(statistics.mean(w['privada_mb'] for w in workers), 1),
+        'pss_total_mb': round(sum(w['pss_mb'] for w in workers), 1),
+        'catalogo_ms': round(statistics.median(w['catalogo_ms'] for w in workers), 1),
+        'certificado_ms': round(statistics.median(w['certificado_ms'] for w in workers), 1),
+        'errores': errores,
+    }
+
+
+def medir_memoria(args):
+    if not os.path.exists('/proc/self/smaps_rollup') or 'fork' not in multiprocessing.get_all_start_methods():
+        print("❌ La medición de memoria necesita Linux (fork y /proc/self/smaps_rollup)")
+        return 1
+
+    # Copia de la BD, y sin hilos de correo ni de emisión en los workers
+    carpeta = tempfile.mkdtemp(prefix='bench_bd_')
+    copia = os.path.join(carpeta, 'sys-donaciones')
+    copiar_bd(args.bd, copia)
+    anterior = app.DATABASE
+    apuntar_bd(copia)
+    app.CORREO_WORKERS = 0
+    app.RENDER_WORKERS = 0
+    if args.detalle_id is None:
+        conn = sqlite3.connect(copia)
+        args.detalle_id = conn.execute("SELECT MIN(id) FROM donacion_detalles").fetchone()[0]
+        conn.close()
+
+    try:
+        resultados = [_correr_memoria(args, precargar) for precargar in (False, True)]
+    finally:
+        apuntar_bd(anterior)
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+    print(f"🧠 {args.workers} workers; memoria por worker (MB) una vez usadas todas las plantillas "
+          f"y primer request (ms)")
+    print(f"{'precarga':<9} {'rss':>8} {'pss':>8} {'privada':>8} {'pss total':>10} {'catálogo':>9} {'cert':>8} {'errores':>8}")
+    for r in resultados:
+        print(f"{'sí' if r['precarga'] else 'no':<9} {r['rss_mb']:>8} {r['pss_mb']:>8} {r['privada_mb']:>8} "
+              f"{r['pss_total_mb']:>10} {r['catalogo_ms']:>9} {r['certificado_ms']:>8} {r['errores']:>8}")
+
+    guardar_json({'memoria': resultados}, args.json)
+    return 0
+
+
+# ============================================
+# PROGRAMA PRINCIPAL
+# ============================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mediciones de rendimiento")
+    subparsers = parser.add_subparsers(dest='medicion', required=True)
+
+    p_formatos = subparsers.add_parser('formatos', help="Bytes y tiempo de codificación por formato")
+    p_formatos.add_argument('--plantilla', default='plantilla_default.jpg', help="Plantilla a usar")
+    p_formatos.add_argument('--repeticiones', type=int, default=5, help="Veces que se codifica cada formato")
+    p_formatos.add_argument('--json', help="Guarda los resultados en este archivo")
+    p_formatos.set_defaults(funcion=medir_formatos)
+
+    p_concurrencia = subparsers.add_parser('concurrencia', help="Lecturas mientras hay compras escribiendo")
+    p_concurrencia.add_argument('--bd', default=app.DATABASE, help="BD a copiar")
+    p_concurrencia.add_argument('--segundos', type=float, default=5, help="Duración de cada corrida")
+    p_concurrencia.add_argument('--lectores', type=int, default=4, help="Hilos leyendo")
+    p_concurrencia.add_argument('--escritores', type=int, default=2, help="Hilos comprando")
+    p_concurrencia.add_argument('--items', type=int, default=3, help="Items por compra")
+    p_concurrencia.add_argument('--retencion', type=float, default=20, help="ms con la transacción abierta")
+    p_concurrencia.add_argument('--json', help="Guarda los resultados en este archivo")
+    p_concurrencia.set_defaults(funcion=medir_concurrencia)
+
+    p_memoria = subparsers.add_parser('memoria', help="Memoria y primer request por worker, con y sin precarga")
+    p_memoria.add_argument('--bd', default=app.DATABASE, help="BD a copiar")
+    p_memoria.add_argument('--workers', type=int, default=4, help="Workers creados con fork")
+    p_memoria.add_argument('--detalle-id', type=int, help="Certificado a pedir (por defecto, el primero)")
+    p_memoria.add_argument('--json', help="Guarda los resultados en este archivo")
+    p_memoria.set_defaults(funcion=medir_memoria)
+
+    def opciones_render(p):
+        p.add_argument('--segundos', type=float, default=2, help="Segundos midiendo cada plantilla y mensaje")
+        p.add_argument('--formato', choices=list(app.FORMATOS_IMAGEN), default='png', help="Formato a generar")
+
+    def opciones_compra(p):
+        p.add_argument('--items', type=int, nargs='+', default=[1, 10, 50], help="Items por compra")
+        p.add_argument('--compras', type=int, default=3, help="Compras por cada número de items")
+        p.add_argument('--espera', type=float, default=300, help="Segundos máximos esperando la emisión")
+
+    def opciones_lecturas(p):
+        p.add_argument('--donaciones', type=int, default=100000, help="Donaciones que se agregan a la copia")
+        p.add_argument('--peticiones', type=int, default=50, help="Peticiones por endpoint")
+        p.add_argument('--semilla', type=int, default=7, help="Semilla de los datos generados")
+
+    p_render = subparsers.add_parser('render', help="Certificados por segundo por plantilla")
+    opciones_render(p_render)
+    p_render.add_argument('--json', help="Guarda los resultados en este archivo")
+    p_render.set_defaults(funcion=medir_render)
+
+    p_compra = subparsers.add_parser('compra', help="procesar-pago de punta a punta con 1, 10 y 50 items")
+    p_compra.add_argument('--bd', default=app.DATABASE, help="BD a copiar")
+    p_compra.add_argument('--formato', choices=list(app.FORMATOS_IMAGEN), default='png', help="Formato de la descarga")
+    opciones_compra(p_compra)
+    p_compra.add_argument('--json', help="Guarda los resultados en este archivo")
+    p_compra.set_defaults(funcion=medir_compra)
+
+    p_lecturas = subparsers.add_parser('lecturas', help="Endpoints de lectura con la BD poblada")
+    p_lecturas.add_argument('--bd', default=app.DATABASE, help="BD a copiar")
+    opciones_lecturas(p_lecturas)
+    p_lecturas.add_argument('--json', help="Guarda los resultados en este archivo")
+    p_lecturas.set_defaults(funcion=medir_lecturas)
+
+    p_suite = subparsers.add_parser('suite', help="render, compra y lecturas en un solo JSON")
+    p_suite.add_argument('--bd', default=app.DATABASE, help="BD a copiar")
+    opciones_render(p_suite)
+    opciones_compra(p_suite)
+    opciones_lecturas(p_suite)
+    p_suite.add_argument('--json', help="Guarda los resultados en este archivo")
+    p_suite.set_defaults(funcion=medir_suite)
+
+    p_comparar = subparsers.add_parser('comparar', help="Compara dos JSON de resultados")
+    p_comparar.add_argument('base', help="Resultados de referencia")
+    p_comparar.add_argument('nuevo', help="Resultados a revisar")
+    p_comparar.add_argument('--tolerancia', type=float, default=15, help="Porcentaje de cambio que se tolera")
+    p_comparar.set_defaults(funcion=comparar_resultados)
+
+    args = parser.parse_args(argv)
+    return args.funcion(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
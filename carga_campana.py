@@ -0,0 +1,419 @@
+"""
+Prueba de carga de un pico de campaña (tipo teletón): miles de donantes
+comprando, viendo certificados y consultando mis-certificados en pocos
+minutos.
+
+Trabaja sobre una copia temporal de la BD que primero se llena con
+--donaciones donaciones sintéticas (las mismas de benchmark.py lecturas).
+La app corre en este mismo proceso con un servidor HTTP de varios hilos y
+los correos salen hacia un Mailjet de prueba local que responde con la
+latencia y la tasa de errores que se indiquen, así que nunca se manda un
+correo real.
+
+Las llegadas siguen la curva de --curva (segundo:llegadas por segundo,
+interpolando entre puntos) y cada llegada es una visita elegida según
+--mezcla:
+    compra            POST /api/procesar-pago, long-poll del estado y
+                      descarga del certificado o del ZIP, como Ordenes.js
+    certificado       GET /api/certificado/<id> de un certificado ya emitido
+    mis_certificados  GET /api/mis-certificados/<email>
+
+Las llegadas no esperan a que termine la anterior (carga abierta): si los
+clientes se acaban, la espera para empezar se reporta como "retraso" y la
+latencia se cuenta desde la hora programada.
+
+Llenar millones de filas tarda; con --guardar-bd se conserva la BD llena
+para las siguientes corridas (con --bd esa_copia --donaciones 0).
+
+Ejemplos:
+    python carga_campana.py
+    python carga_campana.py --donaciones 3000000 --guardar-bd /tmp/campana.db
+    python carga_campana.py --bd /tmp/campana.db --donaciones 0 --curva 0:5,60:80,240:80,300:5
+    python carga_campana.py --mezcla compra=1,certificado=1 --mailjet-latencia 800 --mailjet-errores 0.05
+    python carga_campana.py --json campana.json
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from werkzeug.serving import make_server
+
+# benchmark va antes que app: hace que app se importe sobre una copia de la BD
+from benchmark import BDTemporal, email_donante, guardar_json, percentil, poblar_bd
+import app
+
+
+def avisar(texto):
+    """Imprime en la consola aunque la salida de la app esté redirigida"""
+    print(texto, file=sys.__stdout__, flush=True)
+
+
+# ============================================
+# CURVA DE LLEGADAS
+# ============================================
+
+def leer_curva(texto):
+    """'0:5,60:50,120:5' -> [(0.0, 5.0), (60.0, 50.0), (120.0, 5.0)]"""
+    try:
+        puntos = sorted((float(s), float(t)) for s, t in (punto.split(':') for punto in texto.split(',')))
+    except ValueError:
+        raise argparse.ArgumentTypeError("la curva es segundo:llegadas_por_segundo separados por comas")
+    if len(puntos) < 2 or any(tasa < 0 for _, tasa in puntos) or max(tasa for _, tasa in puntos) == 0:
+        raise argparse.ArgumentTypeError("la curva necesita al menos dos puntos y alguna tasa mayor a 0")
+    return puntos
+
+
+def leer_mezcla(texto):
+    """'compra=2,certificado=5' -> {'compra': 2.0, 'certificado': 5.0}"""
+    try:
+        mezcla = {nombre: float(peso) for nombre, peso in (parte.split('=') for parte in texto.split(','))}
+    except ValueError:
+        raise argparse.ArgumentTypeError("la mezcla es visita=peso separados por comas")
+    desconocidas = set(mezcla) - set(VISITAS)
+    if desconocidas or not any(mezcla.values()):
+        raise argparse.ArgumentTypeError(f"visitas válidas: {', '.join(VISITAS)}")
+    return mezcla
+
+
+def tasa_en(curva, t):
+    """Llegadas por segundo en el segundo t, interpolando entre los puntos"""
+    for (t0, tasa0), (t1, tasa1) in zip(curva, curva[1:]):
+        if t0 <= t <= t1:
+            return tasa0 if t1 == t0 else tasa0 + (tasa1 - tasa0) * (t - t0) / (t1 - t0)
+    return 0
+
+
+def llegadas(curva, rnd):
+    """Segundos de cada llegada: proceso de Poisson con la tasa de la curva (por adelgazamiento)"""
+    tasa_max = max(tasa for _, tasa in curva)
+    t, fin = curva[0][0], curva[-1][0]
+    while True:
+        t += rnd.expovariate(tasa_max)
+        if t >= fin:
+            return
+        if rnd.random() * tasa_max < tasa_en(curva, t):
+            yield t
+
+
+# ============================================
+# MAILJET DE PRUEBA
+# ============================================
+# Responde como POST /v3.1/send: espera una latencia con distribución
+# lognormal alrededor de la mediana pedida y falla la llamada completa
+# (HTTP 500) o rechaza mensajes sueltos con las probabilidades indicadas.
+
+_mailjet = {'latencia_ms': 300, 'errores': 0.0, 'rechazos': 0.0}
+_mailjet_estadisticas = defaultdict(int)
+_mailjet_lock = threading.Lock()
+
+
+class _ManejadorMailjet(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        cuerpo = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            mensajes = json.loads(cuerpo).get('Messages') or []
+        except ValueError:
+            mensajes = []
+        time.sleep(random.lognormvariate(math.log(max(_mailjet['latencia_ms'], 1)), 0.5) / 1000)
+
+        if random.random() < _mailjet['errores']:
+            status, respuesta = 500, {'ErrorMessage': 'Error simulado del Mailjet de prueba'}
+        else:
+            status, respuesta = 200, {'Messages': []}
+            for mensaje in mensajes:
+                if random.random() < _mailjet['rechazos']:
+                    respuesta['Messages'].append({'Status': 'error', 'Errors': [{'ErrorMessage': 'Rechazo simulado'}]})
+                    status = 400
+                else:
+                    respuesta['Messages'].append({'Status': 'success', 'To': mensaje.get('To', [])})
+
+        with _mailjet_lock:
+            _mailjet_estadisticas['llamadas'] += 1
+            _mailjet_estadisticas['mensajes'] += len(mensajes)
+            _mailjet_estadisticas['mb_recibidos'] += len(cuerpo) / 1024 / 1024
+            _mailjet_estadisticas[f'http_{status}'] += 1
+
+        contenido = json.dumps(respuesta).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(contenido)))
+        self.end_headers()
+        self.wfile.write(contenido)
+
+    def log_message(self, *_):
+        pass
+
+
+def iniciar_mailjet(latencia_ms, errores, rechazos):
+    """Arranca el Mailjet de prueba en un puerto libre y devuelve su URL"""
+    _mailjet.update(latencia_ms=latencia_ms, errores=errores, rechazos=rechazos)
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), _ManejadorMailjet)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name='mailjet-prueba', daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_port}/"
+
+
+# ============================================
+# MEDICIONES
+# ============================================
+
+_mediciones = defaultdict(list)  # endpoint -> [(ms, status), ...]
+_retrasos = []
+_mediciones_lock = threading.Lock()
+
+
+def pedir(endpoint, url, programado=None, datos=None):
+    """
+    Hace un request y registra su latencia bajo `endpoint`. Con `programado`
+    la latencia se cuenta desde la hora en que la visita debía empezar.
+    Devuelve (status, json o None); status 0 si no hubo respuesta
+    """
+    inicio = time.perf_counter()
+    peticion = urllib.request.Request(
+        url, data=json.dumps(datos).encode('utf-8') if datos is not None else None,
+        headers={'Content-Type': 'application/json'} if datos is not None else {}
+    )
+    try:
+        with urllib.request.urlopen(peticion, timeout=120) as respuesta:
+            status, contenido, tipo = respuesta.status, respuesta.read(), respuesta.headers.get_content_type()
+    except urllib.error.HTTPError as e:
+        status, contenido, tipo = e.code, e.read(), e.headers.get_content_type()
+    except OSError:
+        status, contenido, tipo = 0, b'', None
+
+    ms = (time.perf_counter() - (programado or inicio)) * 1000
+    with _mediciones_lock:
+        _mediciones[endpoint].append((ms, status))
+    if tipo == 'application/json':
+        try:
+            return status, json.loads(contenido)
+        except ValueError:
+            pass
+    return status, None
+
+
+# ============================================
+# VISITAS
+# ============================================
+
+def visita_compra(carga, rnd, programado):
+    """Compra, espera la emisión y descarga, como Ordenes.js"""
+    items = [
+        {'certificado_id': cert['id'], 'nombre': cert['nombre'], 'precio': cert['precio'],
+         'cantidad': rnd.randint(1, 2), 'mensaje': 'Gracias por tu apoyo'}
+        for cert in rnd.sample(carga['catalogo'], min(rnd.randint(1, 3), len(carga['catalogo'])))
+    ]
+    status, respuesta = pedir('compra', f"{carga['url']}/api/procesar-pago", programado, {
+        'nombre_titular': 'Donante Campaña', 'email': email_donante(rnd, carga['donantes']), 'items': items,
+    })
+    if status != 202 or not respuesta:
+        return
+
+    limite = time.perf_counter() + carga['espera']
+    estado = {}
+    while time.perf_counter() < limite:
+        _, estado = pedir('estado', f"{carga['url']}{respuesta['url_estado']}&esperar=20")
+        if not estado or estado.get('estado') != 'procesando':
+            break
+    if estado and estado.get('estado') == 'lista':
+        pedir('descarga', f"{carga['url']}{estado['url_descarga']}")
+
+
+def visita_certificado(carga, rnd, programado):
+    pedir('certificado', f"{carga['url']}/api/certificado/{rnd.choice(carga['detalles'])}", programado)
+
+
+def visita_mis_certificados(carga, rnd, programado):
+    email = email_donante(rnd, carga['donantes'])
+    pedir('mis_certificados', f"{carga['url']}/api/mis-certificados/{email}", programado)
+
+
+VISITAS = {
+    'compra': visita_compra,
+    'certificado': visita_certificado,
+    'mis_certificados': visita_mis_certificados,
+}
+
+
+def _visitar(visita, carga, semilla, programado):
+    retraso = (time.perf_counter() - programado) * 1000
+    with _mediciones_lock:
+        _retrasos.append(retraso)
+    VISITAS[visita](carga, random.Random(semilla), programado)
+
+
+def correr_carga(carga, curva, mezcla, clientes, semilla):
+    """Programa las llegadas de la curva y espera a que terminen todas las visitas"""
+    rnd = random.Random(semilla)
+    nombres, pesos = zip(*mezcla.items())
+    inicio = time.perf_counter()
+    ultimo_aviso = inicio
+    programadas = 0
+
+    with ThreadPoolExecutor(max_workers=clientes, thread_name_prefix='cliente') as clientes_pool:
+        for t in llegadas(curva, rnd):
+            espera = inicio + t - time.perf_counter()
+            if espera > 0:
+                time.sleep(espera)
+            visita = rnd.choices(nombres, pesos)[0]
+            clientes_pool.submit(_visitar, visita, carga, rnd.getrandbits(32), inicio + t)
+            programadas += 1
+
+            if time.perf_counter() - ultimo_aviso >= 10:
+                ultimo_aviso = time.perf_counter()
+                with _mediciones_lock:
+                    hechas = sum(len(valores) for valores in _mediciones.values())
+                avisar(f"⏱️ {t:.0f}s: {tasa_en(curva, t):.1f} llegadas/s, {programadas} visitas, "
+                       f"{hechas} requests, cola de render {app._cola_render.qsize()}")
+        avisar(f"⏳ Curva terminada a los {time.perf_counter() - inicio:.0f}s, esperando las visitas en curso...")
+    return programadas, time.perf_counter() - inicio
+
+
+# ============================================
+# REPORTE
+# ============================================
+
+def resumir():
+    endpoints = []
+    for endpoint, valores in sorted(_mediciones.items()):
+        tiempos = [ms for ms, _ in valores]
+        codigos = defaultdict(int)
+        for _, status in valores:
+            codigos[str(status)] += 1
+        errores = sum(1 for _, status in valores if status == 0 or status >= 400)
+        endpoints.append({
+            'endpoint': endpoint,
+            'peticiones': len(valores),
+            'errores': errores,
+            'error_pct': round(errores / len(valores) * 100, 2),
+            'p50_ms': round(percentil(tiempos, 50), 1),
+            'p95_ms': round(percentil(tiempos, 95), 1),
+            'p99_ms': round(percentil(tiempos, 99), 1),
+            'max_ms': round(max(tiempos), 1),
+            'codigos': dict(codigos),
+        })
+    return endpoints
+
+
+def imprimir_reporte(resultados):
+    print(f"\n📈 {resultados['visitas']} visitas en {resultados['segundos']}s "
+          f"(retraso para empezar p99 {resultados['retraso_p99_ms']} ms)")
+    print(f"{'endpoint':<18} {'requests':>9} {'error %':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}  códigos")
+    for r in resultados['endpoints']:
+        codigos = ' '.join(f"{codigo}:{n}" for codigo, n in sorted(r['codigos'].items()))
+        print(f"{r['endpoint']:<18} {r['peticiones']:>9} {r['error_pct']:>8} {r['p50_ms']:>9} "
+              f"{r['p95_ms']:>9} {r['p99_ms']:>9} {r['max_ms']:>9}  {codigos}")
+    print(f"📨 Mailjet de prueba: {resultados['mailjet']}")
+    print(f"📬 cola_correos: {resultados['cola_correos']}")
+
+
+# ============================================
+# PROGRAMA PRINCIPAL
+# ============================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga de un pico de campaña")
+    parser.add_argument('--bd', default=app.DATABASE, help="BD a copiar")
+    parser.add_argument('--donaciones', type=int, default=2000000, help="Donaciones sintéticas que se agregan a la copia")
+    parser.add_argument('--semilla', type=int, default=7, help="Semilla de los datos y de las llegadas")
+    parser.add_argument('--guardar-bd', help="Guarda la BD ya llena en esta ruta para reutilizarla")
+    parser.add_argument('--curva', type=leer_curva, default=leer_curva('0:2,60:30,180:30,240:2'),
+                        help="segundo:llegadas_por_segundo,... (por defecto 0:2,60:30,180:30,240:2)")
+    parser.add_argument('--mezcla', type=leer_mezcla, default=leer_mezcla('compra=3,certificado=5,mis_certificados=2'),
+                        help="Peso de cada visita (por defecto compra=3,certificado=5,mis_certificados=2)")
+    parser.add_argument('--clientes', type=int, default=200, help="Visitas simultáneas como máximo")
+    parser.add_argument('--vistos', type=int, default=2000, help="Certificados distintos que se ven en las visitas 'certificado'")
+    parser.add_argument('--espera', type=float, default=120, help="Segundos que una compra espera su emisión")
+    parser.add_argument('--correo-workers', type=int, default=app.CORREO_WORKERS, help="Workers de correo de la app")
+    parser.add_argument('--mailjet-latencia', type=float, default=300, help="Mediana de la latencia de Mailjet (ms)")
+    parser.add_argument('--mailjet-errores', type=float, default=0.01, help="Probabilidad de que una llamada falle (HTTP 500)")
+    parser.add_argument('--mailjet-rechazos', type=float, default=0.0, help="Probabilidad de rechazar cada mensaje")
+    parser.add_argument('--log', default=os.devnull, help="Archivo para la salida de la app durante la carga")
+    parser.add_argument('--json', help="Guarda los resultados en este archivo")
+    args = parser.parse_args(argv)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    mailjet, url_mailjet = iniciar_mailjet(args.mailjet_latencia, args.mailjet_errores, args.mailjet_rechazos)
+
+    with BDTemporal(args.bd) as bd:
+        conn = sqlite3.connect(bd.ruta)
+        if args.donaciones:
+            inicio = time.perf_counter()
+            poblar_bd(conn, args.donaciones, args.semilla)
+            print(f"🌱 {args.donaciones:,} donaciones agregadas en {time.perf_counter() - inicio:.0f}s")
+        if args.guardar_bd:
+            conn.execute("VACUUM INTO ?", (args.guardar_bd,))
+            print(f"💾 BD llena guardada en {args.guardar_bd}")
+        donaciones, max_detalle = conn.execute(
+            "SELECT (SELECT COUNT(*) FROM donaciones), (SELECT MAX(id) FROM donacion_detalles)"
+        ).fetchone()
+        conn.close()
+        print(f"📋 {donaciones:,} donaciones en la BD de prueba")
+
+        # La app manda los correos al Mailjet de prueba con sus propios workers
+        app.CORREO_WORKERS = args.correo_workers
+        app.MAILJET_API_URL = url_mailjet
+        app._mailjet_cliente = None
+        for variable in ('MAILJET_API_KEY', 'MAILJET_SECRET_KEY'):
+            os.environ.setdefault(variable, 'prueba')
+        app.crear_app()
+
+        rnd = random.Random(args.semilla)
+        carga = {
+            'catalogo': [cert for _, cert in sorted(app.obtener_catalogo()['por_id'].items()) if cert['activo'] == 1],
+            'donantes': max(1, donaciones // 5),  # igual que poblar_bd
+            'detalles': [rnd.randint(1, max_detalle) for _ in range(args.vistos)] if max_detalle else [0],
+            'espera': args.espera,
+        }
+
+        servidor = make_server('127.0.0.1', 0, app.app, threaded=True)
+        threading.Thread(target=servidor.serve_forever, name='servidor-app', daemon=True).start()
+        carga['url'] = f"http://127.0.0.1:{servidor.server_port}"
+        print(f"🚀 App en {carga['url']}, Mailjet de prueba en {url_mailjet}")
+        print(f"📈 Curva {args.curva}, mezcla {args.mezcla}, {args.clientes} clientes")
+
+        try:
+            with open(args.log, 'a') as log, redirect_stdout(log):
+                visitas, segundos = correr_carga(carga, args.curva, args.mezcla, args.clientes, args.semilla)
+        finally:
+            servidor.shutdown()
+            # Los workers terminan el lote que estén mandando antes de apagar el Mailjet de prueba
+            app.detener_workers()
+            mailjet.shutdown()
+
+        conn = sqlite3.connect(bd.ruta)
+        cola_correos = dict(conn.execute("SELECT estado, COUNT(*) FROM cola_correos GROUP BY estado").fetchall())
+        conn.close()
+
+    resultados = {
+        'curva': args.curva,
+        'mezcla': args.mezcla,
+        'donaciones': donaciones,
+        'visitas': visitas,
+        'segundos': round(segundos, 1),
+        'retraso_p99_ms': round(percentil(_retrasos, 99), 1),
+        'endpoints': resumir(),
+        'mailjet': {clave: round(valor, 2) for clave, valor in sorted(_mailjet_estadisticas.items())},
+        'cola_correos': cola_correos,
+    }
+    imprimir_reporte(resultados)
+    guardar_json({'carga': resultados}, args.json)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
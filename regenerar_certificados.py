@@ -0,0 +1,198 @@
+"""
+Regenera en lote los certificados guardados, usando todos los núcleos.
+
+Sirve para volver a emitir una campaña cuando cambia una plantilla de
+data/sys-donaciones/plantillas. Por defecto se actualizan los PNG emitidos
+que sirve /api/certificado/<id> (sólo los que se dibujaron con otra versión
+de la plantilla, o todos con --forzar); con --salida se escriben en una
+carpeta aparte como certificado_<folio>.png.
+
+El avance se guarda en un archivo .progreso (uno por combinación de
+filtros), así que si se interrumpe se puede volver a correr el mismo
+comando y sólo procesa lo que faltaba.
+
+Ejemplos:
+    python regenerar_certificados.py --desde 2026-02-01 --hasta 2026-02-28
+    python regenerar_certificados.py --certificado-id 1 --certificado-id 5 --salida /tmp/certs
+    python regenerar_certificados.py --estado completada --procesos 4 --reiniciar
+    python regenerar_certificados.py --certificado-id 3 --forzar
+"""
+import argparse
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import app
+
+
+# ============================================
+# SELECCIÓN DE CERTIFICADOS
+# ============================================
+
+def seleccionar_detalles(conn, desde=None, hasta=None, certificado_ids=None, estado=None):
+    """Ids de donacion_detalles que cumplen los filtros, en orden"""
+    condiciones = []
+    parametros = []
+
+    if desde:
+        condiciones.append("d.fecha >= ?")
+        parametros.append(desde.strftime('%Y-%m-%d'))
+    if hasta:
+        # --hasta incluye todo ese día
+        condiciones.append("d.fecha < ?")
+        parametros.append((hasta + timedelta(days=1)).strftime('%Y-%m-%d'))
+    if certificado_ids:
+        condiciones.append(f"dd.certificado_id IN ({', '.join('?' * len(certificado_ids))})")
+        parametros.extend(certificado_ids)
+    if estado:
+        condiciones.append("d.estado = ?")
+        parametros.append(estado)
+
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    filas = conn.execute(f"""
+        SELECT dd.id
+        FROM donacion_detalles dd
+        JOIN donaciones d ON dd.donacion_id = d.id
+        {where}
+        ORDER BY dd.id
+    """, parametros).fetchall()
+    return [fila['id'] for fila in filas]
+
+
+# ============================================
+# ARCHIVO DE PROGRESO
+# ============================================
+
+def ruta_progreso(args):
+    """Un archivo de progreso por combinación de filtros y destino"""
+    filtros = repr((args.desde, args.hasta, sorted(args.certificado_id or []), args.estado, args.salida, args.forzar))
+    nombre = hashlib.sha1(filtros.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(app.UPLOAD_FOLDER, f"regeneracion_{nombre}.progreso")
+
+
+def leer_progreso(ruta):
+    """Ids ya terminados en una corrida anterior"""
+    if not os.path.exists(ruta):
+        return set()
+    with open(ruta) as f:
+        return {int(linea) for linea in f if linea.strip().isdigit()}
+
+
+# ============================================
+# TRABAJO DE CADA PROCESO
+# ============================================
+
+_conn = None
+_salida = None
+_forzar = False
+
+
+def _iniciar_proceso(salida, forzar):
+    """Cada proceso abre su propia conexión a la BD"""
+    global _conn, _salida, _forzar
+    _conn = app.abrir_conexion()
+    _salida = salida
+    _forzar = forzar
+
+
+def _regenerar(detalle_id):
+    """Genera un certificado y lo guarda; devuelve (detalle_id, error)"""
+    try:
+        detalle, datos_certificado = app.obtener_datos_certificado(_conn, detalle_id)
+        if not datos_certificado:
+            return detalle_id, "no encontrado"
+
+        if not _salida and detalle['cert_gen_id']:
+            # El PNG emitido sólo se vuelve a dibujar si cambió su versión
+            app.emitir_certificados(_conn, [(detalle, datos_certificado)], forzar=_forzar)
+            return detalle_id, None
+
+        img_bytes = app.generar_imagen_certificado(datos_certificado)
+        if not img_bytes:
+            return detalle_id, "error al generar"
+
+        if _salida:
+            ruta = os.path.join(_salida, f"certificado_{datos_certificado['folio']}.png")
+            with open(ruta, 'wb') as f:
+                f.write(img_bytes.getvalue())
+        else:
+            app._guardar_en_cache(app.clave_certificado(datos_certificado), img_bytes.getvalue())
+        return detalle_id, None
+    except Exception as e:
+        return detalle_id, str(e)
+
+
+# ============================================
+# PROGRAMA PRINCIPAL
+# ============================================
+
+def fecha(valor):
+    return datetime.strptime(valor, '%Y-%m-%d')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Regenera certificados guardados en paralelo")
+    parser.add_argument('--desde', type=fecha, help="Fecha inicial de la donación (YYYY-MM-DD)")
+    parser.add_argument('--hasta', type=fecha, help="Fecha final de la donación, inclusive (YYYY-MM-DD)")
+    parser.add_argument('--certificado-id', type=int, action='append', help="Tipo de certificado (se puede repetir)")
+    parser.add_argument('--estado', choices=['completada', 'pendiente', 'cancelada'], help="Estado de la donación")
+    parser.add_argument('--salida', help="Carpeta de salida (por defecto, los certificados emitidos)")
+    parser.add_argument('--forzar', action='store_true', help="Vuelve a dibujar aunque la plantilla no haya cambiado")
+    parser.add_argument('--procesos', type=int, default=os.cpu_count() or 1, help="Número de procesos")
+    parser.add_argument('--reiniciar', action='store_true', help="Ignora el progreso guardado y empieza de cero")
+    args = parser.parse_args(argv)
+
+    if args.salida:
+        os.makedirs(args.salida, exist_ok=True)
+
+    conn = app.abrir_conexion()
+    try:
+        detalle_ids = seleccionar_detalles(conn, args.desde, args.hasta, args.certificado_id, args.estado)
+    finally:
+        conn.close()
+
+    progreso = ruta_progreso(args)
+    if args.reiniciar and os.path.exists(progreso):
+        os.remove(progreso)
+    terminados = leer_progreso(progreso)
+    pendientes = [detalle_id for detalle_id in detalle_ids if detalle_id not in terminados]
+
+    print(f"📋 {len(detalle_ids)} certificados seleccionados, {len(terminados)} ya hechos, {len(pendientes)} pendientes")
+    print(f"📁 Progreso: {progreso}")
+    if not pendientes:
+        return 0
+
+    errores = 0
+    hechos = 0
+    inicio = time.perf_counter()
+    ultimo_reporte = inicio
+
+    contexto = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    pool_args = dict(processes=args.procesos, initializer=_iniciar_proceso, initargs=(args.salida, args.forzar))
+    pool = contexto.Pool(**pool_args) if contexto else multiprocessing.Pool(**pool_args)
+
+    with pool, open(progreso, 'a') as archivo_progreso:
+        for detalle_id, error in pool.imap_unordered(_regenerar, pendientes, chunksize=4):
+            hechos += 1
+            if error:
+                errores += 1
+                print(f"❌ Detalle {detalle_id}: {error}")
+            else:
+                archivo_progreso.write(f"{detalle_id}\n")
+
+            ahora = time.perf_counter()
+            if ahora - ultimo_reporte >= 1 or hechos == len(pendientes):
+                archivo_progreso.flush()
+                transcurrido = ahora - inicio
+                print(f"⏱️ {hechos}/{len(pendientes)} ({hechos / transcurrido:.1f} cert/s, {errores} errores)")
+                ultimo_reporte = ahora
+
+    print(f"✅ Terminado en {time.perf_counter() - inicio:.1f}s con {errores} errores")
+    return 1 if errores else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -509,38 +509,27 @@ procesarPago: async function() {
             throw new Error(error.error || 'Error al procesar el pago');
         }
         
-        // Obtener headers
-        const donacionId = response.headers.get('X-Donacion-ID');
-        const folio = response.headers.get('X-Folio');
+        // El pago queda guardado (202) y los certificados se generan aparte
+        const pago = await response.json();
+        const estado = await this.esperarCertificados(pago.url_estado);
         
-        // Verificar si es una imagen (certificado)
-        const contentType = response.headers.get('Content-Type');
+        // Descargar el certificado (o el ZIP si son varios); si todavía no
+        // estaba listo, el servidor lo genera al pedirlo
+        const a = document.createElement('a');
+        a.href = `${API_BASE}${estado.url_descarga}`;
+        document.body.appendChild(a);
+        a.click();
+        a.remove();
         
-        if (contentType && contentType.includes('image/png')) {
-            // Descargar el certificado
-            const blob = await response.blob();
-            const url = window.URL.createObjectURL(blob);
-            const a = document.createElement('a');
-            a.href = url;
-            a.download = `certificado_${folio || 'donacion'}.png`;
-            document.body.appendChild(a);
-            a.click();
-            window.URL.revokeObjectURL(url);
-            
-            // Limpiar sessionStorage
-            sessionStorage.removeItem('donacion_temp');
-            
-            // Mostrar mensaje de éxito con el email de la orden
-            mostrarExito({
-                donacionId: donacionId,
-                folio: folio,
-                email: datosPago.email  // ← Usamos el email de la orden
-            });
-        } else {
-            // Si no es imagen, algo salió mal
-            const data = await response.json();
-            throw new Error(data.message || 'Respuesta inesperada del servidor');
-        }
+        // Limpiar sessionStorage
+        sessionStorage.removeItem('donacion_temp');
+        
+        // Mostrar mensaje de éxito con el email de la orden
+        mostrarExito({
+            donacionId: pago.donacion_id,
+            folio: pago.folio,
+            email: datosPago.email  // ← Usamos el email de la orden
+        });
         
     } catch (error) {
         console.error('❌ Error en pago:', error);
@@ -550,6 +539,29 @@ procesarPago: async function() {
     }
 },
 
+/**
+ * Espera (long-poll) a que los certificados de la compra estén generados.
+ * Devuelve el último estado; después de unos intentos se devuelve aunque
+ * no esté listo, porque la descarga también funciona en ese caso
+ */
+esperarCertificados: async function(urlEstado, intentos = 3) {
+    const separador = urlEstado.includes('?') ? '&' : '?';
+    let estado = null;
+    for (let i = 0; i < intentos; i++) {
+        const response = await fetch(`${API_BASE}${urlEstado}${separador}esperar=20`);
+        if (!response.ok) {
+            const error = await response.json();
+            throw new Error(error.error || 'Error al consultar el estado del pago');
+        }
+        estado = await response.json();
+        if (estado.estado === 'lista') break;
+        if (estado.estado === 'error') {
+            throw new Error('El pago se registró, pero hubo un error al generar los certificados. Te llegarán por correo.');
+        }
+    }
+    return estado;
+},
+
     // ============================================
     // FUNCIONES PARA MIS-CERTIFICADOS.HTML
     // ============================================
@@ -593,7 +605,39 @@ procesarPago: async function() {
     },
 
     /**
-     * Carga los certificados de un usuario
+     * Arma la tarjeta HTML de un certificado
+     * @param {Object} cert - Certificado de /api/mis-certificados
+     * @returns {string} HTML de la tarjeta
+     */
+    tarjetaCertificado: function(cert) {
+        return `
+            <div style="background: #f8f9fa; border-radius: 10px; padding: 20px; border: 1px solid #dee2e6;">
+                <img src="${API_BASE}${cert.url_miniatura}&w=320" loading="lazy" alt="Vista previa"
+                    style="width: 100%; border-radius: 5px; margin-bottom: 10px;">
+                <h3 style="margin-top: 0;">${cert.certificado_nombre}</h3>
+                <p><strong>Beneficiario:</strong> ${cert.nombre_beneficiario}</p>
+                <p><strong>Cantidad:</strong> ${cert.cantidad}</p>
+                <p><strong>Monto:</strong> $${formatearPrecio(cert.monto_total)}</p>
+                <p><strong>Folio:</strong> ${cert.folio}</p>
+                <p><small>${new Date(cert.fecha).toLocaleDateString()}</small></p>
+                <p><small>Descargado: ${cert.veces_descargado} veces</small></p>
+                <div style="display: flex; gap: 10px; margin-top: 15px;">
+                    <a href="${cert.url_ver}" target="_blank" 
+                        style="flex: 1; background: #3498db; color: white; padding: 8px; text-align: center; text-decoration: none; border-radius: 5px;">
+                        Ver
+                    </a>
+                    <a href="${cert.url_descargar}" 
+                        style="flex: 1; background: #27ae60; color: white; padding: 8px; text-align: center; text-decoration: none; border-radius: 5px;">
+                        Descargar
+                    </a>
+                </div>
+            </div>
+        `;
+    },
+
+    /**
+     * Carga la primera página de certificados de un usuario; las siguientes
+     * se cargan solas al llegar al final de la lista (scroll infinito)
      * @param {string} email - Email del usuario
      */
     cargarCertificadosUsuario: async function(email) {
@@ -623,35 +667,22 @@ procesarPago: async function() {
             }
             
             let html = `<h2>Certificados encontrados: ${data.total_certificados}</h2>`;
-            html += '<div style="display: grid; grid-template-columns: repeat(auto-fill, minmax(300px, 1fr)); gap: 20px;">';
-            
-            data.certificados.forEach(cert => {
-                html += `
-                    <div style="background: #f8f9fa; border-radius: 10px; padding: 20px; border: 1px solid #dee2e6;">
-                        <h3 style="margin-top: 0;">${cert.certificado_nombre}</h3>
-                        <p><strong>Beneficiario:</strong> ${cert.nombre_beneficiario}</p>
-                        <p><strong>Cantidad:</strong> ${cert.cantidad}</p>
-                        <p><strong>Monto:</strong> $${formatearPrecio(cert.monto_total)}</p>
-                        <p><strong>Folio:</strong> ${cert.folio}</p>
-                        <p><small>${new Date(cert.fecha).toLocaleDateString()}</small></p>
-                        <p><small>Descargado: ${cert.veces_descargado} veces</small></p>
-                        <div style="display: flex; gap: 10px; margin-top: 15px;">
-                            <a href="${cert.url_ver}" target="_blank" 
-                                style="flex: 1; background: #3498db; color: white; padding: 8px; text-align: center; text-decoration: none; border-radius: 5px;">
-                                Ver
-                            </a>
-                            <a href="${cert.url_descargar}" 
-                                style="flex: 1; background: #27ae60; color: white; padding: 8px; text-align: center; text-decoration: none; border-radius: 5px;">
-                                Descargar
-                            </a>
-                        </div>
-                    </div>
-                `;
-            });
-            
+            html += `
+                <p>
+                    <a href="${API_BASE}/api/mis-certificados/${encodeURIComponent(email)}?formato=zip" 
+                        style="display: inline-block; background: #2c3e50; color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px;">
+                        Descargar todos (ZIP)
+                    </a>
+                </p>
+            `;
+            html += '<div id="certificados-grid" style="display: grid; grid-template-columns: repeat(auto-fill, minmax(300px, 1fr)); gap: 20px;">';
+            html += data.certificados.map(cert => this.tarjetaCertificado(cert)).join('');
             html += '</div>';
+            html += '<div id="certificados-fin" style="text-align: center; padding: 20px; color: #7f8c8d;"></div>';
             container.innerHTML = html;
             
+            this.observarSiguientePagina(data.url_siguiente);
+            
         } catch (error) {
             const container = document.getElementById('certificados-container');
             if (container) {
@@ -663,6 +694,44 @@ procesarPago: async function() {
                 `;
             }
         }
+    },
+
+    /**
+     * Pide la siguiente página cuando el final de la lista se vuelve visible
+     * @param {string|null} urlSiguiente - url_siguiente de la última respuesta
+     */
+    observarSiguientePagina: function(urlSiguiente) {
+        const fin = document.getElementById('certificados-fin');
+        if (!fin) return;
+        
+        if (this.observadorPaginas) {
+            this.observadorPaginas.disconnect();
+        }
+        if (!urlSiguiente) {
+            fin.textContent = '';
+            return;
+        }
+        
+        fin.textContent = 'Cargando más certificados...';
+        this.observadorPaginas = new IntersectionObserver(async (entradas) => {
+            if (!entradas[0].isIntersecting) return;
+            this.observadorPaginas.disconnect();
+            
+            try {
+                const response = await fetch(`${API_BASE}${urlSiguiente}`);
+                const data = await response.json();
+                if (data.error) {
+                    throw new Error(data.error);
+                }
+                
+                const grid = document.getElementById('certificados-grid');
+                grid.insertAdjacentHTML('beforeend', data.certificados.map(cert => this.tarjetaCertificado(cert)).join(''));
+                this.observarSiguientePagina(data.url_siguiente);
+            } catch (error) {
+                fin.textContent = `Error: ${error.message}`;
+            }
+        }, { rootMargin: '300px' });
+        this.observadorPaginas.observe(fin);
     }
 };
 
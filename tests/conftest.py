@@ -0,0 +1,31 @@
+"""
+Las pruebas importan benchmark antes que app: así app se importa sobre una
+copia temporal de la BD y la BD real no se migra. Cada prueba trabaja sobre
+su propia copia (fixture bd), sin workers de correo.
+"""
+import os
+import sys
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.chdir(RAIZ)  # Las carpetas de datos de la app son relativas
+
+# El cliente de Mailjet no acepta credenciales vacías; nunca se llega al Mailjet real
+os.environ.setdefault('MAILJET_API_KEY', 'prueba')
+os.environ.setdefault('MAILJET_SECRET_KEY', 'prueba')
+
+from benchmark import BDTemporal  # noqa: E402
+import app  # noqa: E402
+
+
+@pytest.fixture
+def bd():
+    with BDTemporal(app.DATABASE) as temporal:
+        yield temporal
+
+
+@pytest.fixture
+def cliente(bd):
+    return app.app.test_client()
@@ -0,0 +1,51 @@
+import time
+
+import pytest
+
+import app
+
+LECTURAS = ['/api/estadisticas', '/api/mis-certificados/lector@example.com']
+
+
+@pytest.fixture
+def compra_abierta(cliente, monkeypatch):
+    """
+    Deja una conexión con una compra a medio guardar (como procesar_pago antes
+    del commit). Se toma el candado EXCLUSIVE, el que la compra necesita para
+    su commit: sin WAL bloquea a los lectores, con WAL no les afecta.
+    """
+    # Un lector que esperara al escritor fallaría en 2 s en vez de esperar 30
+    monkeypatch.setattr(app, 'SQLITE_BUSY_TIMEOUT_MS', 2000)
+    app.cerrar_conexiones()
+    conn = app.abrir_conexion()
+
+    def abrir(journal_mode):
+        conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+        # El primer request arranca los workers, que abren su conexión antes del candado
+        cliente.get(LECTURAS[0])
+        conn.execute("BEGIN EXCLUSIVE")
+        conn.execute("""
+            INSERT INTO donaciones (nombre_titular, email, total, fecha, estado, folio)
+            VALUES ('Escritor', 'escritor@example.com', 100, datetime('now', 'localtime'), 'completada', 'DON-PRUEBA-1')
+        """)
+
+    yield abrir
+    conn.rollback()
+    conn.close()
+
+
+def test_lecturas_no_esperan_a_una_compra_con_wal(cliente, compra_abierta):
+    compra_abierta('WAL')
+    for url in LECTURAS:
+        inicio = time.perf_counter()
+        respuesta = cliente.get(url)
+        segundos = time.perf_counter() - inicio
+        assert respuesta.status_code == 200, respuesta.get_json()
+        assert segundos < 0.5, f"{url} tardó {segundos:.2f}s"
+
+
+def test_sin_wal_las_lecturas_esperan_a_la_compra(cliente, compra_abierta):
+    compra_abierta('DELETE')
+    respuesta = cliente.get(LECTURAS[0])
+    assert respuesta.status_code == 500
+    assert 'locked' in respuesta.get_json()['error']
@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app
+
+
+class _MailjetPrueba(BaseHTTPRequestHandler):
+    """POST /v3.1/send que rechaza los mensajes a direcciones con 'rechazo'"""
+
+    def do_POST(self):
+        mensajes = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['Messages']
+        estados = []
+        for mensaje in mensajes:
+            if 'rechazo' in mensaje['To'][0]['Email']:
+                estados.append({'Status': 'error', 'Errors': [{'ErrorMessage': 'Dirección rechazada'}]})
+            else:
+                estados.append({'Status': 'success', 'To': mensaje['To']})
+        contenido = json.dumps({'Messages': estados}).encode('utf-8')
+        # Como Mailjet: si algún mensaje falla la llamada regresa 400 con el estado de cada uno
+        self.send_response(200 if all(e['Status'] == 'success' for e in estados) else 400)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(contenido)))
+        self.end_headers()
+        self.wfile.write(contenido)
+
+    def log_message(self, *_):
+        pass
+
+
+@pytest.fixture
+def mailjet(monkeypatch):
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), _MailjetPrueba)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    monkeypatch.setattr(app, 'MAILJET_API_URL', f"http://127.0.0.1:{servidor.server_port}/")
+    monkeypatch.setattr(app, '_mailjet_cliente', None)
+    yield
+    servidor.shutdown()
+    servidor.server_close()
+
+
+def comprar(cliente, email):
+    respuesta = cliente.post('/api/procesar-pago', json={
+        'nombre_titular': 'Donante de prueba',
+        'email': email,
+        'items': [{'certificado_id': 3, 'cantidad': 1}],
+    })
+    assert respuesta.status_code == 202, respuesta.get_json()
+    return int(respuesta.headers['X-Correo-ID'])
+
+
+def test_lote_con_fallas_parciales(cliente, mailjet):
+    correo_ok = comprar(cliente, 'ok@example.com')
+    correo_reintento = comprar(cliente, 'rechazo@example.com')
+    correo_ultimo = comprar(cliente, 'rechazo-final@example.com')
+
+    conn = app.abrir_conexion()
+    conn_emision = app.abrir_conexion()
+    try:
+        # Los tres listos ya, y al último le queda un solo intento
+        conn.execute("UPDATE cola_correos SET proximo_intento = 0 WHERE id IN (?, ?, ?)",
+                     (correo_ok, correo_reintento, correo_ultimo))
+        conn.execute("UPDATE cola_correos SET intentos = ? WHERE id = ?", (app.CORREO_MAX_INTENTOS - 1, correo_ultimo))
+        conn.commit()
+
+        correos = app._tomar_correos(conn, app.MAILJET_LOTE_MAX)
+        assert {correo['id'] for correo in correos} == {correo_ok, correo_reintento, correo_ultimo}
+        antes = time.time()
+        app._enviar_lote_correos(conn, correos, conn_emision)
+
+        filas = {fila['id']: fila for fila in conn.execute("SELECT * FROM cola_correos")}
+    finally:
+        conn.close()
+        conn_emision.close()
+
+    assert filas[correo_ok]['estado'] == 'enviado'
+    assert filas[correo_ok]['ultimo_error'] is None
+
+    assert filas[correo_reintento]['estado'] == 'pendiente'
+    assert filas[correo_reintento]['intentos'] == 1
+    assert filas[correo_reintento]['proximo_intento'] >= antes + app.CORREO_BACKOFF_SEGUNDOS
+    assert 'rechazada' in filas[correo_reintento]['ultimo_error']
+
+    assert filas[correo_ultimo]['estado'] == 'fallido'
+    assert 'rechazada' in filas[correo_ultimo]['ultimo_error']
+
+
+def test_correo_que_nunca_termina_queda_fallido(bd):
+    conn = app.abrir_conexion()
+    try:
+        cursor = conn.cursor()
+        # Reservado y abandonado (el worker murió) tantas veces como intentos hay
+        agotado = app.encolar_correo(cursor, 'veneno@example.com', 'Veneno', 'DON-VENENO', donacion_id=1)
+        ultimo = app.encolar_correo(cursor, 'ultimo@example.com', 'Último', 'DON-ULTIMO', donacion_id=1)
+        conn.execute("UPDATE cola_correos SET estado = 'enviando', intentos = ?, proximo_intento = 0 WHERE id = ?",
+                     (app.CORREO_MAX_INTENTOS, agotado))
+        conn.execute("UPDATE cola_correos SET estado = 'enviando', intentos = ?, proximo_intento = 0 WHERE id = ?",
+                     (app.CORREO_MAX_INTENTOS - 1, ultimo))
+        conn.commit()
+
+        tomados = [correo['id'] for correo in app._tomar_correos(conn, app.MAILJET_LOTE_MAX)]
+        estados = dict(conn.execute("SELECT id, estado FROM cola_correos WHERE id IN (?, ?)", (agotado, ultimo)))
+    finally:
+        conn.close()
+
+    assert agotado not in tomados and ultimo in tomados
+    assert estados == {agotado: 'fallido', ultimo: 'enviando'}
+
+
+def test_correo_de_compra_espera_la_emision(cliente, monkeypatch):
+    # Sin workers de emisión la donación se queda en la cola
+    workers = app.RENDER_WORKERS
+    monkeypatch.setattr(app, 'RENDER_WORKERS', 0)
+    correo_id = comprar(cliente, 'espera@example.com')
+    conn = app.abrir_conexion()
+    try:
+        assert correo_id not in [correo['id'] for correo in app._tomar_correos(conn, app.MAILJET_LOTE_MAX)]
+
+        # El siguiente request arranca los workers, que emiten y liberan el correo
+        monkeypatch.setattr(app, 'RENDER_WORKERS', workers)
+        cliente.get('/api/estadisticas')
+        app._cola_render.join()
+        emitidos = conn.execute("""
+            SELECT COUNT(cg.archivo_path) FROM cola_correos cc
+            JOIN donacion_detalles dd ON dd.donacion_id = cc.donacion_id
+            JOIN certificados_generados cg ON cg.donacion_detalle_id = dd.id
+            WHERE cc.id = ?
+        """, (correo_id,)).fetchone()[0]
+        tomados = [correo['id'] for correo in app._tomar_correos(conn, app.MAILJET_LOTE_MAX)]
+    finally:
+        conn.close()
+
+    assert emitidos == 1
+    assert correo_id in tomados
@@ -0,0 +1,35 @@
+import app
+
+
+def test_solo_cuenta_descargas_que_mandan_la_imagen(cliente):
+    respuesta = cliente.post('/api/procesar-pago', json={
+        'nombre_titular': 'Donante de prueba',
+        'email': 'descargas@example.com',
+        'items': [{'certificado_id': 3, 'cantidad': 1}],
+    })
+    assert respuesta.status_code == 202, respuesta.get_json()
+    conn = app.abrir_conexion()
+    try:
+        detalle = conn.execute("""
+            SELECT dd.id, cg.id as cert_gen_id
+            FROM donacion_detalles dd JOIN certificados_generados cg ON cg.donacion_detalle_id = dd.id
+            WHERE dd.donacion_id = ?
+        """, (respuesta.get_json()['donacion_id'],)).fetchone()
+    finally:
+        conn.close()
+    url = f"/api/certificado/{detalle['id']}"
+    app.vaciar_descargas()
+
+    def descargas():
+        return app._descargas_pendientes.get(detalle['cert_gen_id'], [0])[0]
+
+    imagen = cliente.get(url)
+    assert imagen.status_code == 200 and descargas() == 1
+
+    assert cliente.get(url, headers={'If-None-Match': imagen.headers['ETag']}).status_code == 304
+    assert cliente.get(url, query_string={'formato': 'json'}).status_code == 200
+    assert cliente.get(url, query_string={'formato': 'thumb'}).status_code == 200
+    assert descargas() == 1
+
+    assert cliente.get(url, query_string={'formato': 'download'}).status_code == 200
+    assert descargas() == 2
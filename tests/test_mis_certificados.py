@@ -0,0 +1,22 @@
+from urllib.parse import quote
+
+import app
+
+
+def test_url_zip_funciona_con_cualquier_email(cliente):
+    email = 'a+b/c#d?e@example.com'
+    respuesta = cliente.post('/api/procesar-pago', json={
+        'nombre_titular': 'Donante de prueba',
+        'email': email,
+        'items': [{'certificado_id': 3, 'cantidad': 1}],
+    })
+    assert respuesta.status_code == 202, respuesta.get_json()
+    app._cola_render.join()
+
+    # Como lo pide Ordenes.js, con encodeURIComponent
+    pagina = cliente.get(f"/api/mis-certificados/{quote(email, safe='')}").get_json()
+    assert len(pagina['certificados']) == 1
+
+    zip_ = cliente.get(pagina['url_zip'])
+    assert zip_.status_code == 200
+    assert zip_.mimetype == 'application/zip'
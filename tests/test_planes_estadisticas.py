@@ -0,0 +1,42 @@
+import app
+
+
+def test_consultas_de_estadisticas_no_recorren_el_historial(bd):
+    conn = app.abrir_conexion()
+    try:
+        planes = app.revisar_planes_estadisticas(conn)
+    finally:
+        conn.close()
+    malos = {nombre: revision['plan'] for nombre, revision in planes.items() if not revision['ok']}
+    assert planes and not malos
+
+
+def test_detecta_consultas_que_leen_todo_el_historial(bd):
+    malas = [
+        "SELECT COUNT(*), SUM(total) FROM donaciones WHERE DATE(fecha) = ? AND estado = 'completada'",
+        "SELECT COUNT(*), SUM(total) FROM donaciones WHERE strftime('%Y-%m', fecha) = ? AND estado = 'completada'",
+        """SELECT email, SUM(total) as total FROM donaciones WHERE estado = 'completada'
+           GROUP BY email ORDER BY total DESC LIMIT 10""",
+    ]
+    conn = app.abrir_conexion()
+    try:
+        for sql in malas:
+            plan = app.planear_consulta(conn, sql, ('2024-01',) * sql.count('?'))
+            assert not app.plan_acotado(conn, sql, plan), plan
+    finally:
+        conn.close()
+
+
+def test_acepta_busquedas_acotadas_por_fecha_email_o_llave(bd):
+    buenas = [
+        ("SELECT SUM(total) FROM donaciones WHERE fecha >= ? AND fecha < ?", ('2024-01-01', '2024-02-01')),
+        ("SELECT * FROM donaciones WHERE email = ?", ('juan@email.com',)),
+        ("SELECT * FROM donacion_detalles dd JOIN donaciones d ON d.id = dd.donacion_id WHERE dd.id = ?", (1,)),
+    ]
+    conn = app.abrir_conexion()
+    try:
+        for sql, parametros in buenas:
+            plan = app.planear_consulta(conn, sql, parametros)
+            assert app.plan_acotado(conn, sql, plan), plan
+    finally:
+        conn.close()